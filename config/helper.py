@@ -1,26 +1,136 @@
-from os import path
+from bisect import bisect_left
+from dotenv import load_dotenv
+from os import path, getenv
+import threading
 import json
+load_dotenv()
 
 
-def read_config_file(loan_request):
+CONFIG_FILE = path.join(path.dirname(__file__), 'config.json')
+CONFIG_HOT_RELOAD = getenv('CONFIG_HOT_RELOAD', 'false').lower() in ['1', 'true', 'yes']
+TIER_KEYS = ['maximum_amount', 'loan_range', 'score_range', 'qualitative_range', 'minimum_requirements']
+
+
+class FrozenDict(dict):
     '''
-    Returns all data stored in the config.json file as a dict
+    A read-only dict. Config tiers are shared by all requests, so nobody is allowed to modify them
     '''
-    try:
-        config_file = path.join(path.dirname(__file__), 'config.json')
 
-        with open(config_file) as f:
-            data = json.load(f)['data']
-            data = [d for d in data
-                    if d['maximum_amount'] >= loan_request][0]
+    def readonly(self, *args, **kwargs):
+        raise TypeError('config data is read-only')
+
+    __setitem__ = __delitem__ = __ior__ = readonly
+    clear = pop = popitem = setdefault = update = readonly
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+def freeze(obj):
+    '''
+    Returns a deeply immutable copy of a json object: dicts become FrozenDict and lists become tuples
+    '''
+    if isinstance(obj, dict):
+        return FrozenDict({k: freeze(v) for k, v in obj.items()})
+    if isinstance(obj, list):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+
+def validate_tiers(data):
+    '''
+    Raises a ValueError if any loan tier of the config.json file is malformed
+    '''
+    if not data:
+        raise ValueError('config.json contains no loan tiers')
 
-        return data
+    for d in data:
+        missing = [k for k in TIER_KEYS if k not in d]
+        if missing:
+            raise ValueError(f'config.json loan tier is missing keys: {missing}')
+
+        if len(d['loan_range']) != len(d['score_range']):
+            raise ValueError(
+                f'config.json loan tier {d["maximum_amount"]}: loan_range and score_range differ in size')
+
+
+class ConfigRegistry:
+    '''
+    Loads and validates the config.json file once and keeps its loan tiers sorted by maximum amount,
+    so the tier matching a loan request is found by bisection.
+    When hot_reload is on, the file is read again whenever its modification time changes.
+    A reloaded file that can't be read or is invalid is ignored, and the last valid one keeps being served
+    '''
+
+    def __init__(self, config_file, hot_reload=False):
+        self.config_file = config_file
+        self.hot_reload = hot_reload
+        self.lock = threading.Lock()
+        self.snapshot = None  # (mtime, maximum amounts, tiers)
+        self.rejected = None  # mtime of the last file that failed to reload
+
+    def load(self):
+        with self.lock:
+            mtime = path.getmtime(self.config_file)
+            with open(self.config_file) as f:
+                data = json.load(f)['data']
+
+            validate_tiers(data)
+            tiers = sorted(data, key=lambda d: d['maximum_amount'])
+            amounts = [d['maximum_amount'] for d in tiers]
+            self.snapshot = (mtime, amounts, tuple(freeze(d) for d in tiers))
+            return self.snapshot
+
+    def current(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            return self.load()
+        if not self.hot_reload:
+            return snapshot
+
+        try:
+            mtime = path.getmtime(self.config_file)
+        except OSError:
+            return snapshot
+
+        if mtime not in (snapshot[0], self.rejected):
+            try:
+                snapshot = self.load()
+            except Exception as e:
+                # e.g., the file is half written: retry once it changes again
+                print(f'\033[33m Warning: unable to reload config.json, keeping the previous one: {e}\033[0m')
+                self.rejected = mtime
+        return snapshot
+
+    def tiers(self):
+        return self.current()[2]
+
+    def tier(self, loan_request):
+        _, amounts, tiers = self.current()
+        i = bisect_left(amounts, loan_request)
+        if i == len(tiers):
+            raise LookupError('Loan amount requested is over the limit.')
+        return tiers[i]
+
+
+CONFIG = ConfigRegistry(CONFIG_FILE, CONFIG_HOT_RELOAD)
+
+
+def read_config_file(loan_request):
+    '''
+    Returns the (read-only) loan tier of the config.json file matching the loan request
+    '''
+    try:
+        return CONFIG.tier(loan_request)
 
     except OSError:
         return 'Unable to find config.json'
 
-    except Exception:
-        return 'Loan amount requested is over the limit.'
+    except LookupError as e:
+        return str(e)
+
+    except Exception as e:
+        return f'Invalid config.json: {e}'
 
 
 def read_models_and_metrics(d):
@@ -0,0 +1,63 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+class MetricContext:
+    '''
+    Description:
+        intermediate results of the metrics of a single credit score request,
+        kept for inspection once the metrics ran (e.g., by the tests).
+        Each thread or task scoring a request has its own context,
+        so metrics can run concurrently without sharing state
+
+    Attributes:
+        top (dict): balances of the top ERC tokens only (wealth_capital_now_adjusted)
+        best_token (str): ticker of the token with the best avg running balance (traffic_running_balance)
+        methods (dict): volume of the txns of each decoded method (stamina_methods_count)
+        unique_coins (int): number of top ERC tokens held (stamina_coins_count)
+        typed_txn (list): dates and amounts of the txns of a given type (activity_consistency)
+        frame (pd.DataFrame): typed_txn indexed by date (activity_consistency)
+        age (int): age in days of the oldest account (history_acc_longevity)
+        profit (float): net profit since inception (activity_profit_since_inception)
+    '''
+
+    def __init__(self):
+        self.top = None
+        self.best_token = None
+        self.methods = None
+        self.unique_coins = None
+        self.typed_txn = None
+        self.frame = None
+        self.age = None
+        self.profit = None
+
+
+METRIC_CONTEXT = ContextVar('metric_context', default=None)
+
+
+def metric_context():
+    '''returns the metric context of the current request, opening one when there is none'''
+    ctx = METRIC_CONTEXT.get()
+    if ctx is None:
+        ctx = MetricContext()
+        METRIC_CONTEXT.set(ctx)
+    return ctx
+
+
+@contextmanager
+def scoring_context():
+    '''
+    Description:
+        opens a new metric context for the duration of a credit score.
+        It is dropped on exit, so the intermediate results of a user
+        are not kept alive after their request is served
+
+    Returns:
+        ctx (MetricContext): context of the metrics run within the block
+    '''
+    ctx = MetricContext()
+    token = METRIC_CONTEXT.set(ctx)
+    try:
+        yield ctx
+    finally:
+        METRIC_CONTEXT.reset(token)
@@ -1,4 +1,5 @@
 from market.coinmarketcap import *
+from config.helper import read_config_file
 import numpy as np
 from icecream import ic
 
@@ -535,3 +536,37 @@ def qualitative_feedback_covalent(
             msg = msg + f'. An error occurred while computing the score metric called {err}. ' \
                 f'As a result, your score was rounded down. Try to log into MetaMask again later'
         return msg + '.'
+
+
+# -------------------------------------------------------------------------- #
+#                               Feedback stage                               #
+# -------------------------------------------------------------------------- #
+FEEDBACK_BUILDERS = {
+    'plaid': (qualitative_feedback_plaid, interpret_score_plaid),
+    'coinbase': (qualitative_feedback_coinbase, interpret_score_coinbase),
+    'covalent': (qualitative_feedback_covalent, interpret_score_covalent)
+}
+
+
+def feedback_stage(validator, maximum_amount, score, feedback, coinmarketcap_key):
+    '''
+    Description:
+        builds the qualitative message and the interpreted feedback of a score.
+        Run on the scoring executor: the config tier is looked up in the worker
+
+    Returns:
+        message (str): qualitative message explaining the score
+        feedback (dict): interpreted score feedback
+    '''
+    configs = read_config_file(maximum_amount)
+    if isinstance(configs, str):
+        raise Exception(configs)
+
+    qualitative, interpret = FEEDBACK_BUILDERS[validator]
+    args = (configs['score_range'], configs['loan_range'], configs['qualitative_range'])
+
+    message = qualitative(
+        configs['minimum_requirements'][validator]['messages'], score, feedback, *args, coinmarketcap_key)
+    feedback = interpret(score, feedback, *args)
+
+    return message, feedback
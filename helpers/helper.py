@@ -1,7 +1,7 @@
 from pandas.io.json._normalize import nested_to_record
+from config.helper import FrozenDict
 from datetime import datetime, timezone
 from ndicts.ndicts import NestedDict
-from operator import mul
 import pandas as pd
 import numpy as np
 
@@ -151,30 +151,105 @@ def filter_dict(lst, key, value):
 
 
 def dict_reverse_cumsum(lst, col, sum_col):
+    '''
+    Description:
+        rebuild the running balance (sum_col) of every account from its latest balance,
+        by a reverse cumulative sum of the transaction amounts (col) within each account.
+        Each transaction gets the balance after all later transactions are reverted, and its amount
+        is flipped to the balance point of view (Plaid reports money out as positive amounts)
+
+    Parameters:
+        lst (list or DataFrame): transactions sorted by date, holding the latest balance in sum_col
+        col (str): column of the transaction amounts
+        sum_col (str): column of the balances
+
+    Returns:
+        df (DataFrame): the transactions grouped by account in order of appearance, with typed columns
+    '''
     df = pd.DataFrame(lst)
-    cols = df.columns
-    data = pd.DataFrame(columns=cols)
-    accounts = df['account_id'].unique().tolist()
-    for account_id in accounts:
-        temp = df[df['account_id'] == account_id]
-        row = pd.DataFrame(temp[-1:].values, columns=cols)
-        row.at[0, col] = row.at[0, sum_col]
-        temp = pd.concat([temp, row], axis=0, ignore_index=True)
-        temp.reset_index(drop=True, inplace=True)
-        temp[sum_col] = temp.loc[::-1, col].cumsum()[::-1].shift(-1)
-        temp = temp[:-1]
-        temp[col] = temp[col]*-1
-        data = pd.concat([data, temp], axis=0, ignore_index=True)
-    return data.to_dict('records')
-
-
-def aggregate_dict_by_month(data, agg_dict):
-    df = pd.DataFrame(data).set_index('date')
-    df.index = pd.to_datetime(df.index)
-    df = df.groupby([df.index.year.values, df.index.month.values]).agg(agg_dict)
+    df[col] = df[col].astype(float)
+    df[sum_col] = df[sum_col].astype(float)
+    if 'date' in df:
+        df['date'] = pd.to_datetime(df['date'])
+
+    # keep the accounts in order of appearance, and the transactions in their original order
+    account = pd.factorize(df['account_id'])[0]
+    df = df.iloc[np.argsort(account, kind='stable')].reset_index(drop=True)
+
+    groups = df.groupby('account_id', sort=False)
+    later = groups[col].transform('sum') - groups[col].cumsum()
+    df[sum_col] = groups[sum_col].transform('last') + later
+    df[col] = -df[col]
     return df
 
 
+class PlaidFrame:
+    '''
+    Description:
+        DataFrame-backed view of the Plaid transactions of one account type. It is built once per
+        account type: dates are parsed a single time, and every monthly aggregate is derived from
+        one grouped pass keyed by (account, year, month, category)
+
+    Parameters:
+        lst (list or DataFrame): formatted Plaid transactions (see format_plaid_data())
+
+    Attributes:
+        data (DataFrame): the transactions, with parsed dates and their year, month, and cash flow direction
+        monthly (DataFrame): count and sum of amounts, max limit, and last date of the transactions
+            for each account, year, month, category, sub-categories, and cash flow direction
+    '''
+
+    KEYS = ['account_id', 'year', 'month', 'category', 'sub_category', 'sub2_category', 'direction']
+
+    def __init__(self, lst):
+        df = pd.DataFrame(lst).reset_index(drop=True)
+        for k in ['amount', 'current', 'limit']:
+            df[k] = df[k].astype(float)
+        for k in ['category', 'sub_category', 'sub2_category']:
+            if k not in df:
+                df[k] = None
+        df['date'] = pd.to_datetime(df['date'])
+        df['year'] = df['date'].dt.year
+        df['month'] = df['date'].dt.month
+        df['direction'] = np.sign(df['amount'])
+        self.data = df
+
+        self.monthly = df.groupby(self.KEYS, dropna=False).agg(
+            count=('amount', 'count'),
+            amount=('amount', 'sum'),
+            limit=('limit', 'max'),
+            last_date=('date', 'max')
+        ).reset_index()
+
+    def __len__(self):
+        return len(self.data)
+
+    def by_month(self, mask=None, keys=['year', 'month']):
+        '''
+        returns the count and sum of the amounts of the transactions selected by mask (a boolean Series
+        over monthly) for each month. Only the months with at least one selected transaction are kept
+        '''
+        monthly = self.monthly if mask is None else self.monthly[mask]
+        return monthly.groupby(keys).agg(
+            count=('count', 'sum'),
+            sum=('amount', 'sum'),
+            limit=('limit', 'max'),
+            last_date=('last_date', 'max')
+        )
+
+
+def plaid_frame(lst):
+    '''
+    returns the DataFrame-backed view of a list of Plaid transactions, building it only if needed
+    '''
+    return lst if isinstance(lst, PlaidFrame) else PlaidFrame(lst)
+
+
+def last_event_timespan(df):
+    '''returns the number of days elapsed since the last transaction of a monthly aggregate'''
+    return abs((NOW - df['last_date'].max().date()).days)
+
+
 def util_ratio(metadata, data):
     metadata['credit_card']['util_ratio'] = {}
     metadata['credit_card']['util_ratio']['general'] = {}
@@ -193,45 +268,43 @@ def util_ratio(metadata, data):
 def general(metadata, lst, k1):
     ''' regardless how many different account within same account type '''
     k2 = 'general'
+    frame = plaid_frame(lst)
+    data = frame.data
     df = None
 
     # accounts
     k3 = 'accounts'
     metadata[k1][k2][k3] = {}
-    accounts = list(set([d['account_id'] for d in lst]))
+    accounts = data['account_id'].unique().tolist()
     metadata[k1][k2][k3]['total_count'] = len(accounts)
 
     # balances
     k3 = 'balances'
     metadata[k1][k2][k3] = {}
-    current, limit, high_balance = [], [], []
-
-    for account_id in accounts:
-        data = [d for d in lst if d['account_id'] == account_id]
-        current.append(data[-1]['current'])
-        limit.append(data[-1]['limit'])
-
-        if k1 == 'credit_card':
-            df = aggregate_dict_by_month(data, {'amount': 'sum', 'limit': 'max'})
-            high_balance.append(df.amount.max())
-        else:
-            high_balance.append(max([d['current'] for d in data]))
-
-        if k1 == 'checking':
-            df1 = aggregate_dict_by_month(data, {'amount': 'sum'})
-            metadata[k1][k2][k3]['monthly'] = {}
-            metadata[k1][k2][k3]['monthly']['total_count'] = len(df1)
-            metadata[k1][k2][k3]['monthly']['balance'] = df1['amount'].tolist()
-            metadata[k1][k2][k3]['monthly']['overdraft_count'] = len(df1[df1['amount'] < 0].index)
-
-    metadata[k1][k2][k3]['current'] = current
-    metadata[k1][k2][k3]['limit'] = limit
-    metadata[k1][k2][k3]['high_balance'] = high_balance
+    last = data.drop_duplicates('account_id', keep='last').set_index('account_id').loc[accounts]
+    per_account = frame.by_month(keys=['account_id', 'year', 'month']).rename(columns={'sum': 'amount'})
+
+    if k1 == 'credit_card':
+        high_balance = per_account['amount'].groupby(level='account_id').max()
+        # util ratio of the last credit card account
+        df = per_account.loc[accounts[-1], ['amount', 'limit']].copy()
+    else:
+        high_balance = data.groupby('account_id')['current'].max()
+
+    if k1 == 'checking':
+        # monthly balance of the last checking account
+        df1 = per_account.loc[accounts[-1]]
+        metadata[k1][k2][k3]['monthly'] = {}
+        metadata[k1][k2][k3]['monthly']['total_count'] = len(df1)
+        metadata[k1][k2][k3]['monthly']['balance'] = df1['amount'].tolist()
+        metadata[k1][k2][k3]['monthly']['overdraft_count'] = int((df1['amount'] < 0).sum())
+
+    metadata[k1][k2][k3]['current'] = nan_to_none(last['current'])
+    metadata[k1][k2][k3]['limit'] = nan_to_none(last['limit'])
+    metadata[k1][k2][k3]['high_balance'] = high_balance.loc[accounts].tolist()
 
     # running balance
-    data = pd.DataFrame(lst)
-    data['date'] = pd.to_datetime(data['date'], format='%Y-%m-%d')
-    temp = data.groupby([data['date'].dt.year, data['date'].dt.month], as_index=False).last()
+    temp = data.groupby(['year', 'month']).last()
     metadata[k1][k2][k3]['running_balance'] = temp['current'].tolist()
 
     # credit card util ratio
@@ -241,26 +314,30 @@ def general(metadata, lst, k1):
     # transactions
     k3 = 'transactions'
     metadata[k1][k2][k3] = {}
-    metadata[k1][k2][k3]['total_count'] = len(lst)
-    metadata[k1][k2][k3]['timespan'] = lst[0]['timespan']
+    metadata[k1][k2][k3]['total_count'] = len(data)
+    metadata[k1][k2][k3]['timespan'] = int(data['timespan'].iloc[0])
 
     m = metadata[k1][k2][k3]['timespan'] / 30
     metadata[k1][k2][k3]['avg_monthly_count'] = metadata[k1][k2][k3]['total_count'] / m
-    metadata[k1][k2][k3]['avg_monthly_value'] = sum(d['amount'] for d in lst) / m
+    metadata[k1][k2][k3]['avg_monthly_value'] = data['amount'].sum() / m
 
     return metadata
 
 
+def nan_to_none(series):
+    '''returns a Series as a list, with missing values as None'''
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
 def late_payment(metadata, lst):
     metadata['credit_card']['late_payment'] = {}
     metadata['credit_card']['late_payment']['general'] = {}
     metadata['credit_card']['late_payment']['period'] = {}
     period = [30, 60, 90, 180, 360, 720, 1800]
-    data = [d for d in lst if d['sub_category'] == 'interest charged']
-    if data:
-        values = []
-        for p in period:
-            values.append(len([d for d in data if d['timespan'] <= p]))
+    frame = plaid_frame(lst)
+    data = frame.data[frame.data['sub_category'] == 'interest charged']
+    if len(data):
+        values = [int((data['timespan'] <= p).sum()) for p in period]
         values.reverse()
         values.append(0)
         values = [values[i]-values[i+1] for i in range(len(values)-1)]
@@ -269,7 +346,7 @@ def late_payment(metadata, lst):
         metadata['credit_card']['late_payment']['period'] = dict(zip(period, values))
         metadata['credit_card']['late_payment']['general']['total_count'] = len(data)
         metadata['credit_card']['late_payment']['general']['month_count'] = len(
-            aggregate_dict_by_month(data, {'amount': ['count']}))
+            frame.by_month(frame.monthly['sub_category'] == 'interest charged'))
     return metadata
 
 
@@ -277,15 +354,15 @@ def income(metadata, lst, key, value):
     k1 = 'checking'
     k2 = 'income'
 
-    data = [d for d in lst if d[key] == value]
+    frame = plaid_frame(lst)
+    df = frame.by_month(frame.monthly[key] == value)
     k3 = value
     metadata[k1][k2][k3] = {}
-    if data:
-        df = aggregate_dict_by_month(data, {'amount': ['count', 'sum']})
-        metadata[k1][k2][k3]['avg_monthly_count'] = df[('amount', 'count')].mean()
-        metadata[k1][k2][k3]['avg_monthly_value'] = df[('amount', 'sum')].mean()
-        metadata[k1][k2][k3]['last_event_timespan'] = abs((NOW - data[-1]['date']).days)
-        metadata[k1][k2][k3]['last_montly_event_value'] = df[('amount', 'sum')].values[-1]
+    if len(df):
+        metadata[k1][k2][k3]['avg_monthly_count'] = df['count'].mean()
+        metadata[k1][k2][k3]['avg_monthly_value'] = df['sum'].mean()
+        metadata[k1][k2][k3]['last_event_timespan'] = last_event_timespan(df)
+        metadata[k1][k2][k3]['last_montly_event_value'] = df['sum'].values[-1]
     return metadata
 
 
@@ -299,16 +376,16 @@ def expenses(metadata, lst, key, value):
     k1 = 'checking'
     k2 = 'expenses'
 
-    data = [d for d in lst if d[key] == value]
+    frame = plaid_frame(lst)
+    df = frame.by_month(frame.monthly[key] == value)
     k3 = value.split()[0]
     metadata[k1][k2][k3] = {}
-    if data:
-        df = aggregate_dict_by_month(data, {'amount': ['count', 'sum']})
-        df1 = filter_frame_outliers(df, ('amount', 'sum'))
-        metadata[k1][k2][k3]['avg_monthly_count'] = df[('amount', 'count')].mean()
-        metadata[k1][k2][k3]['avg_monthly_value'] = df1[('amount', 'sum')].mean()
-        metadata[k1][k2][k3]['last_event_timespan'] = abs((NOW - data[-1]['date']).days)
-        metadata[k1][k2][k3]['last_montly_event_value'] = df[('amount', 'sum')].values[-1]
+    if len(df):
+        df1 = filter_frame_outliers(df, 'sum')
+        metadata[k1][k2][k3]['avg_monthly_count'] = df['count'].mean()
+        metadata[k1][k2][k3]['avg_monthly_value'] = df1['sum'].mean()
+        metadata[k1][k2][k3]['last_event_timespan'] = last_event_timespan(df)
+        metadata[k1][k2][k3]['last_montly_event_value'] = df['sum'].values[-1]
 
         nd = NestedDict(metadata)
         keys = [k for k in nd.keys()]
@@ -323,29 +400,30 @@ def investments(metadata, lst, key, value):
     k2 = 'investments'
     k3 = 'earnings'
 
-    data = [d for d in lst if d[key] == value]
-    if data:
-        cash_in = [d for d in data if d['amount'] < 0]
-        cash_out = [d for d in data if d['amount'] > 0]
+    frame = plaid_frame(lst)
+    data = frame.monthly[key] == value
+    if data.any():
+        cash_in = frame.by_month(data & (frame.monthly['direction'] < 0))
+        cash_out = frame.by_month(data & (frame.monthly['direction'] > 0))
         k3i = 'deposits'  # FROM checking INTO external investment account
         k3o = 'withdrawals'  # FROM external investment account INTO checking
         dm, dt, wm, wt = 0, 0, 0, 0
-        if cash_in:
-            df = aggregate_dict_by_month(cash_in, {'amount': ['count', 'sum']})
-            metadata[k1][k2][k3i]['avg_monthly_count'] = df[('amount', 'count')].mean()
-            metadata[k1][k2][k3i]['avg_monthly_value'] = df[('amount', 'sum')].mean()
-            metadata[k1][k2][k3i]['total_value'] = df[('amount', 'sum')].sum()
-            metadata[k1][k2][k3i]['last_event_timespan'] = abs((NOW - cash_in[-1]['date']).days)
-            metadata[k1][k2][k3i]['last_montly_event_value'] = df[('amount', 'sum')].values[-1]
+        if len(cash_in):
+            df = cash_in
+            metadata[k1][k2][k3i]['avg_monthly_count'] = df['count'].mean()
+            metadata[k1][k2][k3i]['avg_monthly_value'] = df['sum'].mean()
+            metadata[k1][k2][k3i]['total_value'] = df['sum'].sum()
+            metadata[k1][k2][k3i]['last_event_timespan'] = last_event_timespan(df)
+            metadata[k1][k2][k3i]['last_montly_event_value'] = df['sum'].values[-1]
             dm = metadata[k1][k2][k3i]['avg_monthly_value']
             dt = metadata[k1][k2][k3i]['total_value']
-        if cash_out:
-            df = aggregate_dict_by_month(cash_out, {'amount': ['count', 'sum']})
-            metadata[k1][k2][k3o]['avg_monthly_count'] = df[('amount', 'count')].mean()
-            metadata[k1][k2][k3o]['avg_monthly_value'] = df[('amount', 'sum')].mean()
-            metadata[k1][k2][k3o]['total_value'] = df[('amount', 'sum')].sum()
-            metadata[k1][k2][k3o]['last_event_timespan'] = abs((NOW - cash_out[-1]['date']).days)
-            metadata[k1][k2][k3o]['last_montly_event_value'] = df[('amount', 'sum')].values[-1]
+        if len(cash_out):
+            df = cash_out
+            metadata[k1][k2][k3o]['avg_monthly_count'] = df['count'].mean()
+            metadata[k1][k2][k3o]['avg_monthly_value'] = df['sum'].mean()
+            metadata[k1][k2][k3o]['total_value'] = df['sum'].sum()
+            metadata[k1][k2][k3o]['last_event_timespan'] = last_event_timespan(df)
+            metadata[k1][k2][k3o]['last_montly_event_value'] = df['sum'].values[-1]
             wm = metadata[k1][k2][k3o]['avg_monthly_value']
             wt = metadata[k1][k2][k3o]['total_value']
 
@@ -358,24 +436,25 @@ def cash_flow(metadata, lst, key, value):
     k1 = 'savings'
     k2 = 'cash_flow'
 
-    data = [d for d in lst if d[key] != value]
-    if data:
-        cash_in = [d for d in data if d['amount'] > 0]
-        cash_out = [d for d in data if d['amount'] < 0]
+    frame = plaid_frame(lst)
+    data = frame.monthly[key] != value
+    if data.any():
+        cash_in = frame.by_month(data & (frame.monthly['direction'] > 0))
+        cash_out = frame.by_month(data & (frame.monthly['direction'] < 0))
         k3i = 'deposits'
         k3o = 'withdrawals'
-        if cash_in:
-            df = aggregate_dict_by_month(cash_in, {'amount': ['count', 'sum']})
-            metadata[k1][k2][k3i]['avg_monthly_count'] = df[('amount', 'count')].mean()
-            metadata[k1][k2][k3i]['avg_monthly_value'] = df[('amount', 'sum')].mean()
-            metadata[k1][k2][k3i]['last_event_timespan'] = abs((NOW - cash_in[-1]['date']).days)
-            metadata[k1][k2][k3i]['last_montly_event_value'] = df[('amount', 'sum')].values[-1]
-        if cash_out:
-            df = aggregate_dict_by_month(cash_out, {'amount': ['count', 'sum']})
-            metadata[k1][k2][k3o]['avg_monthly_count'] = df[('amount', 'count')].mean()
-            metadata[k1][k2][k3o]['avg_monthly_value'] = df[('amount', 'sum')].mean()
-            metadata[k1][k2][k3o]['last_event_timespan'] = abs((NOW - cash_out[-1]['date']).days)
-            metadata[k1][k2][k3o]['last_montly_event_value'] = df[('amount', 'sum')].values[-1]
+        if len(cash_in):
+            df = cash_in
+            metadata[k1][k2][k3i]['avg_monthly_count'] = df['count'].mean()
+            metadata[k1][k2][k3i]['avg_monthly_value'] = df['sum'].mean()
+            metadata[k1][k2][k3i]['last_event_timespan'] = last_event_timespan(df)
+            metadata[k1][k2][k3i]['last_montly_event_value'] = df['sum'].values[-1]
+        if len(cash_out):
+            df = cash_out
+            metadata[k1][k2][k3o]['avg_monthly_count'] = df['count'].mean()
+            metadata[k1][k2][k3o]['avg_monthly_value'] = df['sum'].mean()
+            metadata[k1][k2][k3o]['last_event_timespan'] = last_event_timespan(df)
+            metadata[k1][k2][k3o]['last_montly_event_value'] = df['sum'].values[-1]
     return metadata
 
 
@@ -383,13 +462,13 @@ def earnings(metadata, lst, key, value):
     k1 = 'savings'
     k2 = 'earnings'
 
-    data = [d for d in lst if d[key] == value]
-    if data:
-        df = aggregate_dict_by_month(data, {'amount': ['count', 'sum']})
-        metadata[k1][k2]['avg_monthly_count'] = df[('amount', 'count')].mean()
-        metadata[k1][k2]['avg_monthly_value'] = df[('amount', 'sum')].mean()
-        metadata[k1][k2]['last_event_timespan'] = abs((NOW - data[-1]['date']).days)
-        metadata[k1][k2]['last_montly_event_value'] = df[('amount', 'sum')].values[-1]
+    frame = plaid_frame(lst)
+    df = frame.by_month(frame.monthly[key] == value)
+    if len(df):
+        metadata[k1][k2]['avg_monthly_count'] = df['count'].mean()
+        metadata[k1][k2]['avg_monthly_value'] = df['sum'].mean()
+        metadata[k1][k2]['last_event_timespan'] = last_event_timespan(df)
+        metadata[k1][k2]['last_montly_event_value'] = df['sum'].values[-1]
 
         nd = NestedDict(metadata)
         keys = [k for k in nd.keys()]
@@ -418,10 +497,6 @@ def cum_halves_list(start, size):
     return lst
 
 
-def dot_product(l1, l2):
-    return sum(map(mul, l1, l2))
-
-
 def head_tail_list(lst):
     return lst[0], lst[-1]
 
@@ -470,15 +545,11 @@ def build_2d_matrix(size, scalars):
     build a simple 2D scoring matrix.
     Matrix axes growth rate is defined by a log in base 10 function
     '''
-    matrix = np.zeros(size)
     scalars = [1 / n for n in scalars]
 
-    for m in range(matrix.shape[0]):
-        for n in range(matrix.shape[1]):
-            matrix[m][n] = round(
-                scalars[0] * np.log10(m + 1) + scalars[1] * np.log10(n + 1), 2
-            )
-    return matrix
+    rows = scalars[0] * np.log10(np.arange(1, size[0] + 1))
+    cols = scalars[1] * np.log10(np.arange(1, size[1] + 1))
+    return np.round(rows[:, None] + cols[None, :], 2)
 
 
 def build_normalized_matrix(size, scalar):
@@ -486,16 +557,12 @@ def build_normalized_matrix(size, scalar):
     build a normalized 2D scoring matrix.
     Matrix axes growth rate is defined by a natural logarithm function
     '''
-    m = np.zeros(size)
     # evaluate the bottom right element in the matrix and use it to normalize the matrix
-    extrema = round(scalar[0] * np.log(m.shape[0]) + scalar[1] * np.log(m.shape[1]), 2)
+    extrema = round(scalar[0] * np.log(size[0]) + scalar[1] * np.log(size[1]), 2)
 
-    for a in range(m.shape[0]):
-        for b in range(m.shape[1]):
-            m[a][b] = round(
-                (scalar[0] * np.log(a + 1) + scalar[1] * np.log(b + 1)) / extrema, 2
-            )
-    return m
+    rows = scalar[0] * np.log(np.arange(1, size[0] + 1))
+    cols = scalar[1] * np.log(np.arange(1, size[1] + 1))
+    return np.round((rows[:, None] + cols[None, :]) / extrema, 2)
 
 
 def plaid_params(params, score_range):
@@ -740,3 +807,42 @@ def covalent_params(params, score_range):
     ]
 
     return dict(zip(k, v))
+
+
+PARAMS_BUILDERS = {
+    'plaid': plaid_params,
+    'coinbase': coinbase_params,
+    'covalent': covalent_params,
+}
+COMPILED_PARAMS = {}
+
+
+def compiled_params(validator, tier):
+    '''
+    Returns the scoring params (bins, fico medians, scoring matrices) of a validator for a config loan tier.
+    They only depend on the tier, so they are built once and then shared read-only by all requests
+    '''
+    key = (validator, tier['maximum_amount'])
+    hit = COMPILED_PARAMS.get(key)
+
+    # rebuild when the tier object changed, i.e., config.json was reloaded
+    if hit is None or hit[0] is not tier:
+        params = PARAMS_BUILDERS[validator](
+            tier['minimum_requirements'][validator]['params'], tier['score_range'])
+        hit = (tier, FrozenDict(params))
+        COMPILED_PARAMS[key] = hit
+
+    return hit[1]
+
+
+def compile_params(tiers):
+    '''
+    Builds the scoring params and kernel of every validator for every config loan tier ahead of the first request
+    '''
+    from helpers.kernel import compiled_kernel
+
+    for tier in tiers:
+        for validator, requirements in tier['minimum_requirements'].items():
+            if validator in PARAMS_BUILDERS and 'params' in requirements:
+                compiled_params(validator, tier)
+                compiled_kernel(validator, tier)
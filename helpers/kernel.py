@@ -0,0 +1,135 @@
+from config.helper import read_models_and_metrics
+from helpers.helper import immutable_array
+import numpy as np
+
+
+# Features produced by each model of a validator (see helpers/models.py), in the order of the models
+# in the config.json file, along with the slice of the metric weights applied to them.
+# Weights are matched to features by position: extra weights or features are ignored.
+# A model without weights (None) scores its single feature as is
+MODEL_LAYOUT = {
+    'plaid': [(8, slice(0, 7)), (5, slice(7, 12)), (2, slice(12, 14)), (2, slice(14, None))],
+    'coinbase': [(1, None), (1, None), (2, slice(0, 2)), (5, slice(2, None))],
+    'covalent': [(2, slice(0, 2)), (3, slice(2, 5)), (5, slice(5, 10)), (3, slice(10, None))],
+}
+RISK_LEVELS = np.array(['high', 'medium', 'low'])
+
+
+class ScoringKernel:
+    '''
+    Description:
+        the model and metric weights of a validator for a config loan tier, compiled into numpy arrays,
+        to score any number of users at once:
+            - metric_matrix (models x features): weights of the metric scores within each model
+            - model_weights (models): weights of the models within the score
+        Features are the metric scores of a user, model after model, as laid out in MODEL_LAYOUT.
+        A (users x features) matrix is turned into scores, loan amounts and risk levels with array operations
+
+    Parameters:
+        validator (str): 'plaid', 'coinbase' or 'covalent'
+        tier (dict): config loan tier
+    '''
+
+    def __init__(self, validator, tier):
+        models, metrics = read_models_and_metrics(
+            tier['minimum_requirements'][validator]['scores']['models'])
+        metric_weights = list(metrics.values())
+        layout = MODEL_LAYOUT[validator]
+
+        matrix = np.zeros((len(layout), sum([n for n, s in layout])))
+        col = 0
+        for row, (n, s) in enumerate(layout):
+            w = [1] if s is None else metric_weights[s]
+            k = min(n, len(w))
+            matrix[row, col:col + k] = w[:k]
+            col += n
+
+        self.metric_matrix = immutable_array(matrix)
+        self.model_weights = immutable_array(np.array(list(models.values()), dtype=float))
+        self.score_range = immutable_array(np.array(tier['score_range'], dtype=float))
+        self.loan_range = immutable_array(np.array(tier['loan_range']))
+        self.size = col
+
+    def models(self, features):
+        '''returns the model scores (users x models) of a feature matrix (users x features)'''
+        features = np.asarray(features, dtype=float)
+        if features.shape[-1] != self.size:
+            raise ValueError(f'expected {self.size} features per user, got {features.shape[-1]}')
+        return features @ self.metric_matrix.T
+
+    def score(self, features):
+        '''returns the credit scores of a feature matrix (users x features)'''
+        head, tail = self.score_range[0], self.score_range[-1]
+        return head + (tail - head) * (self.models(features) @ self.model_weights)
+
+    def risk(self, scores):
+        '''returns the loan amounts and risk levels of an array of scores'''
+        return risk_arrays(scores, self.score_range, self.loan_range)
+
+    def run(self, features):
+        '''
+        Description:
+            scores many users in one pass
+
+        Parameters:
+            features (np.array): metric scores of each user (users x features)
+
+        Returns:
+            scores (np.array): credit scores
+            loan_amounts (np.array): maximum loan amounts
+            risk_levels (np.array): 'high', 'medium' or 'low' risk
+        '''
+        scores = self.score(features)
+        loan_amounts, risk_levels = self.risk(scores)
+        return scores, loan_amounts, risk_levels
+
+
+def risk_arrays(scores, score_range, loan_range):
+    '''
+    Description:
+        vectorized risk of many scores. Each score bin is split equally into three levels of risk,
+        and the loan amount is the maximum amount of the loan bin.
+        A score equal to one of the bin separators is treated as if it was in the lower bin
+
+    Parameters:
+        scores (np.array): credit scores
+        score_range (np.array): score bin separators
+        loan_range (np.array): loan amount of each score bin
+
+    Returns:
+        loan_amounts (np.array): maximum loan amounts
+        risk_levels (np.array): 'high', 'medium' or 'low' risk
+    '''
+    scores = np.asarray(scores, dtype=float)
+    score_range = np.asarray(score_range, dtype=float)
+    last = len(score_range) - 1
+
+    scores = scores + (np.isin(scores, score_range) & (scores >= score_range[0] + 1))
+    lower = np.clip(np.searchsorted(score_range, scores, side='right') - 1, 0, last)
+    upper = np.clip(np.searchsorted(score_range, scores, side='left'), 0, last)
+
+    split = (score_range[upper] - score_range[lower]) / 3
+    offset = scores - score_range[lower]
+    level = (offset > split).astype(int) + (offset > 2 * split)
+
+    loan_amounts = np.asarray(loan_range)[np.minimum(lower + 1, last)].astype(int)
+    return loan_amounts, RISK_LEVELS[level]
+
+
+COMPILED_KERNELS = {}
+
+
+def compiled_kernel(validator, tier):
+    '''
+    Returns the scoring kernel of a validator for a config loan tier.
+    It only depends on the tier, so it is built once and then shared read-only by all requests
+    '''
+    key = (validator, tier['maximum_amount'])
+    hit = COMPILED_KERNELS.get(key)
+
+    # rebuild when the tier object changed, i.e., config.json was reloaded
+    if hit is None or hit[0] is not tier:
+        hit = (tier, ScoringKernel(validator, tier))
+        COMPILED_KERNELS[key] = hit
+
+    return hit[1]
@@ -1,3 +1,4 @@
+from helpers.context import metric_context
 from datetime import datetime
 import pandas as pd
 import numpy as np
@@ -175,12 +176,13 @@ def history_acc_longevity(acc, feedback, params):
         if acc:
             oldest = min([d["created_at"] for d in acc if d["created_at"]])
             # age (in days) of longest standing Coinbase account
-            history_acc_longevity.age = (NOW - oldest).days
+            age = (NOW - oldest).days
+            metric_context().age = age
             score = params["fico_medians"][
-                np.digitize(history_acc_longevity.age, params["duration"], right=True)
+                np.digitize(age, params["duration"], right=True)
             ]
 
-            feedback["history"]["wallet_age(days)"] = history_acc_longevity.age
+            feedback["history"]["wallet_age(days)"] = age
         else:
             raise Exception("unknown account longevity")
 
@@ -413,7 +415,7 @@ def activity_consistency(txn, type, feedback, params):
             }
 
             # Filter by transaction type and keep txn amounts and dates
-            activity_consistency.typed_txn = [
+            typed_txn = [
                 (
                     datetime.strptime(d["created_at"], "%Y-%m-%dT%H:%M:%SZ"),
                     float(d["native_amount"]["amount"]),
@@ -422,10 +424,11 @@ def activity_consistency(txn, type, feedback, params):
                 if d["type"] in accepted_types[type]
             ]
             df = pd.DataFrame(
-                activity_consistency.typed_txn, columns=["created_at", "amount"]
+                typed_txn, columns=["created_at", "amount"]
             )
             df = df.set_index("created_at")
-            activity_consistency.frame = df
+            ctx = metric_context()
+            ctx.typed_txn, ctx.frame = typed_txn, df
             df = df.groupby(pd.Grouper(freq="M")).sum()
             df = df[-12:]
             df = df[df["amount"] != 0]
@@ -500,7 +503,7 @@ def activity_profit_since_inception(acc, txn, feedback, params):
         )
 
         profit = (balance - credits) + debits
-        activity_profit_since_inception.profit = profit
+        metric_context().profit = profit
 
         if profit == 0:
             raise Exception("no net profit")
@@ -1,3 +1,5 @@
+from helpers.context import metric_context
+import pandas as pd
 import numpy as np
 from datetime import datetime
 
@@ -8,11 +10,142 @@ NOW = datetime.now().date()
 # -------------------------------------------------------------------------- #
 
 
+TXN_COLUMNS = ['value_quote', 'successful', 'from_address', 'to_address', 'signed_at', 'method']
+
+
+class TxnFrame:
+    '''
+    Description:
+        columnar view of the Covalent class A endpoint 'transactions_v2'. It is built once per request,
+        in a single pass over the transactions, and all transaction metrics compute on its numpy arrays
+
+    Parameters:
+        txn (dict): Covalent class A endpoint 'transactions_v2'
+
+    Attributes:
+        address (str): ETH wallet address
+        quote_currency (str): currency of the transaction values
+        value_quote (array): transaction values in quote currency (nan when unknown)
+        successful (array): whether the transactions got completed
+        from_address (array): sender addresses
+        to_address (array): recipient addresses
+        signed_at (array): transaction dates (NaT when unknown)
+        method (array): decoded name of the first log event of each transaction (None if there is none)
+
+    A transaction missing some of its fields is kept, with the missing values left unknown
+
+    The arrays are read-only, so the same frame can safely be shared by all metrics
+    '''
+
+    def __init__(self, txn):
+        items = txn['items']
+        self.address = txn['address']
+        self.quote_currency = txn['quote_currency']
+
+        value_quote, successful, from_address, to_address, signed_at, method = [], [], [], [], [], []
+        for t in items:
+            log_events = t.get('log_events') or []
+            decoded = log_events[0].get('decoded') if log_events else None
+            value_quote.append(t.get('value_quote'))
+            successful.append(bool(t.get('successful')))
+            from_address.append(t.get('from_address'))
+            to_address.append(t.get('to_address'))
+            signed_at.append(t['block_signed_at'][:10] if t.get('block_signed_at') else None)
+            method.append(decoded.get('name') if decoded else None)
+
+        self.value_quote = np.array(value_quote, dtype=float)
+        self.successful = np.array(successful, dtype=bool)
+        self.from_address = np.array(from_address, dtype=object)
+        self.to_address = np.array(to_address, dtype=object)
+        self.signed_at = np.array(signed_at, dtype='datetime64[D]')
+        self.method = np.array(method, dtype=object)
+        self.freeze()
+
+    def __len__(self):
+        return len(self.value_quote)
+
+    def subset(self, mask):
+        '''returns a new TxnFrame holding only the transactions selected by mask'''
+        frame = object.__new__(TxnFrame)
+        frame.address = self.address
+        frame.quote_currency = self.quote_currency
+        for k in TXN_COLUMNS:
+            setattr(frame, k, getattr(self, k)[mask])
+        frame.freeze()
+        return frame
+
+    def freeze(self):
+        '''make the columns read-only and reset the memoized views'''
+        for k in TXN_COLUMNS:
+            getattr(self, k).flags.writeable = False
+        self.clean_view = None
+
+    def clean(self):
+        '''
+        returns the successful and non-dusty transactions. The view is computed
+        on first use and then shared by all metrics reading this frame
+        '''
+        if self.clean_view is None:
+            self.clean_view = self.subset(self.successful & (self.value_quote > 0))
+        return self.clean_view
+
+    def oldest(self):
+        '''returns the date of the oldest transaction whose date is known'''
+        return self.signed_at[~np.isnat(self.signed_at)].min().item()
+
+
+def txn_frame(txn):
+    '''
+    returns the columnar view of a Covalent 'transactions_v2' payload, building it only if needed
+    '''
+    return txn if isinstance(txn, TxnFrame) else TxnFrame(txn)
+
+
+def covalent_frame(txn):
+    '''
+    returns the columnar view of the transactions to share across all metrics.
+    When the payload can't be read, return it untouched and let every metric report its own error
+    '''
+    try:
+        return TxnFrame(txn)
+    except Exception:
+        return txn
+
+
+def swiffer_frame(txn, feedback):
+    '''
+    Description:
+        columnar counterpart of swiffer_duster(): keep only the successful and non-dusty transactions.
+        The clean view is memoized on the frame, so it is computed once per request
+
+    Parameters:
+        txn (TxnFrame): columnar transactions
+        feedback (dict): score feedback
+
+    Returns:
+        txn (TxnFrame): successful and non-dusty transactions
+    '''
+    try:
+        if txn.quote_currency == 'USD':
+            clean = txn.clean()
+
+            if len(clean):
+                return clean
+            else:
+                raise Exception("txn data should be a dict, but is NoneType")
+        else:
+            raise Exception("quote_currency should be USD, but it isn't")
+
+    except Exception as e:
+        feedback['fetch'][swiffer_duster.__name__] = str(e)
+
+
 def swiffer_duster(txn, feedback):
     '''
     Description:
         remove 'dust' transactions (i.e., transactions with less than $0.1 in spot fiat value get classified as dust) and
         keep only 'successful' transactions (i.e., transactions that got completed).
+        The payload passed in is left untouched: the filtered transactions are returned in a new dict
 
     Parameters:
         txn (dict): Covalent class A endpoint 'transactions_v2'
@@ -24,11 +157,11 @@ def swiffer_duster(txn, feedback):
     try:
         # keep only transactions that are successful and have a value > 0
         if txn['quote_currency'] == 'USD':
-            txn['items'] = [t for t in txn['items']
-                            if t['successful'] and t['value_quote'] > 0]
+            items = [t for t in txn['items']
+                     if t['successful'] and t['value_quote'] > 0]
 
-            if txn['items']:
-                return txn
+            if items:
+                return {**txn, 'items': items}
             else:
                 raise Exception("txn data should be a dict, but is NoneType")
         else:
@@ -88,7 +221,7 @@ def top_erc_only(data, feedback, top_erc):
     Parameters:
         data (dict): can be either the 'balances_v2' or the 'portfolio_v2' Covalent class A endpoint
         feedback (dict): score feedback
-        top_erc (list): list of ERC tokens ranked highest on Coinmarketcap
+        top_erc (dict or set): ERC tokens ranked highest on Coinmarketcap
 
     Returns:
         data (dict): containing only top ERC tokens. All other tokens will NOT
@@ -156,7 +289,7 @@ def fetch_covalent(txn, balances, portfolio, feedback):
         feedback (dict): update 'fetch' key in feedback
     '''
     for x in [txn, balances, portfolio]:
-        if 'JSONDecodeError' in x:
+        if isinstance(x, str) and 'JSONDecodeError' in x:
             feedback['fetch']['JSONDecodeError'] = True
         else:
             feedback['fetch']['JSONDecodeError'] = False
@@ -183,7 +316,7 @@ def credibility_kyc(txn, balances, feedback):
     try:
         # Assign max score as long as the user owns a
         # non-zero balance and a credible transaction history
-        if txn['items'] and sum([b['quote'] for b in balances['items']]) > 10:
+        if len(txn_frame(txn)) and sum([b['quote'] for b in balances['items']]) > 10:
             score = 1
             feedback['credibility']['verified'] = True
         else:
@@ -214,9 +347,7 @@ def credibility_oldest_txn(txn, feedback, params):
         feedback (dict): updated score feedback
     '''
     try:
-        oldest = datetime.strptime(
-            txn['items'][-1]['block_signed_at'].split('T')[0], '%Y-%m-%d').date()
-        how_long = (NOW - oldest).days
+        how_long = (NOW - txn_frame(txn).oldest()).days
 
         score = params['fico_medians'][np.digitize(how_long, params['duration'], right=True)]
         feedback['credibility']['longevity_days'] = how_long
@@ -286,16 +417,15 @@ def wealth_capital_now_adjusted(balances, feedback, erc_rank, params):
     '''
     try:
         # Keep only balances data of top rankes ERC tokens
-        top_erc = list(erc_rank.keys())
-        wealth_capital_now_adjusted.top = top_erc_only(balances, feedback, top_erc)
+        metric_context().top = top_erc_only(balances, feedback, erc_rank)
 
-        total = sum([b['quote'] for b in wealth_capital_now_adjusted.top['items']])
+        total = sum([b['quote'] for b in metric_context().top['items']])
         if total == 0:
             score = 0
             feedback['wealth']['cum_balance_now_adjusted'] = 0
         else:
             adjusted_balance = 0
-            for b in wealth_capital_now_adjusted.top['items']:
+            for b in metric_context().top['items']:
                 balance = b['quote']
                 ticker = b['contract_ticker_symbol']
                 # multiply the balance owned per token by a weight inversely
@@ -333,16 +463,13 @@ def wealth_volume_per_txn(txn, feedback, params):
     '''
     try:
         # remove 'dust' transactions from your dataset
-        txn = swiffer_duster(txn, feedback)
-        if txn['items']:
-            volume = 0
-            for t in txn['items']:
-                volume += t['value_quote']
-            volume_avg = volume/len(txn['items'])
+        txn = swiffer_frame(txn_frame(txn), feedback)
+        if len(txn):
+            volume_avg = txn.value_quote.mean()
 
             score = params['fico_medians'][np.digitize(
                 volume_avg, params['volume_per_txn'], right=True)]
-            feedback['wealth']['avg_volume_per_txn'] = round(volume_avg, 2)
+            feedback['wealth']['avg_volume_per_txn'] = round(float(volume_avg), 2)
 
         else:
             score = 0
@@ -379,36 +506,25 @@ def traffic_cred_deb(txn, feedback, operation, params):
     '''
     try:
         # remove 'dust' transactions from your dataset
-        txn = swiffer_duster(txn, feedback)
-        if txn['items']:
-            counts = 0
-            volume = 0
-            eth_wallet = txn['address']
+        txn = swiffer_frame(txn_frame(txn), feedback)
+        if len(txn):
+            eth_wallet = txn.address
 
             # credit
             if operation == 'credit':
-                for t in txn['items']:
-                    if t['to_address'] == eth_wallet:
-                        counts += 1
-                        volume += t['value_quote']
+                mask = txn.to_address == eth_wallet
                 count_operations = params['count_operations']/2
                 cred_deb = params['cred_deb']/2
 
             # debit
             elif operation == 'debit':
-                for t in txn['items']:
-                    if t['from_address'] == eth_wallet:
-                        counts += 1
-                        volume += t['value_quote']
+                mask = txn.from_address == eth_wallet
                 count_operations = params['count_operations']
                 cred_deb = params['cred_deb']
 
             # transfer
             elif operation == 'transfer':
-                for t in txn['items']:
-                    if eth_wallet not in [t['from_address'], t['to_address']]:
-                        counts += 1
-                        volume += t['value_quote']
+                mask = (txn.from_address != eth_wallet) & (txn.to_address != eth_wallet)
                 count_operations = params['count_operations']/2.5
                 cred_deb = params['cred_deb']/2
 
@@ -417,6 +533,9 @@ def traffic_cred_deb(txn, feedback, operation, params):
                 raise Exception(
                     "you passed an invalid param: accepts only 'credit', 'debit', or 'transfer'")
 
+            counts = int(np.count_nonzero(mask))
+            volume = float(txn.value_quote[mask].sum())
+
         else:
             score = 0
             feedback['traffic'][f'count_{operation}_txns'] = 0
@@ -451,7 +570,8 @@ def traffic_dustiness(txn, feedback, params):
         feedback (dict): updated score feedback
     '''
     try:
-        legit_ratio = len(swiffer_duster(txn, feedback)['items']) / len(txn['items'])
+        txn = txn_frame(txn)
+        legit_ratio = len(swiffer_frame(txn, feedback)) / len(txn)
         score = params['fico_medians'][np.digitize(
             legit_ratio, params['fico_medians'][1:]*0.8, right=True)]
         feedback['traffic']['legit_txn_ratio'] = round(legit_ratio, 2)
@@ -484,8 +604,7 @@ def traffic_running_balance(portfolio, feedback, params, erc_rank):
     '''
     try:
         # keep only top ERC on Coinmarketcap
-        top_erc = list(erc_rank.keys())
-        portfolio = top_erc_only(portfolio, feedback, top_erc)
+        portfolio = top_erc_only(portfolio, feedback, erc_rank)
         overview = {}
 
         for p in portfolio['items']:
@@ -499,7 +618,7 @@ def traffic_running_balance(portfolio, feedback, params, erc_rank):
             overview[ticker] = avg
 
         best_avg = max(overview.values())
-        traffic_running_balance.best_token = list(overview.keys())[list(overview.values()).index(best_avg)]
+        metric_context().best_token = list(overview.keys())[list(overview.values()).index(best_avg)]
         score = params['fico_medians'][np.digitize(best_avg, params['avg_run_bal'], right=True)]
         feedback['traffic']['avg_running_balance_best_token'] = round(
             best_avg, 2)
@@ -529,13 +648,11 @@ def traffic_frequency(txn, feedback, params):
     '''
     try:
         # remove 'dusty' transactions
-        txn = swiffer_duster(txn, feedback)
-        if txn['items']:
-            oldest = datetime.strptime(
-                txn['items'][-1]['block_signed_at'].split('T')[0], '%Y-%M-%d').date()
-            duration = int((NOW - oldest).days/30)  # months
+        txn = swiffer_frame(txn_frame(txn), feedback)
+        if len(txn):
+            duration = int((NOW - txn.oldest()).days/30)  # months
 
-            frequency = round(len(txn['items']) / duration, 2)
+            frequency = round(len(txn) / duration, 2)
             score = params['fico_medians'][np.digitize(frequency, params['frequency_txn'], right=True)]
             feedback['traffic']['txn_frequency'] = f'{frequency} txn/month over {duration} months'
         else:
@@ -567,19 +684,23 @@ def stamina_methods_count(txn, feedback, params):
 
     Returns:
         score (float): points for the number of unique methods and their volume
-        feedback (dict): updated score feedback
+        feedback (dict): updated score feedback, with the count and volume of each method
     '''
     try:
         # remove 'dusty' transactions
-        txn = swiffer_duster(txn, feedback)
-        if txn['items']:
-            all = [(t['log_events'][0]['decoded']['name'], t['value_quote'])
-                   for t in txn['items'] if t['log_events'] and t['log_events'][0]['decoded']]
-
-            stamina_methods_count.methods = {}
-            for a in set([x[0] for x in all]):
-                stamina_methods_count.methods[a] = int(sum([y[1] for y in all if a == y[0]]))
-            methods = stamina_methods_count.methods
+        txn = swiffer_frame(txn_frame(txn), feedback)
+        if len(txn):
+            # group transactions by decoded method in a single pass
+            decoded = pd.notna(txn.method)
+            names, group = np.unique(txn.method[decoded].astype(str), return_inverse=True)
+            counts = np.bincount(group, minlength=len(names))
+            volumes = np.bincount(group, weights=txn.value_quote[decoded], minlength=len(names))
+            names = names.tolist()
+
+            methods = {k: int(v) for k, v in zip(names, volumes)}
+            metric_context().methods = methods
+            feedback['stamina']['methods'] = {
+                k: {'count': int(c), 'volume': round(float(v), 2)} for k, c, v in zip(names, counts, volumes)}
 
         else:
             score = 0
@@ -621,23 +742,20 @@ def stamina_coins_count(balances, feedback, params, erc_rank):
     '''
     try:
         # keep only top ERC on Coinmarketcap
-        balances = top_erc_only(balances, feedback, list(erc_rank.keys()))
+        balances = top_erc_only(balances, feedback, erc_rank)
 
-        weighted_sum = 0
-        volumes = [b['quote'] for b in balances['items'] if b['quote'] != 0]
-        ranks = [erc_rank[b['contract_ticker_symbol']]
-                 for b in balances['items'] if b['quote'] != 0]
-        stamina_coins_count.unique_coins = len(volumes)
+        held = [(b['quote'], erc_rank[b['contract_ticker_symbol']]) for b in balances['items'] if b['quote'] != 0]
+        quotes, ranks = np.array(held, dtype=float).reshape(-1, 2).T
+        metric_context().unique_coins = len(quotes)
 
-        for b in balances['items']:
-            if b['quote'] != 0:
-                weight = (sum(ranks) / erc_rank[b['contract_ticker_symbol']]) / sum([sum(ranks)/r for r in ranks])
-                weighted_sum += b['quote']*weight
+        # weight each balance by the inverse of its token rank, normalized across all tokens held
+        inverse = 1 / ranks
+        weighted_sum = quotes @ inverse / inverse.sum() if len(quotes) else 0
 
-        m = np.digitize(stamina_coins_count.unique_coins, params['count_to_four'], right=True)
+        m = np.digitize(len(quotes), params['count_to_four'], right=True)
         n = np.digitize(weighted_sum, params['volume_now']*0.5, right=True)
         score = params['mtx_stamina'][m][n]
-        feedback['stamina']['coins_count'] = stamina_coins_count.unique_coins
+        feedback['stamina']['coins_count'] = len(quotes)
 
     except Exception as e:
         score = 0
@@ -715,9 +833,7 @@ def stamina_loan_duedate(txn, feedback, params):
     '''
     try:
         # Read in the date of the oldest txn
-        oldest_txn = datetime.strptime(
-            txn['items'][-1]['block_signed_at'], '%Y-%m-%dT%H:%M:%SZ').date()
-        txn_length = int((NOW - oldest_txn).days/30)  # months
+        txn_length = int((NOW - txn_frame(txn).oldest()).days/30)  # months
 
         # Loan duedate is equal to the month of txn history there are
         due = np.digitize(txn_length, params['due_date'], right=True)
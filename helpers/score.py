@@ -1,11 +1,11 @@
+from config.helper import *
 from helpers.models import *
 from helpers.helper import *
+from helpers.kernel import compiled_kernel
+from helpers.context import scoring_context
 
 
-def plaid_score(data, score_range, feedback, model_weights, metric_weigths, params, period):
-
-    # format params
-    params = plaid_params(params, score_range)
+def plaid_features(data, feedback, params, period):
 
     # split data: mutually exclusive
     credit_card = filter_dict(data, 'type', 'credit')
@@ -39,13 +39,14 @@ def plaid_score(data, score_range, feedback, model_weights, metric_weigths, para
         }
     }
 
+    # parse each account type once, and share its monthly aggregates across all metadata
     if credit_card:
-        credit_card = dict_reverse_cumsum(credit_card, 'amount', 'current')
+        credit_card = plaid_frame(dict_reverse_cumsum(credit_card, 'amount', 'current'))
         metadata = general(metadata, credit_card, 'credit_card')
         metadata = late_payment(metadata, credit_card)
 
     if checking:
-        checking = dict_reverse_cumsum(checking, 'amount', 'current')
+        checking = plaid_frame(dict_reverse_cumsum(checking, 'amount', 'current'))
         metadata = general(metadata, checking, 'checking')
         metadata = income(metadata, checking, 'sub_category', 'payroll')
         metadata = expenses(metadata, checking, 'sub_category', 'rent')
@@ -55,57 +56,132 @@ def plaid_score(data, score_range, feedback, model_weights, metric_weigths, para
         metadata = investments(metadata, checking, 'sub2_category', 'financial planning and investments')
 
     if savings:
-        savings = dict_reverse_cumsum(savings, 'amount', 'current')
+        savings = plaid_frame(dict_reverse_cumsum(savings, 'amount', 'current'))
         metadata = general(metadata, savings, 'savings')
         metadata = cash_flow(metadata, savings, 'category', 'interest')
         metadata = earnings(metadata, savings, 'sub_category', 'interest earned')
 
     # create model
-    credit, feedback = plaid_credit_model(feedback, params, metric_weigths, metadata, period)
-    velocity, feedback = plaid_velocity_model(feedback, params, metric_weigths, metadata)
-    stability, feedback = plaid_stability_model(feedback, params, metric_weigths, metadata)
-    diversity, feedback = plaid_diversity_model(feedback, params, metric_weigths,  metadata)
+    credit, feedback = plaid_credit_model(feedback, params, metadata, period)
+    velocity, feedback = plaid_velocity_model(feedback, params, metadata)
+    stability, feedback = plaid_stability_model(feedback, params, metadata)
+    diversity, feedback = plaid_diversity_model(feedback, params, metadata)
 
-    a = list(model_weights.values())
-    b = [credit, velocity, stability, diversity]
+    return credit + velocity + stability + diversity, feedback, metadata
 
-    head, tail = head_tail_list(score_range)
-    score = head + (tail - head) * (dot_product(a, b))
 
-    return score, feedback, metadata
+def coinbase_features(feedback, params, acc, txn):
 
+    kyc, feedback = coinbase_kyc(acc, txn, feedback)
+    history, feedback = coinbase_history(acc, feedback, params)
+    liquidity, feedback = coinbase_liquidity(acc, txn, feedback, params)
+    activity, feedback = coinbase_activity(acc, txn, feedback, params)
 
-def coinbase_score(score_range, feedback, model_weights, metric_weigths, params, acc, txn):
+    return kyc + history + liquidity + activity, feedback
 
-    params = coinbase_params(params, score_range)
 
-    kyc, feedback = coinbase_kyc(acc, txn, feedback)
-    history, feedback = coinbase_history(acc, feedback, params)
-    liquidity, feedback = coinbase_liquidity(acc, txn, feedback, metric_weigths, params)
-    activity, feedback = coinbase_activity(acc, txn, feedback, metric_weigths, params)
+def covalent_features(feedback, params, erc_rank, txn, balances, portfolio):
+
+    # read the transactions into columns once, for all metrics
+    txn = covalent_frame(txn)
+
+    credibility, feedback = covalent_credibility(txn, balances, portfolio, feedback, params)
+    wealth, feedback = covalent_wealth(txn, balances, feedback, params, erc_rank)
+    traffic, feedback = covalent_traffic(txn, portfolio, feedback, params, erc_rank)
+    stamina, feedback = covalent_stamina(txn, balances, portfolio, feedback, params, erc_rank)
+
+    return credibility + wealth + traffic + stamina, feedback
+
+
+# -------------------------------------------------------------------------- #
+#                               Scoring stages                               #
+# -------------------------------------------------------------------------- #
+# The fetch-independent part of each credit score, run on the scoring executor:
+# the metrics of a user, turned into their row of features. Only the user data
+# is shipped to the worker: the config tier and the compiled params are looked
+# up in the worker itself.
+# Each stage runs its metrics within a metric context of its own, so stages
+# of different requests can run on the same thread pool at once.
+# The rows are then scored together by score_features(), many users at once.
+
+def scoring_inputs(validator, maximum_amount):
+    '''
+    Description:
+        reads the config tier and the compiled params of a validator
+
+    Parameters:
+        validator (str): 'plaid', 'coinbase' or 'covalent'
+        maximum_amount (int): maximum amount of the config loan tier
+
+    Returns:
+        configs (dict): config loan tier
+        params (dict): compiled scoring params
+    '''
+    configs = read_config_file(maximum_amount)
+    if isinstance(configs, str):
+        raise Exception(configs)
+
+    return configs, compiled_params(validator, configs)
+
+
+def plaid_stage(maximum_amount, feedback, transactions, accounts):
+    '''
+    Description:
+        formats Plaid data, validates the loan request, and computes the Plaid metrics
+
+    Returns:
+        None if the user does not qualify for the loan, else (features, feedback, metadata)
+    '''
+    configs, parm = scoring_inputs('plaid', maximum_amount)
+    period = configs['minimum_requirements']['plaid']['thresholds']['transactions_period']
+
+    data = format_plaid_data(transactions, accounts)
+    if not validate_loan_request(configs['loan_range'], accounts) or not validate_txn_history(period, data):
+        return None
+
+    with scoring_context():
+        return plaid_features(data, feedback, parm, period)
 
-    a = list(model_weights.values())
-    b = [kyc, history, liquidity, activity]
 
-    head, tail = head_tail_list(score_range)
-    score = head + (tail - head) * (dot_product(a, b))
+def coinbase_stage(maximum_amount, feedback, acc, txn):
+    '''computes the Coinbase metrics, returns (features, feedback)'''
+    configs, parm = scoring_inputs('coinbase', maximum_amount)
+    with scoring_context():
+        return coinbase_features(feedback, parm, acc, txn)
 
-    return score, feedback
 
+def covalent_stage(maximum_amount, feedback, erc_rank, txn, balances, portfolio):
+    '''computes the Covalent metrics, returns (features, feedback)'''
+    configs, parm = scoring_inputs('covalent', maximum_amount)
+    with scoring_context():
+        return covalent_features(feedback, parm, erc_rank, txn, balances, portfolio)
 
-def covalent_score(score_range, feedback, model_weights, metric_weigths, params, erc_rank, txn, balances, portfolio):
 
-    params = covalent_params(params, score_range)
+def score_features(validator, rows):
+    '''
+    Description:
+        scores the feature rows of many users of a validator at once: the rows of each config tier
+        go through its scoring kernel in a single pass
 
-    credibility, feedback = covalent_credibility(txn, balances, portfolio, feedback, metric_weigths, params)
-    wealth, feedback = covalent_wealth(txn, balances, feedback, metric_weigths, params, erc_rank)
-    traffic, feedback = covalent_traffic(txn, portfolio, feedback, metric_weigths, params, erc_rank)
-    stamina, feedback = covalent_stamina(txn, balances, portfolio, feedback, metric_weigths, params, erc_rank)
+    Parameters:
+        validator (str): 'plaid', 'coinbase' or 'covalent'
+        rows (list): (maximum amount of the config loan tier, features) of each user
 
-    a = list(model_weights.values())
-    b = [credibility, wealth, traffic, stamina]
+    Returns:
+        scored (list): (score, risk) of each user, in the order of rows
+    '''
+    tiers = {}
+    for i, (maximum_amount, features) in enumerate(rows):
+        tiers.setdefault(maximum_amount, []).append(i)
 
-    head, tail = head_tail_list(score_range)
-    score = head + (tail - head) * (dot_product(a, b))
+    scored = [None] * len(rows)
+    for maximum_amount, index in tiers.items():
+        configs = read_config_file(maximum_amount)
+        if isinstance(configs, str):
+            raise Exception(configs)
 
-    return score, feedback
+        scores, loan_amounts, risk_levels = compiled_kernel(validator, configs).run([rows[i][1] for i in index])
+        for i, score, loan_amount, risk_level in zip(index, scores, loan_amounts, risk_levels):
+            scored[i] = float(score), {'loan_amount': int(loan_amount), 'risk_level': str(risk_level)}
+
+    return scored
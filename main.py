@@ -4,19 +4,25 @@ from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
 from slowapi.errors import RateLimitExceeded
 from slowapi.middleware import SlowAPIMiddleware
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
+from slowapi import _rate_limit_exceeded_handler
 from routers import coinbase, covalent, plaid, kyc
+from config.helper import CONFIG
+from helpers.helper import compile_params
+from support.http_client import close_http_sessions
+from support.executor import close_scoring_executor, run_periodically
+from validator.plaid import PLAID_INCREMENTAL, PLAID_PURGE_INTERVAL, plaid_purge_store
+from support.rate_limit import limiter
 from support.database import engine
 from support import models
+import asyncio
 
 
 models.Base.metadata.create_all(bind=engine)
+compile_params(CONFIG.load()[2])
 app = FastAPI()
 
 
 # throttle control
-limiter = Limiter(key_func=get_remote_address, default_limits=['5/minute'])
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 app.add_middleware(SlowAPIMiddleware)
@@ -32,6 +38,23 @@ app.include_router(plaid.router)
 app.include_router(kyc.router)
 
 
+# purge the local Plaid transactions store on a schedule
+@app.on_event('startup')
+async def startup():
+    app.state.jobs = []
+    if PLAID_INCREMENTAL:
+        app.state.jobs.append(asyncio.ensure_future(run_periodically(PLAID_PURGE_INTERVAL, plaid_purge_store)))
+
+
+# release pooled connections and scoring workers
+@app.on_event('shutdown')
+async def shutdown():
+    for job in app.state.jobs:
+        job.cancel()
+    await close_http_sessions()
+    close_scoring_executor()
+
+
 # error handling
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
@@ -1,11 +1,147 @@
+from support.http_client import http_get
+from config.helper import FrozenDict
 from icecream import ic
-import requests
+import threading
+import time
+
+
+CMC_TTL = 60  # seconds a cached market value is considered fresh
+CMC_MAX_STALE = 600  # seconds a stale market value is still served while it is refreshed
+
+
+class MarketCache:
+    '''
+    In-process cache of CoinMarketCap data with stale-while-revalidate semantics:
+        - a fresh value (younger than ttl) is returned as is
+        - a stale value (younger than ttl + max_stale) is returned immediately,
+          while a background thread fetches a new one
+        - a missing or expired value is fetched synchronously
+    Failed fetches are never cached. Values derived from a cached value are kept along with it,
+    so they are dropped as soon as it is replaced or expires
+    '''
+
+    def __init__(self, ttl, max_stale):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.data = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def get(self, key, fetch):
+        with self.lock:
+            hit = self.data.get(key)
+
+        if hit:
+            timestamp, value, derived = hit
+            age = time.monotonic() - timestamp
+            if age < self.ttl:
+                return value
+            if age < self.ttl + self.max_stale:
+                self.revalidate(key, fetch)
+                return value
+
+        return self.update(key, fetch)
+
+    def update(self, key, fetch):
+        value = fetch()
+        now = time.monotonic()
+        with self.lock:
+            self.data[key] = (now, value, {})
+            # forget values too old to be served
+            expired = [k for k, (t, v, d) in self.data.items() if now - t >= self.ttl + self.max_stale]
+            for k in expired:
+                del self.data[k]
+        return value
+
+    def derive(self, key, fetch, name, build):
+        '''returns build(value) for the value cached under key, built once per value and kept as name'''
+        value = self.get(key, fetch)
+        with self.lock:
+            hit = self.data.get(key)
+            if hit and hit[1] is value and name in hit[2]:
+                return hit[2][name]
+
+        derived = build(value)
+        with self.lock:
+            hit = self.data.get(key)
+            if hit and hit[1] is value:
+                derived = hit[2].setdefault(name, derived)
+        return derived
+
+    def revalidate(self, key, fetch):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def refresh():
+            try:
+                self.update(key, fetch)
+            except Exception as e:
+                ic(str(e))
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+MARKET_CACHE = MarketCache(CMC_TTL, CMC_MAX_STALE)
+
+
+def fetch_currencies(api_key, limit):
+    '''download the top-ranked cryptos from coinmarketcap. Raises an exception on failure'''
+    url = 'https://pro-api.coinmarketcap.com/v1/cryptocurrency/listings/latest'
+
+    headers = {
+        'Accepts': 'application/json',
+        'X-CMC_PRO_API_KEY': api_key,
+    }
+
+    params = {
+        'start': '1',
+        'limit': str(limit),
+        'convert': 'USD'
+    }
+
+    r = http_get(url, headers=headers, params=params).json()
+
+    return dict(
+        [(n['symbol'], (n['cmc_rank'], n['quote']['USD']['price'])) for n in r['data']])
+
+
+def fetch_rate(api_key, coin_in, coin_out):
+    '''download the conversion rate for the coin pair coin_in-coin_out. Raises an exception on failure'''
+    headers = {
+        'Accepts': 'application/json',
+        'X-CMC_PRO_API_KEY': api_key,
+    }
+
+    params = {
+        'amount': 1,
+        'symbol': coin_in,
+        'convert': coin_out
+    }
+
+    # Define url for coinmarketcap API
+    url = 'https://pro-api.coinmarketcap.com/v2/tools/price-conversion'
+
+    # Run GET task to fetch best cryptos from coinmarketcap API
+    r = http_get(url, headers=headers, params=params).json()
+    if not r.get('data'):
+        raise Exception(r['status']['error_message'] or f'No {coin_out} rate for {coin_in}')
+    return r['data'][0]['quote'][coin_out]['price']
 
 
 def coinmarketcap_currencies(api_key, limit):
     '''
     Description:
-        returns a dict of top-ranked cryptos on coinmarketcap
+        returns a dict of top-ranked cryptos on coinmarketcap.
+        The result is cached and shared across requests (see MarketCache)
 
     Parameters:
         api_key (str): bearer token to authenticate into coinmarketcap API
@@ -15,23 +151,8 @@ def coinmarketcap_currencies(api_key, limit):
         top_cryptos (dict): ticker-value pairs for top coinmarketcap cryptos
     '''
     try:
-        url = 'https://pro-api.coinmarketcap.com/v1/cryptocurrency/listings/latest'
-
-        headers = {
-            'Accepts': 'application/json',
-            'X-CMC_PRO_API_KEY': api_key,
-        }
-
-        params = {
-            'start': '1',
-            'limit': str(limit),
-            'convert': 'USD'
-        }
-
-        r = requests.get(url, headers=headers, params=params).json()
-
-        top_currencies = dict(
-            [(n['symbol'], (n['cmc_rank'], n['quote']['USD']['price'])) for n in r['data']])
+        top_currencies = MARKET_CACHE.get(
+            ('listings', api_key, limit), lambda: fetch_currencies(api_key, limit))
 
     except Exception as e:
         top_currencies = str(e)
@@ -41,8 +162,10 @@ def coinmarketcap_currencies(api_key, limit):
 
 def coinmarektcap_top_erc(api_key, limit, erc_tokens):
     '''
-    Description: 
-        returns ERC tokens ranked highest on Coinmarketcap
+    Description:
+        returns ERC tokens ranked highest on Coinmarketcap.
+        The rank lookup is built once per Coinmarketcap listing, cached along with it (see MarketCache),
+        and shared read-only by all requests
 
     Parameters:
         api_key (str): bearer token to authenticate into coinmarketcap API
@@ -52,13 +175,19 @@ def coinmarektcap_top_erc(api_key, limit, erc_tokens):
     Returns:
         top_erc_tokens (dict): top ERC tokens based on Coinmarketcap rankings
     '''
-    try:
-        # retrieve top cryptos from coinmarketcap
-        top_currencies = coinmarketcap_currencies(api_key, limit)
+    def build(top_currencies):
         # keep only ERC tokens
         top_erc_tokens = {k: v[0]
-                          for (k, v) in top_currencies.items() if k in erc_tokens}
+                          for (k, v) in top_currencies.items() if k in erc_set}
         top_erc_tokens['WETH'] = top_erc_tokens['ETH']*1.25
+        return FrozenDict(top_erc_tokens)
+
+    try:
+        # retrieve top cryptos from coinmarketcap, and their ERC ranks along with them
+        erc_set = set(erc_tokens)
+        top_erc_tokens = MARKET_CACHE.derive(
+            ('listings', api_key, limit), lambda: fetch_currencies(api_key, limit),
+            ('top_erc', tuple(erc_tokens)), build)
 
     except Exception as e:
         top_erc_tokens = str(e)
@@ -70,7 +199,8 @@ def coinmarektcap_top_erc(api_key, limit, erc_tokens):
 def coinmarketcap_rate(api_key, coin_in, coin_out):
     '''
     Description:
-        returns a conversion rate for the coin pair coin_in-coin_out
+        returns a conversion rate for the coin pair coin_in-coin_out.
+        The result is cached and shared across requests (see MarketCache)
 
     Parameters:
         api_key (str): bearer token to authenticate into coinmarketcap API
@@ -81,26 +211,39 @@ def coinmarketcap_rate(api_key, coin_in, coin_out):
         rate (float): rate you ought to multiply your base coin by, to obtain its coin_out equilavent
     '''
     try:
-        headers = {
-            'Accepts': 'application/json',
-            'X-CMC_PRO_API_KEY': api_key,
-        }
-
-        params = {
-            'amount': 1,
-            'symbol': coin_in,
-            'convert': coin_out
-        }
-
-        # Define url for coinmarketcap API
-        url = 'https://pro-api.coinmarketcap.com/v2/tools/price-conversion'
-
-        # Run GET task to fetch best cryptos from coinmarketcap API
-        r = requests.get(url, headers=headers, params=params).json()
-        rate = r['data'][0]['quote'][coin_out]['price']
+        rate = MARKET_CACHE.get(
+            ('rate', api_key, coin_in, coin_out), lambda: fetch_rate(api_key, coin_in, coin_out))
 
     except Exception as e:
         ic(str(e))
         rate = 0
 
     return rate
+
+
+def coinmarketcap_usd_rates(api_key, symbols):
+    '''
+    Description:
+        returns the USD value of one unit of each currency, to convert amounts to USD locally.
+        The rates are cached and shared across requests (see MarketCache)
+
+    Parameters:
+        api_key (str): bearer token to authenticate into coinmarketcap API
+        symbols (list): ticker symbols of fiat or crypto currencies
+
+    Returns:
+        rates (dict): ticker-rate pairs
+    '''
+    try:
+        rates = {}
+        for symbol in symbols:
+            if symbol == 'USD':
+                rates[symbol] = 1
+            else:
+                rates[symbol] = MARKET_CACHE.get(
+                    ('rate', api_key, symbol, 'USD'), lambda symbol=symbol: fetch_rate(api_key, symbol, 'USD'))
+
+    except Exception as e:
+        rates = str(e)
+
+    return rates
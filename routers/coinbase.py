@@ -7,10 +7,15 @@ from market.coinmarketcap import *
 from validator.coinbase import *
 
 from fastapi import APIRouter, Depends, Request, status
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.orm import Session
-from support.database import get_db
-from support.schemas import Coinbase_Item
+from support.database import get_db, SessionLocal
+from support.schemas import Coinbase_Item, Coinbase_Batch
+from support.singleflight import SINGLE_FLIGHT
+from support.session_store import SESSION_STORE
+from support.executor import offload, offload_io
+from support.batch import stream_batch, NDJSON
+from support.rate_limit import charge_items
 from support import crud
 
 
@@ -30,120 +35,184 @@ async def credit_score_coinbase(request: Request, item: Coinbase_Item, db: Sessi
     - **coinbase_refresh_token [string]**: coinbase refresh token
     - **coinmarketcap_key [string]**: coinmarketcap key
     - **loan_request [integer]**: loan request amount
+    - **session_handle [string | Optional]**: session handle returned by /kyc, to reuse the data it fetched
 
     Output:
     - **[object]**: coinbase credit score
     '''
 
+    print(f'\033[35;1m Receiving request from: {request.client.host}\033[0m')
+    r = await coinbase_credit_score(item, db)
+    if r['status'] != 'success':
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=r)
+    return r
+
+
+@router.post('/coinbase/batch', status_code=status.HTTP_200_OK, summary='Coinbase credit score of many accounts')
+async def credit_score_coinbase_batch(request: Request, batch: Coinbase_Batch):
+    '''
+    Calculates the credit score of many accounts based on Coinbase data.
+    Requests are processed concurrently, and each score is streamed back as soon as it is ready.
+    Each request of the batch counts against the batch rate limit, shared by the batch endpoints of all validators.
+
+    Input:
+    - **items [array]**: up to 1000 requests, with the same body as /credit_score/coinbase
+
+    Output:
+    - **[ndjson]**: one coinbase credit score per line, in completion order, along with the index of its request
+    '''
+
+    print(f'\033[35;1m Receiving batch of {len(batch.items)} requests from: {request.client.host}\033[0m')
+    charge_items(request, len(batch.items))
+    stream = stream_batch(batch.items, 'coinbase', coinbase_prepare, coinbase_respond, coinbase_failed, SessionLocal)
+    return StreamingResponse(stream, media_type=NDJSON)
+
+
+async def coinbase_credit_score(item, db):
+    '''
+    Description:
+        computes the Coinbase credit score of a single request
+
+    Parameters:
+        item (Coinbase_Item): request body
+        db (sqlalchemy.orm.Session): database session
+
+    Returns:
+        r (dict): response body, its status is 'success' unless the score could not be computed
+    '''
     try:
-        print(f'\033[35;1m Receiving request from: {request.client.host}\033[0m')
-
-        # configs
-        print(f'\033[36m Accessing settings ...\033[0m')
-        configs = read_config_file(item.loan_request)
-        if isinstance(configs, str):
-            raise Exception(configs)
-
-        loan_range = configs['loan_range']
-        score_range = configs['score_range']
-        qualitative_range = configs['qualitative_range']
-
-        thresholds = configs['minimum_requirements']['coinbase']['thresholds']
-        parm = configs['minimum_requirements']['coinbase']['params']
-
-        models, metrics = read_models_and_metrics(
-            configs['minimum_requirements']['coinbase']['scores']['models'])
-
-        messages = configs['minimum_requirements']['coinbase']['messages']
-        feedback = create_feedback(models)
-
-        # coinmarketcap
-        print(f'\033[36m Connecting with Coinmarketcap ...\033[0m')
-        top_marketcap = coinmarketcap_currencies(
-            item.coinmarketcap_key, thresholds['coinmarketcap_currencies'])
-        if isinstance(top_marketcap, str):
-            raise Exception(f'Unable to fetch coinmarketcap data: {top_marketcap}')
-
-        # coinbase client connection
-        print(f'\033[36m Connecting with validator ...\033[0m')
-        client = coinbase_client(
-            item.coinbase_access_token, item.coinbase_refresh_token)
-
-        # coinbase supported currencies
-        print(f'\033[36m Checking supported currencies 1/2 ...\033[0m')
-        currencies = coinbase_currencies(client)
-        if 'error' in currencies:
-            error = currencies['error']['message']
-            raise Exception(f'Unable to fetch coinbase data: {error}')
-
-        # add top coinmarketcap currencies and coinbase currencies
-        print(f'\033[36m Checking supported currencies 2/2 ...\033[0m')
-        top_currencies = aggregate_currencies(
-            top_marketcap, currencies, thresholds['odd_fiats'])
-
-        # set native currency to USD
-        print(f'\033[36m Setting native currency 1/2 ...\033[0m')
-        native = coinbase_native_currency(client)
-        if 'error' in native:
-            error = native['error']['message']
-            raise Exception(f'Unable to fetch coinbase native currency: {error}')
-        if native != 'USD':
-            set_native = coinbase_set_native_currency(client, 'USD')
-
-        # data fetching
-        print(f'\033[36m Reading data ...\033[0m')
-        accounts, transactions = coinbase_accounts_and_transactions(
-            client, top_currencies, thresholds['transaction_types'])
-        if isinstance(accounts, str):
-            raise Exception(f'Unable to fetch accounts data: {accounts}')
-        if isinstance(transactions, str):
-            raise Exception(f'Unable to fetch transactions data: {transactions}')
-
-        # reset native currency
-        print(f'\033[36m Setting native currency 2/2 ...\033[0m')
-        set_native = coinbase_set_native_currency(client, native)
-
-        # compute score and feedback
-        print(f'\033[36m Calculating score ...\033[0m')
-        score, feedback = coinbase_score(
-            score_range, feedback, models, metrics, parm, accounts, transactions)
-
-        # compute risk
-        print(f'\033[36m Calculating risk ...\033[0m')
-        risk = calc_risk(score, score_range, loan_range)
-
-        # keep feedback data
-        print(f'\033[36m Saving parameters ...\033[0m')
-        data = keep_dict(score, feedback, risk, item.loan_request)
-        crud.add_event(db, 'coinbase', data)
-
-        # update feedback
-        print(f'\033[36m Preparing feedback 1/2 ...\033[0m')
-        message = qualitative_feedback_coinbase(
-            messages, score, feedback, score_range, loan_range, qualitative_range, item.coinmarketcap_key)
-
-        print(f'\033[36m Preparing feedback 2/2 ...\033[0m')
-        feedback = interpret_score_coinbase(
-            score, feedback, score_range, loan_range, qualitative_range)
-
-        # return success
-        print(f'\033[35;1m Credit score has successfully been calculated.\033[0m')
-        return {
-            'endpoint': '/credit_score/coinbase',
-            'status': 'success',
-            'score': int(score),
-            'risk': risk,
-            'message': message,
-            'feedback': feedback
-        }
+        maximum_amount, features, state = await coinbase_prepare(item, db)
+        score, risk = score_features('coinbase', [(maximum_amount, features)])[0]
+        return await coinbase_respond(item, db, score, risk, *state)
 
     except Exception as e:
-        print(f'\033[35;1m Unable to complete credit scoring calculation.\033[0m')
-        return JSONResponse(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            content={
-                'endpoint': '/credit_score/coinbase',
-                'status': 'error',
-                'message': str(e),
-            }
-        )
+        return coinbase_failed(e)
+
+
+async def coinbase_prepare(item, db):
+    '''
+    Description:
+        fetches the Coinbase data of a request and computes its metrics, up to the row of features to score
+
+    Parameters:
+        item (Coinbase_Item): request body
+        db (sqlalchemy.orm.Session): database session
+
+    Returns:
+        maximum_amount (int): maximum amount of the config loan tier
+        features (list): metric scores of the user
+        state (tuple): configs and feedback, to pass on to coinbase_respond()
+    '''
+    # configs
+    print(f'\033[36m Accessing settings ...\033[0m')
+    configs = read_config_file(item.loan_request)
+    if isinstance(configs, str):
+        raise Exception(configs)
+
+    thresholds = configs['minimum_requirements']['coinbase']['thresholds']
+
+    models, metrics = read_models_and_metrics(
+        configs['minimum_requirements']['coinbase']['scores']['models'])
+
+    feedback = create_feedback(models)
+
+    # coinmarketcap
+    print(f'\033[36m Connecting with Coinmarketcap ...\033[0m')
+    top_marketcap = await offload_io(
+        coinmarketcap_currencies, item.coinmarketcap_key, thresholds['coinmarketcap_currencies'])
+    if isinstance(top_marketcap, str):
+        raise Exception(f'Unable to fetch coinmarketcap data: {top_marketcap}')
+
+    # coinbase client connection
+    print(f'\033[36m Connecting with validator ...\033[0m')
+    client = await offload_io(
+        coinbase_client, item.coinbase_access_token, item.coinbase_refresh_token)
+
+    # coinbase supported currencies
+    print(f'\033[36m Checking supported currencies 1/2 ...\033[0m')
+    currencies = await offload_io(coinbase_currencies, client)
+    if 'error' in currencies:
+        error = currencies['error']['message']
+        raise Exception(f'Unable to fetch coinbase data: {error}')
+
+    # add top coinmarketcap currencies and coinbase currencies
+    print(f'\033[36m Checking supported currencies 2/2 ...\033[0m')
+    top_currencies = aggregate_currencies(
+        top_marketcap, currencies, thresholds['odd_fiats'])
+
+    # data fetching
+    print(f'\033[36m Reading data ...\033[0m')
+    fetch = ('coinbase', item.coinbase_access_token, tuple(sorted(top_currencies)),
+             tuple(thresholds['transaction_types']))
+    dataset = SESSION_STORE.get(item.session_handle, fetch)
+    if dataset is None:
+        dataset = await SINGLE_FLIGHT.run(
+            fetch, coinbase_accounts_and_transactions, client, top_currencies, thresholds['transaction_types'])
+    accounts, transactions = dataset
+    if isinstance(accounts, str):
+        raise Exception(f'Unable to fetch accounts data: {accounts}')
+    if isinstance(transactions, str):
+        raise Exception(f'Unable to fetch transactions data: {transactions}')
+
+    # convert native currency to USD
+    print(f'\033[36m Converting to USD ...\033[0m')
+    rates = await offload_io(
+        coinmarketcap_usd_rates, item.coinmarketcap_key, coinbase_native_currencies(accounts, transactions))
+    if isinstance(rates, str):
+        raise Exception(f'Unable to fetch coinmarketcap rates: {rates}')
+    accounts, transactions = coinbase_to_usd(accounts, transactions, rates)
+
+    # compute metrics
+    print(f'\033[36m Calculating metrics ...\033[0m')
+    features, feedback = await SINGLE_FLIGHT.run(
+        ('coinbase_features', item.coinbase_access_token, configs['maximum_amount']),
+        offload, coinbase_stage, configs['maximum_amount'], feedback, accounts, transactions)
+
+    return configs['maximum_amount'], features, (configs, feedback)
+
+
+async def coinbase_respond(item, db, score, risk, configs, feedback):
+    '''
+    Description:
+        saves a scored Coinbase request and builds its response
+
+    Parameters:
+        item (Coinbase_Item): request body
+        db (sqlalchemy.orm.Session): database session
+        score (float): credit score
+        risk (dict): loan amount and risk level of the score
+        configs, feedback: state returned by coinbase_prepare()
+
+    Returns:
+        r (dict): response body
+    '''
+    # keep feedback data
+    print(f'\033[36m Saving parameters ...\033[0m')
+    data = keep_dict(score, feedback, risk, item.loan_request)
+    await offload_io(crud.add_event, db, 'coinbase', data)
+
+    # update feedback
+    print(f'\033[36m Preparing feedback ...\033[0m')
+    message, feedback = await offload(
+        feedback_stage, 'coinbase', configs['maximum_amount'], score, feedback, item.coinmarketcap_key)
+
+    # return success
+    print(f'\033[35;1m Credit score has successfully been calculated.\033[0m')
+    return {
+        'endpoint': '/credit_score/coinbase',
+        'status': 'success',
+        'score': int(score),
+        'risk': risk,
+        'message': message,
+        'feedback': feedback
+    }
+
+
+def coinbase_failed(e):
+    '''returns the response body of a Coinbase request that could not be scored'''
+    print(f'\033[35;1m Unable to complete credit scoring calculation.\033[0m')
+    return {
+        'endpoint': '/credit_score/coinbase',
+        'status': 'error',
+        'message': str(e),
+    }
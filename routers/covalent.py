@@ -7,10 +7,15 @@ from market.coinmarketcap import *
 from validator.covalent import *
 
 from fastapi import APIRouter, Depends, Request, status
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.orm import Session
-from support.database import get_db
-from support.schemas import Covalent_Item
+from support.database import get_db, SessionLocal
+from support.schemas import Covalent_Item, Covalent_Batch
+from support.singleflight import SINGLE_FLIGHT
+from support.session_store import SESSION_STORE
+from support.executor import offload, offload_io
+from support.batch import stream_batch, NDJSON
+from support.rate_limit import charge_items
 from support import crud
 
 
@@ -30,101 +35,166 @@ async def credit_score_covalent(request: Request, item: Covalent_Item, db: Sessi
     - **covalent_key [string]**: covalent key
     - **coinmarketcap_key [string]**: coinmarketcap key
     - **loan_request [integer]**: loan request amount
+    - **session_handle [string | Optional]**: session handle returned by /kyc, to reuse the data it fetched
 
     Output:
     - **[object]**: covalent credit score
     '''
 
+    print(f'\033[35;1m Receiving request from: {request.client.host}\033[0m')
+    r = await covalent_credit_score(item, db)
+    if r['status'] != 'success':
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=r)
+    return r
+
+
+@router.post('/covalent/batch', status_code=status.HTTP_200_OK, summary='Covalent credit score of many wallets')
+async def credit_score_covalent_batch(request: Request, batch: Covalent_Batch):
+    '''
+    Calculates the credit score of many wallets based on Covalent data.
+    Requests are processed concurrently, and each score is streamed back as soon as it is ready.
+    Each request of the batch counts against the batch rate limit, shared by the batch endpoints of all validators.
+
+    Input:
+    - **items [array]**: up to 1000 requests, with the same body as /credit_score/covalent
+
+    Output:
+    - **[ndjson]**: one covalent credit score per line, in completion order, along with the index of its request
+    '''
+
+    print(f'\033[35;1m Receiving batch of {len(batch.items)} requests from: {request.client.host}\033[0m')
+    charge_items(request, len(batch.items))
+    stream = stream_batch(batch.items, 'covalent', covalent_prepare, covalent_respond, covalent_failed, SessionLocal)
+    return StreamingResponse(stream, media_type=NDJSON)
+
+
+async def covalent_credit_score(item, db):
+    '''
+    Description:
+        computes the Covalent credit score of a single request
+
+    Parameters:
+        item (Covalent_Item): request body
+        db (sqlalchemy.orm.Session): database session
+
+    Returns:
+        r (dict): response body, its status is 'success' unless the score could not be computed
+    '''
     try:
-        print(f'\033[35;1m Receiving request from: {request.client.host}\033[0m')
-
-        # configs
-        print(f'\033[36m Accessing settings ...\033[0m')
-        configs = read_config_file(item.loan_request)
-        if isinstance(configs, str):
-            raise Exception(configs)
-
-        loan_range = configs['loan_range']
-        score_range = configs['score_range']
-        qualitative_range = configs['qualitative_range']
-
-        thresholds = configs['minimum_requirements']['covalent']['thresholds']
-        parm = configs['minimum_requirements']['covalent']['params']
-
-        models, metrics = read_models_and_metrics(
-            configs['minimum_requirements']['covalent']['scores']['models'])
-
-        messages = configs['minimum_requirements']['covalent']['messages']
-        feedback = create_feedback(models)
-        feedback['fetch'] = {}
-
-       # data fetching
-        print(f'\033[36m Reading data ...\033[0m')
-        txn = covalent_get_transactions(
-            '1', item.eth_address, item.covalent_key, False, 500, 0)
-        if isinstance(txn, dict) and 'found_error' in txn and txn['found_error']:
-            error = txn['error_message']
-            raise Exception(f'Unable to fetch transactions data: {error}')
-
-        balances = covalent_get_balances_or_portfolio(
-            '1', item.eth_address, 'balances_v2', item.
-            covalent_key)
-        if isinstance(balances, dict) and 'found_error' in balances and balances['found_error']:
-            error = balances['error_message']
-            raise Exception(f'Unable to fetch balances data: {error}')
-
-        portfolio = covalent_get_balances_or_portfolio(
-            '1', item.eth_address, 'portfolio_v2', item.covalent_key)
-        if isinstance(portfolio, dict) and 'found_error' in portfolio and portfolio['found_error']:
-            error = portfolio['error_message']
-            raise Exception(f'Unable to fetch portfolio data: {error}')
-
-        # coinmarketcap
-        print(f'\033[36m Connecting with Coinmarketcap ...\033[0m')
-        erc_rank = coinmarektcap_top_erc(
-            item.coinmarketcap_key, thresholds['coinmarketcap_currencies'], thresholds['erc_tokens'])
-
-        # compute score and feedback
-        print(f'\033[36m Calculating score ...\033[0m')
-        score, feedback = covalent_score(
-            score_range, feedback, models, metrics, parm, erc_rank, txn, balances, portfolio)
-
-        # compute risk
-        print(f'\033[36m Calculating risk ...\033[0m')
-        risk = calc_risk(score, score_range, loan_range)
-
-        # keep feedback data
-        print(f'\033[36m Saving parameters ...\033[0m')
-        data = keep_dict(score, feedback, risk, item.loan_request)
-        crud.add_event(db, 'covalent', data)
-
-        # update feedback
-        print(f'\033[36m Preparing feedback 1/2 ...\033[0m')
-        message = qualitative_feedback_covalent(
-            messages, score, feedback, score_range, loan_range, qualitative_range, item.coinmarketcap_key)
-
-        print(f'\033[36m Preparing feedback 2/2 ...\033[0m')
-        feedback = interpret_score_covalent(
-            score, feedback, score_range, loan_range, qualitative_range)
-
-        # return success
-        print(f'\033[35;1m Credit score has successfully been calculated.\033[0m')
-        return {
-            'endpoint': '/credit_score/covalent',
-            'status': 'success',
-            'score': int(score),
-            'risk': risk,
-            'message': message,
-            'feedback': feedback
-        }
+        maximum_amount, features, state = await covalent_prepare(item, db)
+        score, risk = score_features('covalent', [(maximum_amount, features)])[0]
+        return await covalent_respond(item, db, score, risk, *state)
 
     except Exception as e:
-        print(f'\033[35;1m Unable to complete credit scoring calculation.\033[0m')
-        return JSONResponse(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            content={
-                'endpoint': '/credit_score/covalent',
-                'status': 'error',
-                'message': str(e),
-            }
-        )
+        return covalent_failed(e)
+
+
+async def covalent_prepare(item, db):
+    '''
+    Description:
+        fetches the Covalent data of a request and computes its metrics, up to the row of features to score
+
+    Parameters:
+        item (Covalent_Item): request body
+        db (sqlalchemy.orm.Session): database session
+
+    Returns:
+        maximum_amount (int): maximum amount of the config loan tier
+        features (list): metric scores of the user
+        state (tuple): configs and feedback, to pass on to covalent_respond()
+    '''
+    # configs
+    print(f'\033[36m Accessing settings ...\033[0m')
+    configs = read_config_file(item.loan_request)
+    if isinstance(configs, str):
+        raise Exception(configs)
+
+    thresholds = configs['minimum_requirements']['covalent']['thresholds']
+
+    models, metrics = read_models_and_metrics(
+        configs['minimum_requirements']['covalent']['scores']['models'])
+
+    feedback = create_feedback(models)
+    feedback['fetch'] = {}
+
+    # data fetching
+    print(f'\033[36m Reading data ...\033[0m')
+    fetch = ('covalent', item.eth_address, item.covalent_key, thresholds['transactions_pages'])
+    dataset = SESSION_STORE.get(item.session_handle, fetch)
+    if dataset is None:
+        dataset = await SINGLE_FLIGHT.run(
+            fetch, covalent_get_all, '1', item.eth_address, item.covalent_key, False, 500, 0,
+            thresholds['transactions_pages'])
+    txn, balances, portfolio = dataset
+    if isinstance(txn, dict) and 'found_error' in txn and txn['found_error']:
+        error = txn['error_message']
+        raise Exception(f'Unable to fetch transactions data: {error}')
+
+    if isinstance(balances, dict) and 'found_error' in balances and balances['found_error']:
+        error = balances['error_message']
+        raise Exception(f'Unable to fetch balances data: {error}')
+
+    if isinstance(portfolio, dict) and 'found_error' in portfolio and portfolio['found_error']:
+        error = portfolio['error_message']
+        raise Exception(f'Unable to fetch portfolio data: {error}')
+
+    # coinmarketcap
+    print(f'\033[36m Connecting with Coinmarketcap ...\033[0m')
+    erc_rank = await offload_io(
+        coinmarektcap_top_erc, item.coinmarketcap_key, thresholds['coinmarketcap_currencies'],
+        thresholds['erc_tokens'])
+
+    # compute metrics
+    print(f'\033[36m Calculating metrics ...\033[0m')
+    features, feedback = await SINGLE_FLIGHT.run(
+        ('covalent_features', item.eth_address, item.covalent_key, configs['maximum_amount']),
+        offload, covalent_stage, configs['maximum_amount'], feedback, erc_rank, txn, balances, portfolio)
+
+    return configs['maximum_amount'], features, (configs, feedback)
+
+
+async def covalent_respond(item, db, score, risk, configs, feedback):
+    '''
+    Description:
+        saves a scored Covalent request and builds its response
+
+    Parameters:
+        item (Covalent_Item): request body
+        db (sqlalchemy.orm.Session): database session
+        score (float): credit score
+        risk (dict): loan amount and risk level of the score
+        configs, feedback: state returned by covalent_prepare()
+
+    Returns:
+        r (dict): response body
+    '''
+    # keep feedback data
+    print(f'\033[36m Saving parameters ...\033[0m')
+    data = keep_dict(score, feedback, risk, item.loan_request)
+    await offload_io(crud.add_event, db, 'covalent', data)
+
+    # update feedback
+    print(f'\033[36m Preparing feedback ...\033[0m')
+    message, feedback = await offload(
+        feedback_stage, 'covalent', configs['maximum_amount'], score, feedback, item.coinmarketcap_key)
+
+    # return success
+    print(f'\033[35;1m Credit score has successfully been calculated.\033[0m')
+    return {
+        'endpoint': '/credit_score/covalent',
+        'status': 'success',
+        'score': int(score),
+        'risk': risk,
+        'message': message,
+        'feedback': feedback
+    }
+
+
+def covalent_failed(e):
+    '''returns the response body of a Covalent request that could not be scored'''
+    print(f'\033[35;1m Unable to complete credit scoring calculation.\033[0m')
+    return {
+        'endpoint': '/credit_score/covalent',
+        'status': 'error',
+        'message': str(e),
+    }
@@ -11,6 +11,9 @@ from helpers.metrics_covalent import *
 from fastapi import APIRouter, Request, status
 from fastapi.responses import JSONResponse
 from support.schemas import KYC_Item
+from support.singleflight import SINGLE_FLIGHT
+from support.session_store import SESSION_STORE
+from support.executor import offload_io
 
 from dotenv import load_dotenv
 from os import getenv
@@ -35,6 +38,8 @@ async def credit_score_kyc(request: Request, item: KYC_Item):
     - **coinbase_access_token [string | Optional]**: coinbase access token
     - **coinbase_refresh_token [string | Optional]**: coinbase refresh token
     - **coinmarketcap_key [string | Optional]**: coinmarketcap key
+    - **loan_request [integer | Optional]**: loan request amount the user will be scored for
+    - **keep_session [boolean | Optional]**: return a session handle, to reuse the fetched data in the credit score request
     - **eth_address [string | Optional]**: eth address
     - **covalent_key [string | Optional]**: covalentkey
 
@@ -47,7 +52,7 @@ async def credit_score_kyc(request: Request, item: KYC_Item):
 
         # configs
         print(f'\033[36m Accessing settings ...\033[0m')
-        configs = read_config_file(0)
+        configs = read_config_file(item.loan_request or 0)
         if isinstance(configs, str):
             raise Exception(configs)
 
@@ -57,20 +62,20 @@ async def credit_score_kyc(request: Request, item: KYC_Item):
         if item.chosen_validator == 'coinbase':
             # coinmarketcap
             print(f'\033[36m Connecting with Coinmarketcap ...\033[0m')
-            top_marketcap = coinmarketcap_currencies(
-                item.coinmarketcap_key, thresholds['coinmarketcap_currencies'])
+            top_marketcap = await offload_io(
+                coinmarketcap_currencies, item.coinmarketcap_key, thresholds['coinmarketcap_currencies'])
 
             if isinstance(top_marketcap, str):
                 raise Exception(f'Unable to fetch coinmarketcap data: {top_marketcap}')
 
             # coinbase client connection
             print(f'\033[36m Connecting with validator ...\033[0m')
-            client = coinbase_client(
-                item.coinbase_access_token, item.coinbase_refresh_token)
+            client = await offload_io(
+                coinbase_client, item.coinbase_access_token, item.coinbase_refresh_token)
 
             # coinbase supported currencies
             print(f'\033[36m Checking supported currencies 1/2 ...\033[0m')
-            currencies = coinbase_currencies(client)
+            currencies = await offload_io(coinbase_currencies, client)
 
             if 'error' in currencies:
                 error = currencies['error']['message']
@@ -83,8 +88,11 @@ async def credit_score_kyc(request: Request, item: KYC_Item):
 
             # data fetching
             print(f'\033[36m Reading data ...\033[0m')
-            accounts, transactions = coinbase_accounts_and_transactions(
-                client, top_currencies, thresholds['transaction_types'])
+            fetch = ('coinbase', item.coinbase_access_token, tuple(sorted(top_currencies)),
+                     tuple(thresholds['transaction_types']))
+            dataset = await SINGLE_FLIGHT.run(
+                fetch, coinbase_accounts_and_transactions, client, top_currencies, thresholds['transaction_types'])
+            accounts, transactions = dataset
 
             if isinstance(accounts, str):
                 raise Exception(f'Unable to fetch accounts data: {accounts}')
@@ -99,23 +107,20 @@ async def credit_score_kyc(request: Request, item: KYC_Item):
         elif item.chosen_validator == 'covalent':
             # data fetching
             print(f'\033[36m Reading data ...\033[0m')
-            transactions = covalent_get_transactions(
-                '1', item.eth_address, item.covalent_key, False, 500, 0)
+            fetch = ('covalent', item.eth_address, item.covalent_key, thresholds['transactions_pages'])
+            dataset = await SINGLE_FLIGHT.run(
+                fetch, covalent_get_all, '1', item.eth_address, item.covalent_key, False, 500, 0,
+                thresholds['transactions_pages'])
+            transactions, balances, portfolio = dataset
 
             if isinstance(transactions, dict) and 'found_error' in transactions and transactions['found_error']:
                 error = transactions['error_message']
                 raise Exception(f'Unable to fetch transactions data: {error}')
 
-            balances = covalent_get_balances_or_portfolio(
-                '1', item.eth_address, 'balances_v2', item.covalent_key)
-
             if isinstance(balances, dict) and 'found_error' in balances and balances['found_error']:
                 error = balances['error_message']
                 raise Exception(f'Unable to fetch balances data: {error}')
 
-            portfolio = covalent_get_balances_or_portfolio(
-                '1', item.eth_address, 'portfolio_v2', item.covalent_key)
-
             if isinstance(portfolio, dict) and 'found_error' in portfolio and portfolio['found_error']:
                 error = portfolio['error_message']
                 raise Exception(f'Unable to fetch portfolio data: {error}')
@@ -127,12 +132,14 @@ async def credit_score_kyc(request: Request, item: KYC_Item):
         elif item.chosen_validator == 'plaid':
             # plaid client connection
             print(f'\033[36m Connecting with validator ...\033[0m')
-            client = plaid_client(
-                getenv('PLAID_ENV'), item.plaid_client_id, item.plaid_client_secret)
+            client = await offload_io(
+                plaid_client, getenv('PLAID_ENV'), item.plaid_client_id, item.plaid_client_secret)
 
             # data fetching
             print(f'\033[36m Reading data ...\033[0m')
-            dataset = plaid_transactions(item.plaid_access_token, client, thresholds['transactions_period'])
+            fetch = ('plaid', item.plaid_access_token, thresholds['transactions_pagination'])
+            dataset = await SINGLE_FLIGHT.run(
+                fetch, plaid_transactions, item.plaid_access_token, client, thresholds['transactions_pagination'])
 
             if isinstance(dataset, dict) and 'error_code' in dataset:
                 error = dataset['message']
@@ -142,13 +149,19 @@ async def credit_score_kyc(request: Request, item: KYC_Item):
             print(f'\033[36m Verifying KYC ...\033[0m')
             kyc_verified = plaid_kyc(dataset['accounts'], dataset['transactions'])
 
+        # keep fetched data for the credit score request
+        r = {}
+        if item.keep_session:
+            r['session_handle'] = SESSION_STORE.put(fetch, dataset)
+
         # return success
         print(f'\033[35;1m Account has successfully been KYC verified.\033[0m')
         return {
             'endpoint': '/kyc',
             'status': 'success',
             'validator': item.chosen_validator,
-            'kyc_verified': kyc_verified
+            'kyc_verified': kyc_verified,
+            **r
         }
 
     except Exception as e:
@@ -7,10 +7,15 @@ from market.coinmarketcap import *
 from validator.plaid import *
 
 from fastapi import APIRouter, Depends, Request, status
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.orm import Session
-from support.database import get_db
-from support.schemas import Plaid_Item
+from support.database import get_db, SessionLocal
+from support.schemas import Plaid_Item, Plaid_Batch
+from support.singleflight import SINGLE_FLIGHT
+from support.session_store import SESSION_STORE
+from support.executor import offload, offload_io
+from support.batch import stream_batch, NDJSON
+from support.rate_limit import charge_items
 from support import crud
 
 from dotenv import load_dotenv
@@ -35,117 +40,182 @@ async def credit_score_plaid(request: Request, item: Plaid_Item, db: Session = D
     - **plaid_client_secret [string]**: plaid client secret
     - **coinmarketcap_key [string]**: coinmarketcap key
     - **loan_request [integer]**: loan request amount
+    - **session_handle [string | Optional]**: session handle returned by /kyc, to reuse the data it fetched
 
     Output:
     - **[object]**: plaid credit score
     '''
 
+    print(f'\033[35;1m Receiving request from: {request.client.host}\033[0m')
+    r = await plaid_credit_score(item, db)
+    if r['status'] != 'success':
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=r)
+    return r
+
+
+@router.post('/plaid/batch', status_code=status.HTTP_200_OK, summary='Plaid credit score of many users')
+async def credit_score_plaid_batch(request: Request, batch: Plaid_Batch):
+    '''
+    Calculates the credit score of many users based on Plaid data.
+    Requests are processed concurrently, and each score is streamed back as soon as it is ready.
+    Each request of the batch counts against the batch rate limit, shared by the batch endpoints of all validators.
+
+    Input:
+    - **items [array]**: up to 1000 requests, with the same body as /credit_score/plaid
+
+    Output:
+    - **[ndjson]**: one plaid credit score per line, in completion order, along with the index of its request
+    '''
+
+    print(f'\033[35;1m Receiving batch of {len(batch.items)} requests from: {request.client.host}\033[0m')
+    charge_items(request, len(batch.items))
+    stream = stream_batch(batch.items, 'plaid', plaid_prepare, plaid_respond, plaid_failed, SessionLocal)
+    return StreamingResponse(stream, media_type=NDJSON)
+
+
+async def plaid_credit_score(item, db):
+    '''
+    Description:
+        computes the Plaid credit score of a single request
+
+    Parameters:
+        item (Plaid_Item): request body
+        db (sqlalchemy.orm.Session): database session
+
+    Returns:
+        r (dict): response body, its status is 'success' unless the score could not be computed
+    '''
     try:
-        print(f'\033[35;1m Receiving request from: {request.client.host}\033[0m')
-
-        # configs
-        print(f'\033[36m Accessing settings ...\033[0m')
-        configs = read_config_file(item.loan_request)
-        if isinstance(configs, str):
-            raise Exception(configs)
-
-        loan_range = configs['loan_range']
-        score_range = configs['score_range']
-        qualitative_range = configs['qualitative_range']
-
-        thresholds = configs['minimum_requirements']['plaid']['thresholds']
-        period = thresholds['transactions_period']
-        pagination = thresholds['transactions_pagination']
-        parm = configs['minimum_requirements']['plaid']['params']
-
-        models, metrics = read_models_and_metrics(
-            configs['minimum_requirements']['plaid']['scores']['models'])
-
-        messages = configs['minimum_requirements']['plaid']['messages']
-        feedback = create_feedback(models)
-        feedback['fetch'] = {}
-
-        # plaid client connection
-        print(f'\033[36m Connecting with validator ...\033[0m')
-        client = plaid_client(
-            getenv('PLAID_ENV'), item.plaid_client_id, item.plaid_client_secret)
-
-        # data fetching
-        print(f'\033[36m Reading data ...\033[0m')
-        dataset = plaid_transactions(item.plaid_access_token, client, pagination)
-        if isinstance(dataset, dict) and 'error_code' in dataset:
-            error = dataset['message']
-            raise Exception(f'Unable to fetch transactions data: {error}')
-
-        bank_name = plaid_bank_name(client, dataset['item']['institution_id'])
-        feedback['diversity']['bank_name'] = bank_name
-
-        # data formatting
-        print(f'\033[36m Formatting data ...\033[0m')
-        transactions = dataset['transactions']
-        accounts = remove_key_dupes(dataset['accounts'], 'account_id')
-        data = format_plaid_data(transactions, accounts)
-
-        # validate loan request and transaction history
-        print(f'\033[36m Validating template ...\033[0m')
-        if not validate_loan_request(loan_range, accounts) or not validate_txn_history(period, data):
-            value = loan_range[0]
-            if value == 0:
-                raise Exception(messages['not_qualified'])
-            else:
-                raise Exception(messages['not_qualified'].format(value))
-
-        # compute score, feedback, and metadata
-        print(f'\033[36m Calculating score ...\033[0m')
-        score, feedback, metadata = plaid_score(data, score_range, feedback, models, metrics, parm, period)
-
-        # compute risk
-        print(f'\033[36m Calculating risk ...\033[0m')
-        risk = calc_risk(score, score_range, loan_range)
-
-        # keep metadata
-        print(f'\033[36m Saving parameters ...\033[0m')
-        data = keep_dict(score, metadata, risk, item.loan_request)
-        crud.add_event(db, 'plaid', data)
-
-        # update feedback
-        print(f'\033[36m Preparing feedback 1/2...\033[0m')
-        message = qualitative_feedback_plaid(
-            messages, score, feedback, score_range, loan_range, qualitative_range, item.coinmarketcap_key)
-
-        print(f'\033[36m Preparing feedback 2/2 ...\033[0m')
-        feedback = interpret_score_plaid(
-            score, feedback, score_range, loan_range, qualitative_range)
-
-        # return success
-        print(f'\033[35;1m Credit score has successfully been calculated.\033[0m')
+        maximum_amount, features, state = await plaid_prepare(item, db)
+        score, risk = score_features('plaid', [(maximum_amount, features)])[0]
+        return await plaid_respond(item, db, score, risk, *state)
+
+    except Exception as e:
+        return plaid_failed(e)
+
+
+async def plaid_prepare(item, db):
+    '''
+    Description:
+        fetches the Plaid data of a request and computes its metrics, up to the row of features to score
+
+    Parameters:
+        item (Plaid_Item): request body
+        db (sqlalchemy.orm.Session): database session
+
+    Returns:
+        maximum_amount (int): maximum amount of the config loan tier
+        features (list): metric scores of the user
+        state (tuple): configs, feedback and metadata, to pass on to plaid_respond()
+    '''
+    # configs
+    print(f'\033[36m Accessing settings ...\033[0m')
+    configs = read_config_file(item.loan_request)
+    if isinstance(configs, str):
+        raise Exception(configs)
+
+    loan_range = configs['loan_range']
+
+    thresholds = configs['minimum_requirements']['plaid']['thresholds']
+    pagination = thresholds['transactions_pagination']
+
+    models, metrics = read_models_and_metrics(
+        configs['minimum_requirements']['plaid']['scores']['models'])
+
+    messages = configs['minimum_requirements']['plaid']['messages']
+    feedback = create_feedback(models)
+    feedback['fetch'] = {}
+
+    # plaid client connection
+    print(f'\033[36m Connecting with validator ...\033[0m')
+    client = await offload_io(
+        plaid_client, getenv('PLAID_ENV'), item.plaid_client_id, item.plaid_client_secret)
+
+    # data fetching
+    print(f'\033[36m Reading data ...\033[0m')
+    fetch = ('plaid', item.plaid_access_token, pagination)
+    dataset = SESSION_STORE.get(item.session_handle, fetch)
+    if dataset is None and PLAID_INCREMENTAL:
+        dataset = await SINGLE_FLIGHT.run(
+            fetch, plaid_transactions_incremental, item.plaid_access_token, client, db, pagination)
+    elif dataset is None:
+        dataset = await SINGLE_FLIGHT.run(
+            fetch, plaid_transactions, item.plaid_access_token, client, pagination)
+    if isinstance(dataset, dict) and 'error_code' in dataset:
+        error = dataset['message']
+        raise Exception(f'Unable to fetch transactions data: {error}')
+
+    bank_name = await offload_io(plaid_bank_name, client, dataset['item']['institution_id'])
+    feedback['diversity']['bank_name'] = bank_name
+
+    # format data, validate loan request and transaction history, compute metrics
+    print(f'\033[36m Calculating metrics ...\033[0m')
+    accounts = remove_key_dupes(dataset['accounts'], 'account_id')
+    computed = await SINGLE_FLIGHT.run(
+        ('plaid_features', item.plaid_access_token, configs['maximum_amount']),
+        offload, plaid_stage, configs['maximum_amount'], feedback, dataset['transactions'], accounts)
+
+    if computed is None:
+        value = loan_range[0]
+        if value == 0:
+            raise Exception(messages['not_qualified'])
+        else:
+            raise Exception(messages['not_qualified'].format(value))
+
+    features, feedback, metadata = computed
+    return configs['maximum_amount'], features, (configs, feedback, metadata)
+
+
+async def plaid_respond(item, db, score, risk, configs, feedback, metadata):
+    '''
+    Description:
+        saves a scored Plaid request and builds its response
+
+    Parameters:
+        item (Plaid_Item): request body
+        db (sqlalchemy.orm.Session): database session
+        score (float): credit score
+        risk (dict): loan amount and risk level of the score
+        configs, feedback, metadata: state returned by plaid_prepare()
+
+    Returns:
+        r (dict): response body
+    '''
+    # keep metadata
+    print(f'\033[36m Saving parameters ...\033[0m')
+    data = keep_dict(score, metadata, risk, item.loan_request)
+    await offload_io(crud.add_event, db, 'plaid', data)
+
+    # update feedback
+    print(f'\033[36m Preparing feedback ...\033[0m')
+    message, feedback = await offload(
+        feedback_stage, 'plaid', configs['maximum_amount'], score, feedback, item.coinmarketcap_key)
+
+    # return success
+    print(f'\033[35;1m Credit score has successfully been calculated.\033[0m')
+    return {
+        'endpoint': '/credit_score/plaid',
+        'status': 'success',
+        'score': int(score),
+        'risk': risk,
+        'message': message,
+        'feedback': feedback
+    }
+
+
+def plaid_failed(e):
+    '''returns the response body of a Plaid request that could not be scored'''
+    print(f'\033[35;1m Unable to complete credit scoring calculation.\033[0m')
+    error_msg = str(e)
+    if 'do not qualify' in error_msg:
         return {
             'endpoint': '/credit_score/plaid',
-            'status': 'success',
-            'score': int(score),
-            'risk': risk,
-            'message': message,
-            'feedback': feedback
+            'status': 'not qualified',
+            'message': str(e),
         }
 
-    except Exception as e:
-        print(f'\033[35;1m Unable to complete credit scoring calculation.\033[0m')
-        error_msg = str(e)
-        if 'do not qualify' in error_msg:
-            return JSONResponse(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                content={
-                    'endpoint': '/credit_score/plaid',
-                    'status': 'not qualified',
-                    'message': str(e),
-                }
-            )
-
-        return JSONResponse(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            content={
-                'endpoint': '/credit_score/plaid',
-                'status': 'error',
-                'message': error_msg,
-            }
-        )
+    return {
+        'endpoint': '/credit_score/plaid',
+        'status': 'error',
+        'message': error_msg,
+    }
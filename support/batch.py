@@ -0,0 +1,99 @@
+from fastapi.encoders import jsonable_encoder
+from helpers.score import score_features
+from dotenv import load_dotenv
+from os import getenv
+import asyncio
+import json
+load_dotenv()
+
+
+BATCH_MAX_ITEMS = int(getenv('BATCH_MAX_ITEMS', 1000))  # requests accepted in a single batch
+BATCH_MAX_CONCURRENCY = int(getenv('BATCH_MAX_CONCURRENCY', 8))  # requests of a batch processed at once
+NDJSON = 'application/x-ndjson'
+
+
+async def stream_batch(items, validator, prepare, respond, failed, session):
+    '''
+    Description:
+        scores the requests of a batch together, and yields each response as a line of NDJSON
+        as soon as it is ready, along with the index of its request in the batch:
+            1. the data of each request is fetched and turned into its row of features,
+               at most BATCH_MAX_CONCURRENCY requests at once. Requests failing meanwhile are answered at once
+            2. the rows of all the other requests are scored in one pass (see score_features)
+            3. the scored requests are saved and answered, at most BATCH_MAX_CONCURRENCY at once
+        Each step of a request runs on a database session of its own, as sessions can't be shared
+        by concurrent requests. If the client disconnects, the requests still pending are cancelled
+
+    Parameters:
+        items (list): requests of the batch
+        validator (str): 'plaid', 'coinbase' or 'covalent'
+        prepare (function): coroutine function, returns (maximum_amount, features, state) given a request
+            and its database session
+        respond (function): coroutine function, returns the response body of a request given the request,
+            its database session, its score and risk, and the state returned by prepare
+        failed (function): returns the response body of a request given the exception it raised
+        session (function): opens a database session
+
+    Returns:
+        line (str): JSON response of a request, newline terminated
+    '''
+    done = asyncio.Queue()
+    answered = set()
+    prepared = []
+
+    async def answer(i, r):
+        answered.add(i)
+        await done.put({'index': i, **r})
+
+    async def step(i, fn, *args):
+        db = session()
+        try:
+            return await fn(items[i], db, *args)
+        except Exception as e:
+            await answer(i, failed(e))
+        finally:
+            db.close()
+
+    async def prepare_item(i):
+        r = await step(i, prepare)
+        if r is not None:
+            prepared.append((i, *r))
+
+    async def respond_item(i, scored, state):
+        r = await step(i, respond, *scored, *state)
+        if r is not None:
+            await answer(i, r)
+
+    async def run():
+        try:
+            await bounded([lambda i=i: prepare_item(i) for i in range(len(items))])
+            scored = score_features(validator, [(amount, features) for i, amount, features, state in prepared])
+            await bounded([lambda i=i, s=s, state=state: respond_item(i, s, state)
+                           for (i, amount, features, state), s in zip(prepared, scored)])
+
+        # answer the requests left, or the stream would wait for them forever
+        except Exception as e:
+            for i in range(len(items)):
+                if i not in answered:
+                    await answer(i, failed(e))
+
+    task = asyncio.ensure_future(run())
+    try:
+        for _ in range(len(items)):
+            r = await done.get()
+            yield json.dumps(jsonable_encoder(r)) + '\n'
+
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+async def bounded(jobs):
+    '''run the coroutine functions of jobs, at most BATCH_MAX_CONCURRENCY at once'''
+    queue = iter(jobs)
+
+    async def worker():
+        for job in queue:
+            await job()
+
+    await asyncio.gather(*[worker() for _ in range(min(BATCH_MAX_CONCURRENCY, len(jobs)))])
@@ -0,0 +1,90 @@
+from collections import OrderedDict
+from dotenv import load_dotenv
+from os import getenv
+import threading
+import hashlib
+import time
+load_dotenv()
+
+
+CLIENT_MAX_ENTRIES = int(getenv('CLIENT_MAX_ENTRIES', 256))  # SDK clients kept at once, per registry
+CLIENT_IDLE_TTL = int(getenv('CLIENT_IDLE_TTL', 600))  # seconds an unused SDK client is kept
+
+
+class ClientRegistry:
+    '''
+    Description:
+        LRU registry of validator SDK clients, so that requests made with the same credentials
+        reuse the same client and its warm connection pool instead of building a new one.
+        Clients unused for longer than idle_ttl are dropped, and when full,
+        the least recently used client is dropped. Dropped clients are closed
+
+    Parameters:
+        max_entries (int): maximum number of clients kept at once
+        idle_ttl (int): seconds an unused client is kept
+        close (function): releases the connections of a dropped client
+    '''
+
+    def __init__(self, max_entries, idle_ttl, close):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.close = close
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        '''returns the client registered under key, or registers the one returned by build()'''
+        digest = client_key(key)
+        now = time.monotonic()
+        with self.lock:
+            dropped = self.expire(now)
+            hit = self.data.get(digest)
+            if hit is not None:
+                self.data[digest] = (now, hit[1])
+                self.data.move_to_end(digest)
+                client = hit[1]
+
+        if hit is None:
+            client = build()
+            with self.lock:
+                if digest in self.data:
+                    # another request built the same client meanwhile: keep theirs
+                    dropped.append(client)
+                    client = self.data[digest][1]
+                else:
+                    self.data[digest] = (now, client)
+                    while len(self.data) > self.max_entries:
+                        dropped.append(self.data.popitem(last=False)[1][1])
+
+        for c in dropped:
+            self.release(c)
+        return client
+
+    def expire(self, now):
+        '''pop the clients idle for too long, oldest first, and return them'''
+        dropped = []
+        while self.data:
+            digest, (used, client) = next(iter(self.data.items()))
+            if now - used < self.idle_ttl:
+                break
+            del self.data[digest]
+            dropped.append(client)
+        return dropped
+
+    def release(self, client):
+        try:
+            self.close(client)
+        except Exception:
+            pass
+
+    def clear(self):
+        with self.lock:
+            dropped = [client for used, client in self.data.values()]
+            self.data.clear()
+        for c in dropped:
+            self.release(c)
+
+
+def client_key(key):
+    '''hash of the credentials a client is built with, so they are never kept in clear as keys'''
+    return hashlib.sha256(repr(key).encode()).hexdigest()
@@ -1,5 +1,9 @@
 from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import select, or_
 from support import models
+from datetime import datetime, timezone
+import json
 
 
 def add_event(db: Session, tablename: str, data: object):
@@ -40,3 +44,72 @@ def add_event(db: Session, tablename: str, data: object):
 
     finally:
         return
+
+
+def get_plaid_cursor(db: Session, item_id: str):
+    '''returns the last sync cursor stored for a Plaid item, or None if the item was never synced'''
+    item = db.get(models.PlaidItemTable, item_id)
+    return item.cursor if item else None
+
+
+def sync_plaid_transactions(db: Session, item_id: str, cursor: str, transactions: list, removed: list):
+    '''
+    upsert the added and modified transactions of a Plaid item, drop the removed ones,
+    and save the new sync cursor, all in one commit. A concurrent sync of the same item may insert
+    the same transactions first: the upsert is then retried once. Raises an exception on failure
+    '''
+    table = models.PlaidTransactionTable
+    for attempt in range(2):
+        try:
+            for n in range(0, len(removed), 1000):
+                db.query(table).filter(table.transaction_id.in_(removed[n:n+1000])).delete(synchronize_session=False)
+
+            for t in transactions:
+                db.merge(table(
+                    transaction_id=t['transaction_id'],
+                    item_id=item_id,
+                    account_id=t['account_id'],
+                    date=t['date'],
+                    pending=t['pending'],
+                    data=json.loads(json.dumps(t, default=str))
+                ))
+
+            db.merge(models.PlaidItemTable(item_id=item_id, cursor=cursor, datetime=datetime.now(timezone.utc)))
+            db.commit()
+            return
+
+        except IntegrityError:
+            db.rollback()
+            if attempt:
+                raise
+
+        except Exception:
+            db.rollback()
+            raise
+
+
+def purge_plaid_transactions(db: Session, start_date, idle_since):
+    '''
+    drop the stored transactions older than start_date, which are out of the scoring window,
+    and the items not synced since idle_since along with all their transactions. Raises an exception on failure
+    '''
+    table = models.PlaidTransactionTable
+    items = models.PlaidItemTable
+    try:
+        idle = select(items.item_id).where(items.datetime < idle_since)
+        db.query(table).filter(
+            or_(table.date < start_date, table.item_id.in_(idle))).delete(synchronize_session=False)
+        db.query(items).filter(items.datetime < idle_since).delete(synchronize_session=False)
+        db.commit()
+
+    except Exception:
+        db.rollback()
+        raise
+
+
+def get_plaid_transactions(db: Session, item_id: str, start_date, limit=None):
+    '''returns the stored transactions of a Plaid item since start_date, up to limit of the latest ones, newest first'''
+    table = models.PlaidTransactionTable
+    rows = db.query(table).filter(table.item_id == item_id, table.date >= start_date)
+    rows = rows.order_by(table.date.desc(), table.transaction_id).limit(limit)
+    return [{**r.data, 'date': r.date} for r in rows]
@@ -0,0 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import get_context
+from dotenv import load_dotenv
+from os import getenv, cpu_count
+import asyncio
+load_dotenv()
+
+
+SCORING_EXECUTOR = getenv('SCORING_EXECUTOR', 'thread').lower()  # 'thread', 'process' or 'inline'
+SCORING_WORKERS = int(getenv('SCORING_WORKERS', cpu_count() or 1))  # workers of the scoring pool
+
+
+def init_worker():
+    '''
+    Runs once in every worker process: loads the config tiers and compiles their scoring params
+    before the first job, so jobs only carry user data
+    '''
+    from config.helper import CONFIG
+    from helpers.helper import compile_params
+    compile_params(CONFIG.load()[2])
+
+
+def scoring_executor(kind, workers):
+    '''
+    Description:
+        builds the pool the CPU-bound scoring stages run on, off the event loop
+            - thread: shares memory with the server, no serialization cost
+            - process: scales with cores, user data is pickled to and from the workers
+            - inline: no pool, stages run on the event loop
+
+    Parameters:
+        kind (str): 'thread', 'process' or 'inline'
+        workers (int): number of workers of the pool
+
+    Returns:
+        executor (concurrent.futures.Executor): None when inline
+    '''
+    if kind == 'process':
+        # spawn rather than fork: the server already runs threads (connection pools, fetch pools)
+        return ProcessPoolExecutor(workers, mp_context=get_context('spawn'), initializer=init_worker)
+    if kind == 'thread':
+        return ThreadPoolExecutor(workers, thread_name_prefix='scoring')
+    if kind == 'inline':
+        return None
+    raise ValueError(f'unknown SCORING_EXECUTOR: {kind}')
+
+
+SCORING_POOL = scoring_executor(SCORING_EXECUTOR, SCORING_WORKERS)
+
+
+async def offload(fn, *args):
+    '''run fn(*args) on the scoring pool, without blocking the event loop'''
+    if SCORING_POOL is None:
+        return fn(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(SCORING_POOL, fn, *args)
+
+
+async def offload_io(fn, *args):
+    '''run the blocking I/O call fn(*args) on the default thread pool, without blocking the event loop'''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, fn, *args)
+
+
+async def run_periodically(seconds, fn, *args):
+    '''run the blocking job fn(*args) off the event loop every given number of seconds, until cancelled'''
+    while True:
+        try:
+            await offload_io(fn, *args)
+        except Exception as e:
+            print(f'\033[31m Scheduled {fn.__name__} failed: {e}\033[0m')
+        await asyncio.sleep(seconds)
+
+
+def close_scoring_executor():
+    if SCORING_POOL is not None:
+        SCORING_POOL.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,79 @@
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+from os import getenv
+import threading
+import requests
+import asyncio
+import aiohttp
+load_dotenv()
+
+
+HTTP_TIMEOUT = float(getenv('HTTP_TIMEOUT', 30))  # seconds an upstream API has to answer
+HTTP_CONNECT_TIMEOUT = float(getenv('HTTP_CONNECT_TIMEOUT', 5))  # seconds to open a connection
+HTTP_MAX_CONNECTIONS = int(getenv('HTTP_MAX_CONNECTIONS', 20))  # keep-alive connections per host
+HTTP_KEEPALIVE = 60  # seconds an idle connection is kept open
+
+SYNC_SESSION = None
+ASYNC_SESSIONS = {}
+lock = threading.Lock()
+
+
+def http_session():
+    '''
+    Description:
+        returns the requests session shared by all blocking HTTP calls of the process.
+        It keeps a pool of keep-alive connections per host, so repeated calls to the same API
+        skip the TCP and TLS handshakes. It is safe to use from several threads
+
+    Returns:
+        session (requests.Session): shared session
+    '''
+    global SYNC_SESSION
+    with lock:
+        if SYNC_SESSION is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=HTTP_MAX_CONNECTIONS)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            SYNC_SESSION = session
+        return SYNC_SESSION
+
+
+def http_get(url, **kwargs):
+    '''GET request through the shared session, with the default timeouts unless others are given'''
+    kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_TIMEOUT))
+    return http_session().get(url, **kwargs)
+
+
+def async_session():
+    '''
+    Description:
+        returns the aiohttp session shared by all async HTTP calls running on the current event loop.
+        Like http_session(), it keeps a pool of keep-alive connections per host, and applies
+        the default timeouts to every request
+
+    Returns:
+        session (aiohttp.ClientSession): shared session of the running loop
+    '''
+    loop = asyncio.get_running_loop()
+    session = ASYNC_SESSIONS.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit_per_host=HTTP_MAX_CONNECTIONS, keepalive_timeout=HTTP_KEEPALIVE)
+        timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT, sock_connect=HTTP_CONNECT_TIMEOUT)
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        ASYNC_SESSIONS[loop] = session
+    return session
+
+
+async def close_http_sessions():
+    '''close the shared sessions and their pooled connections (call it on app shutdown)'''
+    global SYNC_SESSION
+    session = ASYNC_SESSIONS.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+    with lock:
+        if SYNC_SESSION is not None:
+            SYNC_SESSION.close()
+            SYNC_SESSION = None
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, Float, String, DateTime
+from sqlalchemy import Column, Integer, Float, String, DateTime, Date, Boolean, JSON
 from support.database import Base
 
 
@@ -37,3 +37,25 @@ class CovalentTable(Base):
     credit_score = Column(Float, nullable=False)
     amount_granted = Column(Float, nullable=False)
     loan_risk = Column(String, nullable=False)
+
+
+# local store of Plaid transactions, synced incrementally
+class PlaidItemTable(Base):
+
+    __tablename__ = 'plaid_item'
+
+    item_id = Column(String, primary_key=True)
+    cursor = Column(String, nullable=False)
+    datetime = Column(DateTime, nullable=False)
+
+
+class PlaidTransactionTable(Base):
+
+    __tablename__ = 'plaid_transaction'
+
+    transaction_id = Column(String, primary_key=True)
+    item_id = Column(String, nullable=False, index=True)
+    account_id = Column(String, nullable=False)
+    date = Column(Date, nullable=False, index=True)
+    pending = Column(Boolean, nullable=False)
+    data = Column(JSON, nullable=False)
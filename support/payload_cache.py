@@ -0,0 +1,174 @@
+from collections import OrderedDict
+from datetime import date, datetime
+from dotenv import load_dotenv
+from os import getenv
+import threading
+import hashlib
+import struct
+import json
+import time
+import zlib
+import os
+load_dotenv()
+
+
+PAYLOAD_CACHE_BYTES = int(getenv('PAYLOAD_CACHE_BYTES', 64 * 2**20))  # memory budget of the in-memory tier
+PAYLOAD_CACHE_DIR = getenv('PAYLOAD_CACHE_DIR')  # optional on-disk tier, off when unset
+
+
+class PayloadCache:
+    '''
+    Description:
+        cache of raw validator responses, keyed by (validator, account identifier, endpoint, params).
+        Keys are hashed, so credentials used as account identifiers are never stored in clear.
+        Values are stored as JSON, so every hit returns a fresh copy the caller is free to mutate,
+        and the disk tier never holds anything but data. Tuples come back as lists.
+            - memory tier: LRU bounded by the total size of the serialized values
+            - disk tier (optional): compressed values evicted from memory spill to disk,
+              and are promoted back to memory on their next hit
+        Every value expires after the ttl it was stored with
+
+    Parameters:
+        max_bytes (int): memory budget of the in-memory tier
+        directory (str): folder of the on-disk tier (None to keep values in memory only)
+    '''
+
+    def __init__(self, max_bytes, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.data = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        '''returns the cached value of key, or None if it is missing or expired'''
+        digest = payload_key(*key)
+        now = time.time()
+        with self.lock:
+            hit = self.data.get(digest)
+            if hit:
+                expires, blob = hit
+                if expires > now:
+                    self.data.move_to_end(digest)
+                    return loads(blob)
+                self.drop(digest)
+
+        hit = self.read(digest, now)
+        if hit:
+            expires, blob = hit
+            try:
+                value = loads(blob)
+            except ValueError:
+                return None
+            with self.lock:
+                spill = self.store(digest, expires, blob)
+            for args in spill:
+                self.write(*args)
+            return value
+
+    def put(self, key, value, ttl):
+        '''store value under key for ttl seconds. Values that aren't JSON serializable are not cached'''
+        digest = payload_key(*key)
+        try:
+            blob = dumps(value)
+        except (TypeError, ValueError):
+            return
+        with self.lock:
+            spill = self.store(digest, time.time() + ttl, blob)
+        for args in spill:
+            self.write(*args)
+
+    def store(self, digest, expires, blob):
+        '''add a value to the memory tier, and return the least recently used values evicted to make room'''
+        if digest in self.data:
+            self.drop(digest)
+        self.data[digest] = (expires, blob)
+        self.size += len(blob)
+
+        spill = []
+        while self.size > self.max_bytes and len(self.data) > 1:
+            k, (e, b) = self.data.popitem(last=False)
+            self.size -= len(b)
+            spill.append((k, e, b))
+        return spill
+
+    def drop(self, digest):
+        expires, blob = self.data.pop(digest)
+        self.size -= len(blob)
+
+    def write(self, digest, expires, blob):
+        '''spill a value to the disk tier, along with its expiry time'''
+        if not self.directory or expires <= time.time():
+            return
+        path = os.path.join(self.directory, digest)
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                f.write(struct.pack('d', expires) + zlib.compress(blob))
+            os.replace(path + '.tmp', path)
+        except OSError:
+            pass
+
+    def read(self, digest, now):
+        '''returns (expires, blob) from the disk tier, or None when missing or expired'''
+        if not self.directory:
+            return None
+        path = os.path.join(self.directory, digest)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            expires = struct.unpack('d', data[:8])[0]
+            if expires > now:
+                return expires, zlib.decompress(data[8:])
+            os.remove(path)
+        except (OSError, zlib.error, struct.error):
+            pass
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.size = 0
+
+
+def dumps(value):
+    '''serialize a JSON payload, along with the dates the validator SDKs parse in it'''
+    return json.dumps(value, default=encode_date, separators=(',', ':')).encode()
+
+
+def loads(blob):
+    return json.loads(blob, object_hook=decode_date)
+
+
+def encode_date(obj):
+    if isinstance(obj, datetime):
+        return {'$datetime': obj.isoformat()}
+    if isinstance(obj, date):
+        return {'$date': obj.isoformat()}
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+def decode_date(d):
+    if len(d) == 1 and '$datetime' in d:
+        return datetime.fromisoformat(d['$datetime'])
+    if len(d) == 1 and '$date' in d:
+        return date.fromisoformat(d['$date'])
+    return d
+
+
+def payload_key(validator, account, endpoint, params):
+    '''content address of a validator response'''
+    key = repr((validator, account, endpoint, sorted(params.items())))
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def payload_version(*first_page):
+    '''
+    fingerprint of the first page of a paginated endpoint, to cache the following pages under.
+    Pages are requested by offset, and new data shifts the offsets of all pages: it also changes
+    the first page, so the following pages cached along with another first page are never reused
+    '''
+    return hashlib.sha256(repr(first_page).encode()).hexdigest()
+
+
+PAYLOAD_CACHE = PayloadCache(PAYLOAD_CACHE_BYTES, PAYLOAD_CACHE_DIR)
@@ -0,0 +1,44 @@
+from slowapi import Limiter
+from slowapi.errors import RateLimitExceeded
+from slowapi.util import get_remote_address
+from slowapi.wrappers import Limit
+from dotenv import load_dotenv
+from limits import parse
+from os import getenv
+import threading
+load_dotenv()
+
+
+RATE_LIMIT = getenv('RATE_LIMIT', '5/minute')  # calls per client and endpoint
+BATCH_RATE_LIMIT = getenv('BATCH_RATE_LIMIT', '10000/hour')  # batch requests per client, all batch endpoints together
+BATCH_SCOPE = '/credit_score/batch'
+
+limiter = Limiter(key_func=get_remote_address, default_limits=[RATE_LIMIT])
+lock = threading.Lock()
+
+
+def charge_items(request, n):
+    '''
+    Description:
+        charges the n requests of a batch to BATCH_RATE_LIMIT, the budget shared by the batch endpoints
+        of all validators, apart from the limit of the endpoints scoring a single request.
+        The whole batch is charged at once, or not at all when it doesn't fit in what is left of the budget
+
+    Parameters:
+        request (starlette.requests.Request): batch request
+        n (int): number of requests in the batch
+
+    Raises:
+        RateLimitExceeded: the batch doesn't fit in the budget
+    '''
+    item = parse(BATCH_RATE_LIMIT)
+    args = [get_remote_address(request), BATCH_SCOPE]
+    request.state.view_rate_limit = (item, args)
+
+    # check and charge in one step, so that concurrent batches can't both fit in the same budget
+    with lock:
+        reset, remaining = limiter.limiter.get_window_stats(item, *args)
+        if remaining < n:
+            raise RateLimitExceeded(Limit(item, get_remote_address, None, False, None, None, None, False))
+        for _ in range(n):
+            limiter.limiter.hit(item, *args)
@@ -1,4 +1,5 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, conlist
+from support.batch import BATCH_MAX_ITEMS
 from typing import Optional
 
 
@@ -27,25 +28,44 @@ class Loan_Item(BaseModel):
     loan_request: int
 
 
+class Session_Access(BaseModel):
+    session_handle: Optional[str]
+
+
 class Coinbase_Item(
-        Coinbase_Access, CoinmarketCap_Access, Loan_Item):
+        Coinbase_Access, CoinmarketCap_Access, Loan_Item, Session_Access):
     pass
 
 
 class Covalent_Item(
-        Covalent_Access, CoinmarketCap_Access, Loan_Item):
+        Covalent_Access, CoinmarketCap_Access, Loan_Item, Session_Access):
     pass
 
 
 class Plaid_Item(
-        Plaid_Access, CoinmarketCap_Access, Loan_Item):
+        Plaid_Access, CoinmarketCap_Access, Loan_Item, Session_Access):
     pass
 
 
+class Coinbase_Batch(BaseModel):
+    items: conlist(Coinbase_Item, min_items=1, max_items=BATCH_MAX_ITEMS)
+
+
+class Covalent_Batch(BaseModel):
+    items: conlist(Covalent_Item, min_items=1, max_items=BATCH_MAX_ITEMS)
+
+
+class Plaid_Batch(BaseModel):
+    items: conlist(Plaid_Item, min_items=1, max_items=BATCH_MAX_ITEMS)
+
+
 class KYC_Item(BaseModel):
     chosen_validator: str
     coinmarketcap_key: str
 
+    loan_request: Optional[int]
+    keep_session: Optional[bool]
+
     plaid_access_token: Optional[str]
     plaid_client_id: Optional[str]
     plaid_client_secret: Optional[str]
@@ -0,0 +1,69 @@
+from collections import OrderedDict
+from dotenv import load_dotenv
+from os import getenv
+import threading
+import hashlib
+import secrets
+import pickle
+import time
+load_dotenv()
+
+
+SESSION_TTL = int(getenv('SESSION_TTL', 300))  # seconds a session handle stays valid
+SESSION_MAX_ENTRIES = int(getenv('SESSION_MAX_ENTRIES', 1000))  # sessions kept at once
+
+
+class SessionStore:
+    '''
+    Description:
+        bounded, expiring, server-side store of the data fetched by /kyc, so that the credit score
+        endpoints can reuse it instead of fetching it again. Data is stored under an opaque handle,
+        along with the fetch it comes from: (validator, user credentials, fetch params).
+        A handle only returns data to a request making the very same fetch,
+        so it is useless without the credentials of the user it was issued to.
+        When full, the oldest session is dropped
+
+    Parameters:
+        max_entries (int): maximum number of sessions kept at once
+        ttl (int): seconds a session stays valid
+    '''
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, fetch, data):
+        '''store the data returned by a fetch, and return the handle to retrieve it'''
+        handle = secrets.token_urlsafe(24)
+        blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        with self.lock:
+            self.data[handle] = (now + self.ttl, fetch_key(fetch), blob)
+            while len(self.data) > self.max_entries:
+                self.data.popitem(last=False)
+        return handle
+
+    def get(self, handle, fetch):
+        '''returns a copy of the data stored under handle for this fetch, or None'''
+        if not handle:
+            return None
+        with self.lock:
+            hit = self.data.get(handle)
+            if hit is None:
+                return None
+            expires, digest, blob = hit
+            if expires <= time.time():
+                del self.data[handle]
+                return None
+        if secrets.compare_digest(digest, fetch_key(fetch)):
+            return pickle.loads(blob)
+
+
+def fetch_key(fetch):
+    '''hash of a fetch, so user credentials are never stored in clear'''
+    return hashlib.sha256(repr(fetch).encode()).hexdigest()
+
+
+SESSION_STORE = SessionStore(SESSION_MAX_ENTRIES, SESSION_TTL)
@@ -0,0 +1,60 @@
+from support.executor import offload_io
+import asyncio
+import inspect
+import copy
+
+
+class SingleFlight:
+    '''
+    Coalesce concurrent calls sharing the same key into a single in-flight computation:
+        - the first caller starts the computation
+        - callers arriving while it is in flight wait for it instead of starting their own
+        - all of them receive its result (or its exception)
+    Nothing is cached: once the computation completes, the next call with the same key starts a new one.
+    Every caller but the last one to resume gets a deep copy of the result,
+    so callers can freely mutate what they receive
+    '''
+
+    def __init__(self):
+        self.flights = {}
+
+    async def run(self, key, fn, *args):
+        '''
+        run fn(*args), or join the in-flight call with the same key.
+        fn can either be a regular function or a coroutine function:
+        regular functions run on the default thread pool, so a blocking fetch doesn't hold the event loop
+        '''
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = Flight(asyncio.ensure_future(call(fn, *args)))
+            self.flights[key] = flight
+            flight.task.add_done_callback(lambda task: self.forget(key, flight))
+
+        flight.waiters += 1
+        try:
+            # a caller going away must not cancel the computation shared with the others
+            result = await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+
+        return result if flight.waiters == 0 else copy.deepcopy(result)
+
+    def forget(self, key, flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+
+class Flight:
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+async def call(fn, *args):
+    if inspect.iscoroutinefunction(fn):
+        return await fn(*args)
+    return await offload_io(fn, *args)
+
+
+SINGLE_FLIGHT = SingleFlight()
@@ -1,6 +1,7 @@
 from helpers.metrics_coinbase import *
 from config.helper import *
 from helpers.helper import *
+from validator.coinbase import coinbase_to_usd
 from datetime import datetime
 import unittest
 import json
@@ -99,8 +100,8 @@ class TestMetricsCoinbase(unittest.TestCase):
         '''
         history_acc_longevity(self.acc, self.fb, self.par)
 
-        self.assertGreaterEqual(history_acc_longevity.age, 0)
-        self.assertIsInstance(history_acc_longevity.age, (int, float))
+        self.assertGreaterEqual(metric_context().age, 0)
+        self.assertIsInstance(metric_context().age, (int, float))
         self.assertEqual(history_acc_longevity([], self.fb, self.par)[0], 0)
 
     def test_liquidity_tot_balance_now(self):
@@ -154,8 +155,8 @@ class TestMetricsCoinbase(unittest.TestCase):
         - no tx returns 'no tx history' error
         '''
         a, b = activity_consistency(self.tx, 'credit', self.fb, self.par)
-        i = list(activity_consistency.frame.index)
-        d = [x[0] for x in activity_consistency.typed_txn]
+        i = list(metric_context().frame.index)
+        d = [x[0] for x in metric_context().typed_txn]
 
         self.assertCountEqual(i, d)
         self.assertIsInstance(np.random.choice(d), datetime)
@@ -172,8 +173,8 @@ class TestMetricsCoinbase(unittest.TestCase):
         activity_profit_since_inception(self.acc, self.tx, self.fb, self.par)
 
         self.assertIsInstance(
-            activity_profit_since_inception.profit, (float, int))
-        self.assertGreater(activity_profit_since_inception.profit, 0)
+            metric_context().profit, (float, int))
+        self.assertGreater(metric_context().profit, 0)
         self.assertRegex(activity_profit_since_inception([], [], self.fb, self.par)[
                          1]['activity']['error'], 'no net profit')
 
@@ -293,3 +294,27 @@ class TestParametrizeCoinbase(unittest.TestCase):
                 self.assertEqual(x[0], 0)
                 self.assertIsInstance(x[0], (float, int))
                 self.assertIsInstance(x[1], dict)
+
+
+class TestCoinbaseToUsd(unittest.TestCase):
+
+    def setUp(self):
+        self.acc = [{'native_balance': {'amount': 100.0, 'currency': 'EUR'}},
+                    {'native_balance': {'amount': 50.0, 'currency': 'USD'}}]
+        self.txn = [{'native_amount': {'amount': '-20.00', 'currency': 'EUR'}},
+                    {'native_amount': {'amount': '7.5', 'currency': 'USD'}}]
+
+    def test_convert(self):
+        # native amounts are converted with the rate of their currency, and keep their type
+        acc, txn = coinbase_to_usd(self.acc, self.txn, {'EUR': 1.1, 'USD': 1})
+        self.assertEqual([d['native_balance']['currency'] for d in acc], ['USD', 'USD'])
+        self.assertEqual([d['native_amount']['currency'] for d in txn], ['USD', 'USD'])
+        self.assertAlmostEqual(acc[0]['native_balance']['amount'], 110.0)
+        self.assertEqual(acc[1]['native_balance']['amount'], 50.0)
+        self.assertAlmostEqual(float(txn[0]['native_amount']['amount']), -22.0)
+        self.assertEqual(txn[1]['native_amount']['amount'], '7.5')
+
+    def test_missing_rate(self):
+        # a currency without a rate fails the conversion, rather than being left unconverted
+        self.assertRaisesRegex(Exception, 'EUR', coinbase_to_usd, self.acc, self.txn, {'USD': 1})
+        self.assertEqual(self.acc[0]['native_balance']['currency'], 'EUR')
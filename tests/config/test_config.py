@@ -0,0 +1,88 @@
+from config.helper import *
+import tempfile
+import unittest
+import shutil
+import json
+import os
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                   - test the config.json loan tier registry -              #
+# -------------------------------------------------------------------------- #
+
+
+class TestConfigRegistry(unittest.TestCase):
+
+    def setUp(self):
+        with open(CONFIG_FILE) as f:
+            self.data = json.load(f)['data']
+
+    def linear_tier(self, loan_request):
+        # reference lookup: first tier of the file whose maximum amount covers the loan request
+        tiers = [d for d in self.data if d['maximum_amount'] >= loan_request]
+        return tiers[0] if tiers else 'Loan amount requested is over the limit.'
+
+    def test_tier_boundaries(self):
+        # the bisection should pick the same tier as the linear lookup, on and around every boundary
+        amounts = [d['maximum_amount'] for d in self.data]
+        requests = [-1, 0, 1] + [a + n for a in amounts for n in [-1, 0, 1]]
+        for loan_request in requests:
+            with self.subTest(loan_request=loan_request):
+                expected = self.linear_tier(loan_request)
+                tier = read_config_file(loan_request)
+                if isinstance(expected, str):
+                    self.assertEqual(tier, expected)
+                else:
+                    self.assertEqual(tier['maximum_amount'], expected['maximum_amount'])
+
+    def test_frozen(self):
+        # config tiers are shared by all requests, so they can't be modified
+        tier = read_config_file(0)
+        self.assertRaises(TypeError, tier.__setitem__, 'maximum_amount', 0)
+        self.assertRaises(TypeError, tier['minimum_requirements'].pop, 'plaid')
+        self.assertIsInstance(tier['score_range'], tuple)
+        self.assertIs(read_config_file(0), tier)
+
+    def config_copy(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        config_file = os.path.join(folder, 'config.json')
+        shutil.copy(CONFIG_FILE, config_file)
+        return config_file
+
+    def rewrite(self, config_file, text):
+        with open(config_file, 'w') as f:
+            f.write(text)
+        mtime = os.path.getmtime(config_file) + 10
+        os.utime(config_file, (mtime, mtime))
+
+    def test_hot_reload(self):
+        # with hot reload on, the file is read again once its modification time changes
+        config_file = self.config_copy()
+
+        registry = ConfigRegistry(config_file, hot_reload=True)
+        static = ConfigRegistry(config_file)
+        amount = registry.tier(0)['maximum_amount']
+        static.tier(0)
+
+        data = {'data': [dict(d, maximum_amount=d['maximum_amount'] + 1) for d in self.data]}
+        self.rewrite(config_file, json.dumps(data))
+
+        self.assertEqual(registry.tier(0)['maximum_amount'], amount + 1)
+        self.assertEqual(static.tier(0)['maximum_amount'], amount)
+
+    def test_invalid_reload(self):
+        # a half written or invalid file is ignored, the last valid one keeps being served
+        config_file = self.config_copy()
+        registry = ConfigRegistry(config_file, hot_reload=True)
+        tier = registry.tier(0)
+
+        self.rewrite(config_file, '{"data": [')
+        self.assertIs(registry.tier(0), tier)
+        self.rewrite(config_file, json.dumps({'data': [{'maximum_amount': 0}]}))
+        self.assertIs(registry.tier(0), tier)
+
+        data = {'data': [dict(d, maximum_amount=d['maximum_amount'] + 1) for d in self.data]}
+        self.rewrite(config_file, json.dumps(data))
+        self.assertEqual(registry.tier(0)['maximum_amount'], tier['maximum_amount'] + 1)
@@ -1,7 +1,18 @@
 from helpers.metrics_covalent import *
 from config.helper import *
 from helpers.helper import *
+from helpers.score import covalent_features, covalent_stage, score_features
+from helpers.kernel import compiled_kernel
+from helpers.context import scoring_context
+from helpers.risk import calc_risk
+from support.executor import offload
+from support.payload_cache import PayloadCache
+from support import payload_cache
+from validator import covalent
+from unittest import mock
 import unittest
+import asyncio
+import copy
 import json
 import os
 
@@ -128,7 +139,7 @@ class TestMetricWealth(unittest.TestCase):
             ERC_RANK,
             self.parm
         )
-        keep_erc = [b['contract_ticker_symbol'] for b in wealth_capital_now_adjusted.top['items']]
+        keep_erc = [b['contract_ticker_symbol'] for b in metric_context().top['items']]
         for erc in keep_erc:
             self.assertIn(erc, list(ERC_RANK.keys()))
         self.assertGreater(a[1]['wealth']['cum_balance_now_adjusted'], 1000)
@@ -186,6 +197,10 @@ class TestMetricTraffic(unittest.TestCase):
         # when all txn are voluminous, the user should earn the max score of 1
         if len(swiffer_duster(self.txn, self.fb)['items']) == len(self.txn['items']):
             self.assertEqual(traffic_dustiness(self.txn, self.fb, self.parm)[0], 1)
+        # the legit ratio compares the clean txns against the raw, untouched ones
+        traffic_dustiness(self.txn, self.fb, self.parm)
+        legit = len(swiffer_duster(self.txn, self.fb)['items'])
+        self.assertEqual(self.fb['traffic']['legit_txn_ratio'], round(legit / len(self.txn['items']), 2))
         self.assertIn('error',
                       list(traffic_dustiness(self.bal, self.fb, self.parm)[1]['traffic'].keys())
                       )
@@ -199,7 +214,7 @@ class TestMetricTraffic(unittest.TestCase):
             ERC_RANK
         )
         quotes = [y['close']['quote'] for x in self.por['items'] for y in x['holdings']
-                  if x['contract_ticker_symbol'] == traffic_running_balance.best_token]
+                  if x['contract_ticker_symbol'] == metric_context().best_token]
         avg = sum(quotes) / len(quotes)
         self.assertEqual(int(a[1]['traffic']['avg_running_balance_best_token']), int(avg))
 
@@ -239,9 +254,26 @@ class TestMetricStamina(unittest.TestCase):
             self.parm
         )
         methods = list(set([t['log_events'][0]['decoded']['name']
-                            for t in self.txn['items'] if t['log_events']]))
+                            for t in self.txn['items'] if t['log_events']
+                            and t['successful'] and t['value_quote'] > 0]))
         for m in methods:
-            self.assertIn(m, list(stamina_methods_count.methods.keys()))
+            self.assertIn(m, list(metric_context().methods.keys()))
+
+    def test_stamina_methods_breakdown(self):
+        # the feedback should count and sum the transactions of each method
+        clean = [t for t in self.txn['items'] if t['successful'] and t['value_quote'] > 0]
+        names = ['transfer', 'swap', 'approve']
+        for i, t in enumerate(clean):
+            t['log_events'] = [{'decoded': {'name': names[i % 3]}}]
+
+        stamina_methods_count(self.txn, self.fb, self.parm)
+        self.assertCountEqual(self.fb['stamina']['methods'].keys(), names)
+        for i, m in enumerate(names):
+            txn = clean[i::3]
+            self.assertEqual(self.fb['stamina']['methods'][m]['count'], len(txn))
+            self.assertAlmostEqual(
+                self.fb['stamina']['methods'][m]['volume'], sum([t['value_quote'] for t in txn]), places=1)
+            self.assertEqual(metric_context().methods[m], int(sum([t['value_quote'] for t in txn])))
 
     def test_stamina_coins_count(self):
         # ensure the function detects all legitimate coins owned by the user
@@ -253,7 +285,7 @@ class TestMetricStamina(unittest.TestCase):
         )
         coins = [c['contract_ticker_symbol'] for c in self.bal['items']
                  if c['contract_ticker_symbol'] in list(ERC_RANK.keys()) and c['quote'] > 0]
-        self.assertEqual(stamina_coins_count.unique_coins, len(coins))
+        self.assertEqual(metric_context().unique_coins, len(coins))
         self.assertRaises
         (
             Exception,
@@ -314,7 +346,10 @@ class TestCovHelperFunctions(unittest.TestCase):
         # ensure swiffer_duster() is removing all dusty txns
         length0 = len(self.txn['items'])
         dust = [t for t in self.txn['items'] if t['value_quote'] == 0]
+        raw = self.txn
         self.txn = swiffer_duster(self.txn, self.fb)
+        # the raw payload is never filtered in place
+        self.assertEqual(len(raw['items']), length0)
         for t in self.txn['items']:
             self.assertTrue(t['value_quote'] > 0)
         self.txn['quote_currency'] == 'YEN'
@@ -322,6 +357,29 @@ class TestCovHelperFunctions(unittest.TestCase):
         if len(dust) > 0:
             self.assertGreater(length0, len(self.txn['items']))
 
+    def test_swiffer_frame(self):
+        # the clean view matches swiffer_duster() and is computed only once per frame
+        frame = TxnFrame(self.txn)
+        clean = swiffer_frame(frame, self.fb)
+        self.assertEqual(len(clean), len(swiffer_duster(self.txn, self.fb)['items']))
+        self.assertIs(swiffer_frame(frame, self.fb), clean)
+        self.assertFalse(clean.value_quote.flags.writeable)
+
+    def test_frame_missing_fields(self):
+        # transactions missing their log events or date are kept, with those values unknown
+        items = copy.deepcopy(self.txn['items'])
+        del items[0]['log_events']
+        items[1]['log_events'] = None
+        del items[2]['block_signed_at']
+        frame = covalent_frame(dict(self.txn, items=items))
+
+        self.assertIsInstance(frame, TxnFrame)
+        self.assertEqual(len(frame), len(items))
+        self.assertIsNone(frame.method[0])
+        self.assertIsNone(frame.method[1])
+        self.assertTrue(np.isnat(frame.signed_at[2]))
+        self.assertEqual(frame.oldest(), TxnFrame(self.txn).subset(np.arange(len(items)) != 2).oldest())
+
     def test_purge_portfolio(self):
         # ensure the purge occurs
         self.por['quote_currency'] == 'CAD'
@@ -458,3 +516,241 @@ class TestParametrizeCovalent(unittest.TestCase):
                 self.assertIsInstance(x, tuple)
                 self.assertIsInstance(x[1], dict)
                 self.assertIsInstance(x[0], (float, int))
+
+
+class TestScoringMatrix(unittest.TestCase):
+
+    def setUp(self):
+        # expected result
+        self.expected = [
+            [0.0, 0.22, 0.35, 0.44, 0.51, 0.57, 0.62],
+            [0.19, 0.41, 0.54, 0.63, 0.7, 0.76, 0.81],
+            [0.3, 0.52, 0.65, 0.74, 0.81, 0.87, 0.92],
+            [0.38, 0.6, 0.73, 0.82, 0.89, 0.95, 1.0]
+        ]
+
+        # inputs
+        self.shapes = [(4, 7), (7, 7), (25, 40), (100, 100)]
+        self.scalars = [(7, 8), (4, 12), (1.5, 2.25)]
+
+    def tearDown(self):
+        # post-test cleanup
+        self.shapes = None
+        self.scalars = None
+
+    def build_normalized_matrix_loop(self, size, scalar):
+        # reference cell-by-cell implementation of build_normalized_matrix()
+        m = np.zeros(size)
+        extrema = round(scalar[0] * np.log(m.shape[0]) + scalar[1] * np.log(m.shape[1]), 2)
+
+        for a in range(m.shape[0]):
+            for b in range(m.shape[1]):
+                m[a][b] = round(
+                    (scalar[0] * np.log(a + 1) + scalar[1] * np.log(b + 1)) / extrema, 2
+                )
+        return m
+
+    def test_build_normalized_matrix(self):
+        # the vectorized matrix should match the reference one cell by cell
+        m = build_normalized_matrix((4, 7), (7, 8))
+        self.assertListEqual(m.tolist(), self.expected)
+
+        for size in self.shapes:
+            for scalar in self.scalars:
+                with self.subTest(size=size, scalar=scalar):
+                    np.testing.assert_array_equal(
+                        build_normalized_matrix(size, scalar), self.build_normalized_matrix_loop(size, scalar))
+
+
+class TestScoringStage(unittest.TestCase):
+
+    def setUp(self):
+        self.configs = read_config_file(LOAN_AMOUNT)
+        self.models, self.metrics = read_models_and_metrics(
+            self.configs['minimum_requirements']['covalent']['scores']['models'])
+
+    def feedback(self):
+        fb = create_feedback(self.models)
+        fb['fetch'] = {}
+        return fb
+
+    def test_covalent_stage(self):
+        # the stage reads its config tier and params in the worker, and must compute the same metrics
+        d = CovalentData()
+        expected = covalent_features(
+            self.feedback(), compiled_params('covalent', self.configs), ERC_RANK, d.txn, d.bal, d.por)
+
+        d = CovalentData()
+        features, fb = covalent_stage(
+            self.configs['maximum_amount'], self.feedback(), ERC_RANK, d.txn, d.bal, d.por)
+
+        self.assertEqual(features, expected[0])
+        self.assertEqual(len(features), compiled_kernel('covalent', self.configs).size)
+        self.assertDictEqual(fb, expected[1])
+
+    def test_score_features(self):
+        # rows of different config tiers are scored together, each with the kernel of its tier
+        d = CovalentData()
+        features, fb = covalent_stage(
+            self.configs['maximum_amount'], self.feedback(), ERC_RANK, d.txn, d.bal, d.por)
+        tiers = [read_config_file(amount) for amount in [500, 10000, 25000]]
+        rows = [(t['maximum_amount'], features) for t in tiers] * 2
+
+        scored = score_features('covalent', rows)
+        self.assertEqual(len(scored), len(rows))
+        for (amount, f), (score, risk) in zip(rows, scored):
+            configs = read_config_file(amount)
+            expected = float(compiled_kernel('covalent', configs).score([f])[0])
+            self.assertEqual(score, expected)
+            self.assertEqual(risk, calc_risk(expected, configs['score_range'], configs['loan_range']))
+
+    def test_metric_context(self):
+        # each stage keeps the metric intermediates in its own context, dropped once it is done
+        from concurrent.futures import ThreadPoolExecutor
+
+        def stage(erc_rank):
+            d = CovalentData()
+            with scoring_context() as ctx:
+                covalent_features(
+                    self.feedback(), compiled_params('covalent', self.configs), erc_rank, d.txn, d.bal, d.por)
+            return ctx, metric_context()
+
+        erc_ranks = [ERC_RANK, {k: v for k, v in ERC_RANK.items() if k != 'USDC'}] * 4
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(stage, erc_ranks))
+
+        for erc_rank, (ctx, after) in zip(erc_ranks, results):
+            keep_erc = [b['contract_ticker_symbol'] for b in ctx.top['items']]
+            self.assertTrue(set(keep_erc) <= set(erc_rank))
+            self.assertIsNot(after, ctx)
+        self.assertEqual(len({id(ctx) for ctx, after in results}), len(results))
+
+    def test_offload(self):
+        # stages run on the scoring pool return the same result as a direct call
+        result = asyncio.run(offload(head_tail_list, [300, 500, 850]))
+        self.assertEqual(result, (300, 850))
+
+    def test_scoring_kernel(self):
+        # scoring many users in one pass should match the per-user weighted sums, model after model
+        kernel = compiled_kernel('covalent', self.configs)
+        features = np.random.default_rng(0).random((50, kernel.size))
+        scores, loan_amounts, risk_levels = kernel.run(features)
+
+        a = list(self.models.values())
+        w = list(self.metrics.values())
+        head, tail = self.configs['score_range'][0], self.configs['score_range'][-1]
+        for i, f in enumerate(features):
+            b = [sum(x * y for x, y in zip(w[:2], f[:2])),
+                 sum(x * y for x, y in zip(w[2:5], f[2:5])),
+                 sum(x * y for x, y in zip(w[5:10], f[5:10])),
+                 sum(x * y for x, y in zip(w[10:], f[10:]))]
+            score = head + (tail - head) * sum(x * y for x, y in zip(a, b))
+            risk = calc_risk(score, self.configs['score_range'], self.configs['loan_range'])
+
+            self.assertAlmostEqual(scores[i], score)
+            self.assertEqual(loan_amounts[i], risk['loan_amount'])
+            self.assertEqual(risk_levels[i], risk['risk_level'])
+
+
+class TestCovalentFetch(unittest.TestCase):
+
+    def setUp(self):
+        # fresh payload cache, so every test fetches from the fake Covalent API
+        patcher = mock.patch.object(payload_cache, 'PAYLOAD_CACHE', PayloadCache(2**20))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fake_api(self, get):
+        patcher = mock.patch.object(covalent, 'covalent_get', get)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def cancel(self, fetch, *args):
+        # start a fetch, and cancel it while its requests are pending
+        async def run():
+            task = asyncio.ensure_future(fetch(*args))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            await task
+
+        asyncio.run(run())
+
+    async def hang(self, endpoint):
+        await asyncio.sleep(3600)
+
+    def test_fetch_cancelled(self):
+        # cancelling a fetch must propagate, rather than be turned into a result
+        self.fake_api(self.hang)
+        with self.assertRaises(asyncio.CancelledError):
+            self.cancel(covalent.covalent_get_balances_or_portfolio, '1', '0xabc', 'balances_v2', 'key')
+
+    def test_transactions_cancelled(self):
+        # cancelling the transactions fetch cancels the pages still pending
+        cancelled = []
+
+        async def get(endpoint):
+            if 'page-number=0' in endpoint:
+                return self.page(0, ['a'], True)
+            try:
+                await asyncio.sleep(3600)
+            except asyncio.CancelledError:
+                cancelled.append(endpoint)
+                raise
+
+        self.fake_api(get)
+        with self.assertRaises(asyncio.CancelledError):
+            self.cancel(covalent.covalent_get_transactions, '1', '0xabc', 'key', False, 500, 0)
+        self.assertEqual(len(cancelled), 2)
+
+    def page(self, n, hashes, has_more):
+        return {'error': False, 'data': {
+            'address': '0xabc',
+            'items': [{'tx_hash': h} for h in hashes],
+            'pagination': {'has_more': has_more, 'page_number': n}}}
+
+    def fake_pages(self, pages):
+        # fake transactions_v2 endpoint serving the given pages of tx hashes, and recording the pages requested
+        requested = []
+
+        async def get(endpoint):
+            n = int(endpoint.split('page-number=')[1].split('&')[0])
+            requested.append(n)
+            await asyncio.sleep(0.01 * max(len(pages) - n, 0))  # later pages answer first
+            return self.page(n, pages[n] if n < len(pages) else [], n + 1 < len(pages))
+
+        self.fake_api(get)
+        return requested
+
+    def fetch_transactions(self, max_pages):
+        return asyncio.run(covalent.covalent_get_transactions('1', '0xabc', 'key', False, 2, 0, max_pages))
+
+    def test_transactions_pages(self):
+        # pages are merged in page order, whatever order they arrive in, and overlapping txns are kept once
+        self.fake_pages([['a', 'b'], ['b', 'c'], ['d', 'e']])
+        r = self.fetch_transactions(3)
+        self.assertListEqual([t['tx_hash'] for t in r['items']], ['a', 'b', 'c', 'd', 'e'])
+        self.assertFalse(r['pagination']['has_more'])
+
+    def test_transactions_page_limit(self):
+        # no more than max_pages pages are requested, and the result tells there is more data
+        requested = self.fake_pages([['a'], ['b'], ['c'], ['d']])
+        r = self.fetch_transactions(2)
+        self.assertListEqual([t['tx_hash'] for t in r['items']], ['a', 'b'])
+        self.assertTrue(r['pagination']['has_more'])
+        self.assertListEqual(sorted(requested), [0, 1])
+
+    def test_transactions_last_page(self):
+        # pages after the last one are never merged
+        self.fake_pages([['a'], ['b']])
+        r = self.fetch_transactions(4)
+        self.assertListEqual([t['tx_hash'] for t in r['items']], ['a', 'b'])
+
+    def test_transactions_shifted_pages(self):
+        # new transactions shift all the pages: cached pages of the previous first page must not be reused
+        pages = [['c', 'd'], ['b', 'a']]
+        self.fake_pages(pages)
+        with mock.patch.dict(covalent.COVALENT_TTL, {'transactions_v2': 0}):
+            self.fetch_transactions(2)
+            pages[:] = [['e', 'c'], ['d', 'b'], ['a']]
+            r = self.fetch_transactions(3)
+        self.assertListEqual([t['tx_hash'] for t in r['items']], ['e', 'c', 'd', 'b', 'a'])
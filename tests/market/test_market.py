@@ -0,0 +1,135 @@
+from market.coinmarketcap import *
+from unittest import mock
+import threading
+import unittest
+import time
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#                 - test the Coinmarketcap market data cache -               #
+# -------------------------------------------------------------------------- #
+
+
+class Clock:
+    '''fake monotonic clock, moved forward by hand'''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class TestMarketCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('market.coinmarketcap.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = MarketCache(60, 600)
+
+    def test_fresh(self):
+        # a fresh value is fetched once
+        fetch = mock.Mock(return_value={'BTC': (1, 20000)})
+        self.cache.get('listings', fetch)
+        self.clock.now += 59
+        self.assertEqual(self.cache.get('listings', fetch), {'BTC': (1, 20000)})
+        self.assertEqual(fetch.call_count, 1)
+
+    def test_stale_while_revalidate(self):
+        # a stale value is served at once, while a single background refresh fetches the new one
+        self.cache.get('listings', lambda: 'old')
+        self.clock.now += 120
+
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'new'
+
+        self.assertEqual(self.cache.get('listings', fetch), 'old')
+        self.assertTrue(started.wait(5))
+        for _ in range(5):
+            self.assertEqual(self.cache.get('listings', fetch), 'old')
+
+        release.set()
+        for _ in range(100):
+            if not self.cache.refreshing:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.cache.get('listings', fetch), 'new')
+        self.assertEqual(len(calls), 1)
+
+    def test_expired(self):
+        # a value too old to be served is fetched again before returning
+        self.cache.get('listings', lambda: 'old')
+        self.clock.now += 60 + 600
+        self.assertEqual(self.cache.get('listings', lambda: 'new'), 'new')
+
+    def test_failed_fetch(self):
+        # failed fetches are not cached
+        fetch = mock.Mock(side_effect=[Exception('unreachable'), 'new'])
+        self.assertRaises(Exception, self.cache.get, 'listings', fetch)
+        self.assertEqual(self.cache.get('listings', fetch), 'new')
+
+    def test_derive(self):
+        # a derived value is built once per cached value, and dropped along with it
+        build = mock.Mock(side_effect=lambda v: v.upper())
+        self.assertEqual(self.cache.derive('listings', lambda: 'old', 'upper', build), 'OLD')
+        self.assertEqual(self.cache.derive('listings', lambda: 'old', 'upper', build), 'OLD')
+        self.assertEqual(build.call_count, 1)
+
+        self.clock.now += 60 + 600
+        self.assertEqual(self.cache.derive('listings', lambda: 'new', 'upper', build), 'NEW')
+        self.assertEqual(build.call_count, 2)
+
+        self.clock.now += 60 + 600
+        self.cache.get('rates', lambda: 1)
+        self.assertEqual(list(self.cache.data), ['rates'])
+
+
+class FakeResponse:
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+def price_conversion(url, headers, params, **kwargs):
+    # fake Coinmarketcap price conversion endpoint, knowing a couple of currencies only
+    prices = {'EUR': 1.1, 'GBP': 1.25}
+    if params['symbol'] not in prices:
+        error = f'Invalid value for "symbol": "{params["symbol"]}"'
+        return FakeResponse({'status': {'error_code': 400, 'error_message': error}})
+    return FakeResponse({'status': {'error_code': 0, 'error_message': None}, 'data': [
+        {'symbol': params['symbol'], 'quote': {params['convert']: {'price': prices[params['symbol']]}}}]})
+
+
+class TestUsdRates(unittest.TestCase):
+
+    def setUp(self):
+        self.get = mock.Mock(side_effect=price_conversion)
+        for patcher in [mock.patch('market.coinmarketcap.http_get', self.get),
+                        mock.patch('market.coinmarketcap.MARKET_CACHE', MarketCache(60, 600))]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_usd_rates(self):
+        # USD needs no rate, and each rate is fetched once
+        rates = coinmarketcap_usd_rates('key', ['EUR', 'GBP', 'USD'])
+        self.assertDictEqual(rates, {'EUR': 1.1, 'GBP': 1.25, 'USD': 1})
+        coinmarketcap_usd_rates('key', ['EUR'])
+        self.assertEqual(self.get.call_count, 2)
+
+    def test_missing_currency(self):
+        # a currency unknown to Coinmarketcap fails the rates, with its error message
+        rates = coinmarketcap_usd_rates('key', ['EUR', 'XYZ'])
+        self.assertIsInstance(rates, str)
+        self.assertIn('XYZ', rates)
@@ -1,11 +1,21 @@
 from helpers.metrics_plaid import *
 from helpers.helper import *
 from config.helper import *
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from unittest import mock
 import unittest
+import plaid
 import json
 import os
 
+os.environ.setdefault('DATABASE_URL', 'sqlite://')  # read by support.database on import
+from support import crud, models  # noqa: E402
+from validator import plaid as validator  # noqa: E402
+from support.payload_cache import PayloadCache  # noqa: E402
+from support import payload_cache  # noqa: E402
+
 
 LOAN_AMOUNT = 10000
 dummy_data = 'test_plaid.json'
@@ -229,3 +239,273 @@ class TestMetricDiversity(unittest.TestCase):
 
         self.assertCountEqual(s, self.expected)
         self.assertListEqual(s, self.expected)
+
+
+class TestScoringMatrix(unittest.TestCase):
+
+    def setUp(self):
+        ''' import test values (inputs) that will feed app functions '''
+
+        # expected result
+        self.expected = [
+            [0.0, 0.22, 0.34, 0.43, 0.5, 0.56, 0.6],
+            [0.25, 0.47, 0.59, 0.68, 0.75, 0.81, 0.85],
+            [0.4, 0.61, 0.74, 0.83, 0.9, 0.95, 1.0]
+        ]
+
+        # inputs
+        self.shapes = [(3, 7), (7, 7), (25, 40), (100, 100)]
+        self.scalars = [(1.2, 1.4), (3.03, 1.17), (1.85, 1.55), (1.73, 1.17)]
+
+    def tearDown(self):
+        ''' reset test values after running tests'''
+
+        self.shapes = None
+        self.scalars = None
+
+    def build_2d_matrix_loop(self, size, scalars):
+        ''' reference cell-by-cell implementation of build_2d_matrix() '''
+
+        matrix = np.zeros(size)
+        scalars = [1 / n for n in scalars]
+
+        for m in range(matrix.shape[0]):
+            for n in range(matrix.shape[1]):
+                matrix[m][n] = round(
+                    scalars[0] * np.log10(m + 1) + scalars[1] * np.log10(n + 1), 2
+                )
+        return matrix
+
+    def test_build_2d_matrix(self):
+        ''' perform test calling app functions '''
+
+        m = build_2d_matrix((3, 7), (1.2, 1.4))
+        self.assertListEqual(m.tolist(), self.expected)
+
+        for size in self.shapes:
+            for scalars in self.scalars:
+                with self.subTest(size=size, scalars=scalars):
+                    np.testing.assert_array_equal(
+                        build_2d_matrix(size, scalars), self.build_2d_matrix_loop(size, scalars))
+
+
+class TestPlaidFrame(unittest.TestCase):
+
+    def setUp(self):
+        ''' import test values (inputs) that will feed app functions '''
+
+        with open(json_file) as f:
+            dataset = json.load(f)
+
+        for d in dataset['transactions']:
+            d['date'] = datetime.strptime(d['date'], '%Y-%m-%d').date()
+
+        accounts = remove_key_dupes(dataset['accounts'], 'account_id')
+        data = format_plaid_data(dataset['transactions'], accounts)
+
+        # inputs
+        self.data = data
+        self.checking = dict_reverse_cumsum(
+            filter_dict(data, 'subtype', 'checking'), 'amount', 'current').to_dict('records')
+
+    def tearDown(self):
+        ''' reset test values after running tests'''
+
+        self.data = None
+        self.checking = None
+
+    def dict_reverse_cumsum_loop(self, lst, col, sum_col):
+        ''' reference account-by-account implementation of dict_reverse_cumsum() '''
+
+        data = []
+        accounts = list(dict.fromkeys(d['account_id'] for d in lst))
+        for account_id in accounts:
+            temp = [dict(d) for d in lst if d['account_id'] == account_id]
+            balance = temp[-1][sum_col]
+            for d in reversed(temp):
+                d[sum_col] = balance
+                balance += d[col]
+                d[col] = -d[col]
+            data += temp
+        return data
+
+    def test_dict_reverse_cumsum(self):
+        ''' running balances rebuilt per account match the account-by-account reference '''
+
+        for subtype in ['checking', 'savings', 'credit card']:
+            with self.subTest(subtype=subtype):
+                lst = filter_dict(self.data, 'subtype', subtype)
+                expected = self.dict_reverse_cumsum_loop(lst, 'amount', 'current')
+                df = dict_reverse_cumsum(lst, 'amount', 'current')
+
+                self.assertEqual(df['current'].dtype, float)
+                self.assertListEqual(df['account_id'].tolist(), [d['account_id'] for d in expected])
+                np.testing.assert_allclose(df['amount'], [d['amount'] for d in expected])
+                np.testing.assert_allclose(df['current'], [d['current'] for d in expected])
+
+    def test_by_month(self):
+        ''' monthly aggregates of the grouped pass match a month-by-month scan of the transactions '''
+
+        frame = PlaidFrame(self.checking)
+        for category in ['restaurants', 'taxi', 'airlines and aviation services', 'payroll']:
+            with self.subTest(category=category):
+                expected = {}
+                for d in self.checking:
+                    if d['sub_category'] == category:
+                        n, s = expected.get((d['date'].year, d['date'].month), (0, 0))
+                        expected[(d['date'].year, d['date'].month)] = (n + 1, s + d['amount'])
+
+                df = frame.by_month(frame.monthly['sub_category'] == category)
+                self.assertListEqual(df.index.tolist(), sorted(expected))
+                self.assertListEqual(df['count'].tolist(), [v[0] for k, v in sorted(expected.items())])
+                np.testing.assert_allclose(df['sum'], [v[1] for k, v in sorted(expected.items())])
+
+
+class FakeResponse:
+
+    def __init__(self, data):
+        self.data = data
+
+    def to_dict(self):
+        return self.data
+
+
+class FakePlaidClient:
+    '''Plaid client serving the given /transactions/sync responses (or exceptions) in turn'''
+
+    def __init__(self, syncs):
+        self.syncs = list(syncs)
+        self.cursors = []
+
+    def accounts_get(self, request):
+        return FakeResponse({'accounts': [{'account_id': 'acc'}], 'item': {'item_id': 'item', 'institution_id': 'ins'}})
+
+    def transactions_sync(self, request):
+        self.cursors.append(request.get('cursor'))
+        r = self.syncs.pop(0)
+        if isinstance(r, Exception):
+            raise r
+        return FakeResponse(r)
+
+
+def plaid_txn(transaction_id, days_ago=10, amount=1.0, pending=False):
+    return {'transaction_id': transaction_id, 'account_id': 'acc', 'amount': amount, 'pending': pending,
+            'date': datetime.now().date() - timedelta(days=days_ago)}
+
+
+def sync_page(added=[], modified=[], removed=[], has_more=False, next_cursor='cursor'):
+    return {'added': added, 'modified': modified, 'removed': [{'transaction_id': t} for t in removed],
+            'has_more': has_more, 'next_cursor': next_cursor}
+
+
+def plaid_error(error_code):
+    e = plaid.ApiException(status=400, reason='Bad Request')
+    e.body = json.dumps({'error_code': error_code, 'error_message': error_code, 'error_type': 'TRANSACTIONS_ERROR'})
+    return e
+
+
+class TestPlaidStore(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(bind=engine)
+        self.session = sessionmaker(bind=engine)
+        self.db = self.session()
+        self.addCleanup(self.db.close)
+
+    def stored(self, item_id='item'):
+        return {t['transaction_id']: t for t in crud.get_plaid_transactions(self.db, item_id, datetime.min.date())}
+
+    def test_incremental_sync(self):
+        # added, modified, and removed transactions are applied to the store, along with the new cursor
+        client = FakePlaidClient([
+            sync_page(added=[plaid_txn('a'), plaid_txn('b'), plaid_txn('c'), plaid_txn('p', pending=True)],
+                      next_cursor='c1'),
+            sync_page(added=[plaid_txn('d')], modified=[plaid_txn('b', amount=2.0)], removed=['c'], next_cursor='c2'),
+        ])
+
+        data = validator.plaid_transactions_incremental('token', client, self.db, 0)
+        self.assertCountEqual([t['transaction_id'] for t in data['transactions']], ['a', 'b', 'c'])
+
+        data = validator.plaid_transactions_incremental('token', client, self.db, 0)
+        self.assertCountEqual([t['transaction_id'] for t in data['transactions']], ['a', 'b', 'd'])
+        self.assertEqual(self.stored()['b']['amount'], 2.0)
+        self.assertEqual(client.cursors, [None, 'c1'])
+        self.assertEqual(crud.get_plaid_cursor(self.db, 'item'), 'c2')
+
+    def test_sync_restart(self):
+        # a mutation during pagination restarts the sync from its first cursor, discarding the pages read
+        client = FakePlaidClient([
+            sync_page(added=[plaid_txn('a')], has_more=True, next_cursor='p1'),
+            plaid_error('TRANSACTIONS_SYNC_MUTATION_DURING_PAGINATION'),
+            sync_page(added=[plaid_txn('b')], has_more=True, next_cursor='p1'),
+            sync_page(added=[plaid_txn('c')], removed=['b'], next_cursor='p2'),
+        ])
+
+        txn, removed, cursor = validator.plaid_sync('token', client, 'c0')
+        self.assertEqual([t['transaction_id'] for t in txn], ['c'])
+        self.assertEqual(removed, ['b'])
+        self.assertEqual(cursor, 'p2')
+        self.assertEqual(client.cursors, ['c0', 'p1', 'c0', 'p1'])
+
+        # any other error is raised
+        client = FakePlaidClient([plaid_error('ITEM_LOGIN_REQUIRED')])
+        self.assertRaises(plaid.ApiException, validator.plaid_sync, 'token', client, 'c0')
+
+    def test_read_back_limit(self):
+        # only the latest transactions a full download would get are read back from the store
+        client = FakePlaidClient([sync_page(added=[plaid_txn(str(n), days_ago=n) for n in range(1, 6)])])
+        with mock.patch.object(validator, 'PLAID_MAX_FETCH', 2):
+            data = validator.plaid_transactions_incremental('token', client, self.db, 1)
+        self.assertListEqual([t['transaction_id'] for t in data['transactions']], ['1', '2', '3', '4'])
+        self.assertEqual(len(self.stored()), 5)
+
+    def test_concurrent_sync(self):
+        # another sync storing the same transactions updates them instead of failing
+        other = self.session()
+        self.addCleanup(other.close)
+        crud.sync_plaid_transactions(self.db, 'item', 'c1', [plaid_txn('a'), plaid_txn('b')], [])
+        crud.sync_plaid_transactions(other, 'item', 'c1', [plaid_txn('a', amount=2.0), plaid_txn('c')], ['b'])
+        self.assertCountEqual(list(self.stored()), ['a', 'c'])
+        self.assertEqual(self.stored()['a']['amount'], 2.0)
+
+    def test_purge(self):
+        # transactions out of the scoring window, and items unused for too long, are dropped
+        now = datetime.now(timezone.utc)
+        crud.sync_plaid_transactions(self.db, 'item', 'c1', [plaid_txn('new'), plaid_txn('old', days_ago=2000)], [])
+        crud.sync_plaid_transactions(self.db, 'idle', 'c1', [plaid_txn('idle')], [])
+        self.db.query(models.PlaidItemTable).filter_by(item_id='idle').update({'datetime': now - timedelta(days=100)})
+        self.db.commit()
+
+        crud.purge_plaid_transactions(self.db, now.date() - timedelta(days=1800), now - timedelta(days=90))
+        self.assertListEqual(list(self.stored()), ['new'])
+        self.assertDictEqual(self.stored('idle'), {})
+        self.assertIsNone(crud.get_plaid_cursor(self.db, 'idle'))
+        self.assertEqual(crud.get_plaid_cursor(self.db, 'item'), 'c1')
+
+
+class TestPlaidPages(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(payload_cache, 'PAYLOAD_CACHE', PayloadCache(2**20))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fake_client(self, txn):
+        # fake /transactions/get endpoint serving pages of 2 of the given transaction ids
+        client = mock.Mock()
+        client.transactions_get.side_effect = lambda request: FakeResponse({
+            'accounts': [], 'item': {'item_id': 'item'}, 'total_transactions': len(txn),
+            'transactions': [plaid_txn(t) for t in txn[request.options.offset:request.options.offset + 2]]})
+        return client
+
+    def test_shifted_pages(self):
+        # new transactions shift all the pages: cached pages of the previous first page must not be reused
+        txn = ['c', 'd', 'b', 'a']
+        client = self.fake_client(txn)
+        with mock.patch.object(validator, 'PLAID_MAX_FETCH', 2), \
+                mock.patch.dict(validator.PLAID_TTL, {'transactions': 0}):
+            validator.plaid_transactions('token', client, 10)
+            txn.insert(0, 'e')
+            data = validator.plaid_transactions('token', client, 10)
+        self.assertListEqual([t['transaction_id'] for t in data['transactions']], ['e', 'c', 'd', 'b', 'a'])
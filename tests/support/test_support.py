@@ -0,0 +1,410 @@
+from support.singleflight import SingleFlight
+from support.payload_cache import PayloadCache
+from support.client_registry import ClientRegistry
+from support import http_client
+from support.rate_limit import charge_items, limiter
+from limits import parse
+from support.batch import stream_batch
+from slowapi.errors import RateLimitExceeded
+from starlette.requests import Request
+from datetime import date, datetime
+from unittest import mock
+import threading
+import tempfile
+import unittest
+import asyncio
+import shutil
+import time
+import json
+import zlib
+import os
+
+
+# -------------------------------------------------------------------------- #
+#                                TEST CASES                                  #
+#             - test the request coalescing, caching, and pooling -          #
+# -------------------------------------------------------------------------- #
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def coalesce(self, fn, n=5):
+        # n identical callers, arriving one after the other while the first call is in flight
+        flight = SingleFlight()
+
+        async def caller(i):
+            await asyncio.sleep(0.01 * i)
+            return await flight.run('key', fn)
+
+        async def run():
+            return await asyncio.gather(*[caller(i) for i in range(n)], return_exceptions=True)
+
+        return asyncio.run(run())
+
+    def test_blocking_fetch(self):
+        # a blocking fetch runs off the event loop, so the callers arriving meanwhile join it
+        calls = []
+
+        def fetch():
+            calls.append(threading.current_thread())
+            time.sleep(0.2)
+            return {'items': [1, 2, 3]}
+
+        results = self.coalesce(fetch)
+        self.assertEqual(len(calls), 1)
+        self.assertIsNot(calls[0], threading.main_thread())
+        self.assertEqual(results, [{'items': [1, 2, 3]}] * 5)
+
+    def test_async_fetch(self):
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.2)
+            return 'data'
+
+        self.assertEqual(self.coalesce(fetch), ['data'] * 5)
+        self.assertEqual(len(calls), 1)
+
+    def test_copies(self):
+        # all callers but one get a deep copy of the result, so they can mutate it freely
+        fetched = []
+
+        def fetch():
+            time.sleep(0.2)
+            fetched.append({'items': [1, 2, 3]})
+            return fetched[0]
+
+        results = self.coalesce(fetch)
+        self.assertEqual(len([r for r in results if r is fetched[0]]), 1)
+        self.assertEqual(len(set(id(r['items']) for r in results)), 5)
+
+    def test_exception(self):
+        # a failed call raises its exception in every caller
+        def fetch():
+            time.sleep(0.2)
+            raise ValueError('unreachable')
+
+        results = self.coalesce(fetch)
+        self.assertEqual(len(results), 5)
+        for r in results:
+            self.assertIsInstance(r, ValueError)
+
+
+class TestPayloadCache(unittest.TestCase):
+
+    def key(self, n):
+        return ('covalent', '0xabc', 'balances_v2', {'page': n})
+
+    def value(self, n):
+        return {'items': [n] * 100}
+
+    def test_copies(self):
+        # every hit is a fresh copy, so callers can't corrupt the cached value
+        cache = PayloadCache(2**20)
+        cache.put(self.key(0), self.value(0), 60)
+        r = cache.get(self.key(0))
+        r['items'].clear()
+        self.assertEqual(cache.get(self.key(0)), self.value(0))
+        self.assertIsNot(cache.get(self.key(0)), cache.get(self.key(0)))
+
+    def test_dates(self):
+        # dates parsed by the validator SDKs survive the JSON serialization, tuples come back as lists
+        value = {'date': date(2022, 5, 1), 'at': datetime(2022, 5, 1, 12, 30), 'page': ([1], {'next_uri': None})}
+        cache = PayloadCache(2**20)
+        cache.put(self.key(0), value, 60)
+        self.assertEqual(cache.get(self.key(0)), dict(value, page=[[1], {'next_uri': None}]))
+
+        # values that aren't JSON are not cached
+        cache.put(self.key(1), {'items': object()}, 60)
+        self.assertIsNone(cache.get(self.key(1)))
+
+    def test_lru(self):
+        # once over budget, the least recently used values are evicted first
+        cache = PayloadCache(2**20)
+        cache.put(self.key(0), self.value(0), 60)
+        cache.max_bytes = cache.size * 3
+
+        cache.put(self.key(1), self.value(1), 60)
+        cache.put(self.key(2), self.value(2), 60)
+        cache.get(self.key(0))
+        cache.put(self.key(3), self.value(3), 60)
+
+        self.assertIsNone(cache.get(self.key(1)))
+        for n in [0, 2, 3]:
+            self.assertEqual(cache.get(self.key(n)), self.value(n))
+        self.assertLessEqual(cache.size, cache.max_bytes)
+
+    def test_ttl(self):
+        # values expire after the ttl they were stored with
+        cache = PayloadCache(2**20)
+        with mock.patch('support.payload_cache.time.time', return_value=1000):
+            cache.put(self.key(0), self.value(0), 60)
+            cache.put(self.key(1), self.value(1), 600)
+        with mock.patch('support.payload_cache.time.time', return_value=1000 + 61):
+            self.assertIsNone(cache.get(self.key(0)))
+            self.assertEqual(cache.get(self.key(1)), self.value(1))
+
+    def test_disk_tier(self):
+        # values evicted from memory spill to disk, and are promoted back to memory on their next hit
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        cache = PayloadCache(1, folder)
+
+        cache.put(self.key(0), self.value(0), 60)
+        cache.put(self.key(1), self.value(1), 60)
+        self.assertEqual(len(cache.data), 1)
+        self.assertEqual(len(os.listdir(folder)), 1)
+
+        self.assertEqual(cache.get(self.key(0)), self.value(0))
+        self.assertEqual(len(os.listdir(folder)), 2)
+        self.assertEqual(PayloadCache(1, folder).get(self.key(1)), self.value(1))
+
+        # disk files hold compressed JSON, and corrupted ones are ignored
+        files = [os.path.join(folder, f) for f in os.listdir(folder)]
+        with open(files[0], 'rb') as f:
+            self.assertIn(json.loads(zlib.decompress(f.read()[8:])), [self.value(0), self.value(1)])
+        with open(files[0], 'r+b') as f:
+            f.seek(8)
+            f.write(zlib.compress(b'{"items": ['))
+        self.assertEqual(len([n for n in range(2) if PayloadCache(1, folder).get(self.key(n)) is None]), 1)
+
+        # expired values are dropped from disk too
+        with mock.patch('support.payload_cache.time.time', return_value=time.time() + 61):
+            self.assertIsNone(PayloadCache(1, folder).get(self.key(1)))
+        self.assertEqual(len(os.listdir(folder)), 1)
+
+
+class TestHttpClient(unittest.TestCase):
+
+    def sessions(self):
+        # the sessions returned twice within the same loop, left open
+        async def run():
+            return http_client.async_session(), http_client.async_session()
+        return asyncio.run(run())
+
+    def close(self, session):
+        asyncio.run(session.close())
+
+    def test_one_session_per_loop(self):
+        # calls on the same loop share a session, another loop gets its own
+        a, b = self.sessions()
+        self.addCleanup(self.close, a)
+        c, d = self.sessions()
+        self.addCleanup(self.close, c)
+
+        self.assertIs(a, b)
+        self.assertIs(c, d)
+        self.assertIsNot(a, c)
+        self.assertFalse(c.closed)
+
+    def test_closed_session(self):
+        # a closed session is replaced by a new one
+        async def run():
+            a = http_client.async_session()
+            await http_client.close_http_sessions()
+            b = http_client.async_session()
+            await b.close()
+            return a, b
+
+        a, b = asyncio.run(run())
+        self.assertTrue(a.closed)
+        self.assertIsNot(a, b)
+
+
+class TestClientRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.closed = []
+        self.registry = ClientRegistry(2, 600, self.closed.append)
+        self.now = 1000
+        patcher = mock.patch('support.client_registry.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, key):
+        return self.registry.get(key, lambda: {'key': key})
+
+    def test_reuse(self):
+        # the same credentials get the same client
+        a = self.get(('client_id', 'secret'))
+        self.assertIs(self.get(('client_id', 'secret')), a)
+        self.assertIsNot(self.get(('client_id', 'other')), a)
+        self.assertEqual(self.closed, [])
+
+    def test_lru(self):
+        # when full, the least recently used client is dropped and closed
+        a, b = self.get('a'), self.get('b')
+        self.get('a')
+        self.get('c')
+
+        self.assertEqual(self.closed, [b])
+        self.assertIs(self.get('a'), a)
+        self.assertEqual(len(self.registry.data), 2)
+
+    def test_idle_ttl(self):
+        # clients unused for idle_ttl seconds are dropped and closed on the next call
+        a = self.get('a')
+        self.now += 300
+        b = self.get('b')
+        self.now += 301
+
+        c = self.get('c')
+        self.assertEqual(self.closed, [a])
+        self.assertIs(self.get('b'), b)
+        self.assertIsNot(self.get('a'), a)
+        self.assertEqual(self.closed, [a, c])
+
+    def test_clear(self):
+        a, b = self.get('a'), self.get('b')
+        self.registry.clear()
+        self.assertEqual(self.closed, [a, b])
+        self.assertEqual(len(self.registry.data), 0)
+
+
+class FakeSession:
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.passes = []
+
+    def stream(self, items, prepare, respond=None):
+        sessions = []
+
+        def session():
+            sessions.append(FakeSession())
+            return sessions[-1]
+
+        async def answer(item, db, score, risk, tag):
+            return {'status': 'success', 'score': score, 'tag': tag}
+
+        def failed(e):
+            return {'status': 'error', 'message': str(e)}
+
+        async def run():
+            stream = stream_batch(items, 'covalent', prepare, respond or answer, failed, session)
+            return [json.loads(line) async for line in stream]
+
+        with mock.patch('support.batch.score_features', self.score_features):
+            return asyncio.run(run()), sessions
+
+    def score_features(self, validator, rows):
+        # fake scoring pass: the score of a row is the sum of its features
+        self.passes.append(rows)
+        return [(sum(features), {'loan_amount': amount, 'risk_level': 'low'}) for amount, features in rows]
+
+    def test_scored_together(self):
+        # the requests are scored in a single pass, and each line carries the index of its request
+        async def prepare(item, db):
+            await asyncio.sleep(item)
+            return 500, [item, item], (f'tag{item}',)
+
+        lines, sessions = self.stream([0.3, 0.1, 0.2], prepare)
+        self.assertEqual(len(self.passes), 1)
+        self.assertEqual(sorted(self.passes[0]), [(500, [n, n]) for n in [0.1, 0.2, 0.3]])
+        self.assertCountEqual([r['index'] for r in lines], [0, 1, 2])
+        for r in lines:
+            item = [0.3, 0.1, 0.2][r['index']]
+            self.assertEqual(r['score'], item * 2)
+            self.assertEqual(r['tag'], f'tag{item}')
+
+        # every step of every request had its own session, closed once done
+        self.assertEqual(len(sessions), 6)
+        self.assertTrue(all(db.closed for db in sessions))
+
+    def test_error_line(self):
+        # a request failing to be prepared is answered first, with an error line, the others are scored
+        async def prepare(item, db):
+            if item == 'bad':
+                raise ValueError('invalid request')
+            await asyncio.sleep(0.1)
+            return 500, [1], ('ok',)
+
+        lines, sessions = self.stream(['ok', 'bad', 'ok'], prepare)
+        self.assertEqual(lines[0], {'index': 1, 'status': 'error', 'message': 'invalid request'})
+        self.assertEqual(sorted(r['index'] for r in lines[1:]), [0, 2])
+        self.assertEqual([r['status'] for r in lines[1:]], ['success', 'success'])
+        self.assertEqual(len(self.passes[0]), 2)
+        self.assertTrue(all(db.closed for db in sessions))
+
+    def test_respond_error(self):
+        # a request failing once scored gets an error line too
+        async def prepare(item, db):
+            return 500, [item], ()
+
+        async def respond(item, db, score, risk):
+            if item == 2:
+                raise ValueError('unable to save')
+            return {'status': 'success'}
+
+        lines, sessions = self.stream([1, 2], prepare, respond)
+        lines = sorted(lines, key=lambda r: r['index'])
+        self.assertEqual(lines, [{'index': 0, 'status': 'success'},
+                                 {'index': 1, 'status': 'error', 'message': 'unable to save'}])
+
+    def test_scoring_error(self):
+        # a failing scoring pass answers every request left with an error line, instead of leaving the stream hanging
+        async def prepare(item, db):
+            if item == 'bad':
+                raise ValueError('invalid request')
+            return 500, [1], ()
+
+        self.score_features = mock.Mock(side_effect=ValueError('no config'))
+        lines, sessions = self.stream(['ok', 'bad', 'ok'], prepare)
+        self.assertEqual(lines[0], {'index': 1, 'status': 'error', 'message': 'invalid request'})
+        self.assertEqual(sorted(r['index'] for r in lines[1:]), [0, 2])
+        self.assertEqual({r['message'] for r in lines[1:]}, {'no config'})
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('support.rate_limit.BATCH_RATE_LIMIT', '5/minute')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        limiter.reset()
+        self.addCleanup(limiter.reset)
+
+    def request(self, host, path='/credit_score/plaid/batch'):
+        return Request({'type': 'http', 'path': path, 'client': (host, 1234), 'headers': []})
+
+    def test_charge_items(self):
+        # a batch is charged one hit per request, and rejected as a whole once over the budget
+        charge_items(self.request('10.0.0.1'), 3)
+        with self.assertRaises(RateLimitExceeded):
+            charge_items(self.request('10.0.0.1'), 3)
+        charge_items(self.request('10.0.0.1'), 2)
+        with self.assertRaises(RateLimitExceeded):
+            charge_items(self.request('10.0.0.1', '/credit_score/coinbase/batch'), 1)
+
+        # the budget is per client, apart from the limit of the single request endpoints
+        charge_items(self.request('10.0.0.2'), 5)
+        self.assertTrue(limiter.limiter.hit(parse('5/minute'), '10.0.0.1', '/credit_score/plaid'))
+
+    def test_concurrent_batches(self):
+        # concurrent batches can't both fit in the same budget
+        barrier = threading.Barrier(8)
+        charged = []
+
+        def batch():
+            barrier.wait()
+            try:
+                charge_items(self.request('10.0.0.1'), 3)
+                charged.append(1)
+            except RateLimitExceeded:
+                pass
+
+        threads = [threading.Thread(target=batch) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(charged), 1)
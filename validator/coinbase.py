@@ -1,14 +1,36 @@
 from coinbase.wallet.error import CoinbaseError
 from coinbase.wallet.client import OAuthClient
+from support.client_registry import ClientRegistry, CLIENT_MAX_ENTRIES, CLIENT_IDLE_TTL
+from support import payload_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from icecream import ic
 import numpy as np
 import json
 
 
+COINBASE_PAGE_LIMIT = 100  # largest page size, https://developers.coinbase.com/api/v2#pagination
+COINBASE_MAX_WORKERS = 4  # accounts whose transactions are fetched at once, for a single user
+
+# seconds a raw Coinbase response is cached (see PayloadCache)
+COINBASE_TTL = {
+    'get_currencies': 3600,  # currencies supported by Coinbase, the same for all users
+    'get_accounts': 60,  # balances
+    'get_transactions': 120,  # first page: latest transactions
+    'get_transactions_older': 3600,  # following pages: older transactions, which seldom change
+}
+
+
+COINBASE_CLIENTS = ClientRegistry(CLIENT_MAX_ENTRIES, CLIENT_IDLE_TTL, lambda client: client.session.close())
+
+
 def coinbase_client(access_token, refresh_token):
-    '''Connect to a client's Coinbase account using their tokens'''
-    return OAuthClient(access_token, refresh_token)
+    '''
+    Connect to a client's Coinbase account using their tokens.
+    The client is reused by the following requests made with the same tokens (see ClientRegistry)
+    '''
+    return COINBASE_CLIENTS.get(
+        (access_token, refresh_token), lambda: OAuthClient(access_token, refresh_token))
 
 
 def format_error(e):
@@ -27,35 +49,43 @@ def convert_to_json(obj):
     return json.loads(json.dumps(obj))
 
 
-def coinbase_currencies(client):
-    '''Get all Coinbase fiat currencies'''
-    try:
-        r = client.get_currencies()
-        r = dict([(n['id'], float(n['min_size'])) for n in r['data']])
-
-    except CoinbaseError as e:
-        r = format_error(e)
-
-    finally:
-        return r
-
-
-def coinbase_native_currency(client):
-    '''Check what currency is currently set as default 'native currency' in the user's Coinbase account'''
-    try:
-        r = client.get_current_user()['native_currency']
-
-    except CoinbaseError as e:
-        r = format_error(e)
-
-    finally:
-        return r
+def coinbase_page(client, endpoint, params, *args):
+    '''
+    Fetch one page of a Coinbase list endpoint, as plain data and pagination.
+    Pages go through the raw payload cache
+    '''
+    older = endpoint + '_older'
+    name = older if older in COINBASE_TTL and 'starting_after' in params else endpoint
+    key = ('coinbase', client.access_token, name, {'args': args, **params})
+    page = payload_cache.PAYLOAD_CACHE.get(key)
+    if page is None:
+        r = getattr(client, endpoint)(*args, **params)
+        page = convert_to_json(r['data']), convert_to_json(r.pagination)
+        payload_cache.PAYLOAD_CACHE.put(key, page, COINBASE_TTL[name])
+    return page
+
+
+def coinbase_paginate(client, endpoint, *args):
+    '''Walk every page of a Coinbase list endpoint, following its next_uri cursor, and return all items'''
+    data = []
+    params = {'limit': COINBASE_PAGE_LIMIT}
+    while True:
+        items, pagination = coinbase_page(client, endpoint, dict(params), *args)
+        data.extend(items)
+        if not pagination or not pagination.get('next_uri'):
+            return data
+        params['starting_after'] = pagination['next_starting_after']
 
 
-def coinbase_set_native_currency(client, symbol):
-    '''Reset the currency of the user's Coinbase account to its initial default native currency'''
+def coinbase_currencies(client):
+    '''Get all Coinbase fiat currencies'''
     try:
-        r = client.update_current_user(native_currency=symbol)
+        key = ('coinbase', None, 'get_currencies', {})
+        r = payload_cache.PAYLOAD_CACHE.get(key)
+        if r is None:
+            r = convert_to_json(client.get_currencies()['data'])
+            payload_cache.PAYLOAD_CACHE.put(key, r, COINBASE_TTL['get_currencies'])
+        r = dict([(n['id'], float(n['min_size'])) for n in r])
 
     except CoinbaseError as e:
         r = format_error(e)
@@ -67,7 +97,7 @@ def coinbase_set_native_currency(client, symbol):
 def coinbase_accounts(client):
     '''Returns list of accounts with balance > $0. Current balances are reported both in native currency and in USD for each account.'''
     try:
-        r = convert_to_json(client.get_accounts()['data'])
+        r = coinbase_paginate(client, 'get_accounts')
         r = [n for n in r if float(n['native_balance']['amount']) != 0]
 
         for d in r:
@@ -87,9 +117,9 @@ def coinbase_accounts(client):
 
 
 def coinbase_transactions(client, account_id):
-    '''Returns Coinbase data for all user's accounts'''
+    '''Returns all transactions of a user's account, across all pages'''
     try:
-        r = convert_to_json(client.get_transactions(account_id)['data'])
+        r = coinbase_paginate(client, 'get_transactions', account_id)
 
     except CoinbaseError as e:
         r = format_error(e)
@@ -98,6 +128,40 @@ def coinbase_transactions(client, account_id):
         return r
 
 
+def coinbase_transactions_stream(client, account_ids):
+    '''
+    Fetch the transactions of all accounts concurrently, at most COINBASE_MAX_WORKERS accounts at once,
+    and yield the position of each account along with its transactions, as soon as they arrive
+    '''
+    with ThreadPoolExecutor(max_workers=COINBASE_MAX_WORKERS) as pool:
+        futures = {pool.submit(coinbase_transactions, client, n): i for i, n in enumerate(account_ids)}
+        try:
+            for f in as_completed(futures):
+                r = f.result()
+                if 'error' in r:
+                    raise Exception(r['error']['message'])
+                yield futures[f], r
+        finally:
+            for f in futures:
+                f.cancel()
+
+
+def format_transactions(txn, txn_types):
+    '''Keep the completed transactions of the chosen types, and tell apart incoming and outgoing sends'''
+    txn = [n for n in txn
+           if n['status'] == 'completed'
+           and n['type'] in txn_types]
+
+    for d in txn:
+        if d['type'] == 'send' and np.sign(float(d['amount']['amount'])) == 1:
+            d['type'] = 'send_credit'
+
+        elif d['type'] == 'send' and np.sign(float(d['amount']['amount'])) == -1:
+            d['type'] = 'send_debit'
+
+    return txn
+
+
 def coinbase_accounts_and_transactions(client, currencies, txn_types):
     '''Returns user accounts and transactions'''
     try:
@@ -109,24 +173,51 @@ def coinbase_accounts_and_transactions(client, currencies, txn_types):
         # formating accounts
         acc = [n for n in acc if n['currency'] in currencies]
 
-        # fetching transactions
-        txn = [coinbase_transactions(client, n['id']) for n in acc]
-
-        # formatting transactions
-        txn = [x for n in txn for x in n]
-        txn = [n for n in txn
-               if n['status'] == 'completed'
-               and n['type'] in txn_types]
-
-        for d in txn:
-            if d['type'] == 'send' and np.sign(float(d['amount']['amount'])) == 1:
-                d['type'] = 'send_credit'
+        # fetching and formatting transactions, account by account as they arrive
+        pages = [None] * len(acc)
+        for i, txn in coinbase_transactions_stream(client, [n['id'] for n in acc]):
+            pages[i] = format_transactions(txn, txn_types)
 
-            elif d['type'] == 'send' and np.sign(float(d['amount']['amount'])) == -1:
-                d['type'] = 'send_debit'
+        # keep the transactions in account order
+        txn = [x for n in pages for x in n]
 
     except Exception as e:
         acc = str(e)
         txn = str(e)
 
     return acc, txn
+
+
+def coinbase_native_currencies(acc, txn):
+    '''Returns the currencies the native balances and amounts are reported in'''
+    return sorted(set([d['native_balance']['currency'] for d in acc] +
+                      [d['native_amount']['currency'] for d in txn]))
+
+
+def coinbase_to_usd(acc, txn, rates):
+    '''
+    Convert the native balances of the accounts and the native amounts of the transactions to USD,
+    given the USD value of one unit of each native currency. This replaces switching the native
+    currency of the user's Coinbase account to USD while fetching their data.
+    Past transaction amounts are converted at today's rate, not at the rate of their own day,
+    so they drift with the exchange rate since then. This is an accepted approximation:
+    native currencies are fiat currencies, whose USD rates move little next to the crypto prices
+    the score depends on. Raises an exception if the rate of a currency is missing
+    '''
+    missing = set(coinbase_native_currencies(acc, txn)) - set(rates)
+    if missing:
+        raise Exception(f'Missing USD rate for: {", ".join(sorted(missing))}')
+
+    for d in acc:
+        native = d['native_balance']
+        if native['currency'] != 'USD':
+            native['amount'] = float(native['amount']) * rates[native['currency']]
+            native['currency'] = 'USD'
+
+    for d in txn:
+        native = d['native_amount']
+        if native['currency'] != 'USD':
+            native['amount'] = str(float(native['amount']) * rates[native['currency']])
+            native['currency'] = 'USD'
+
+    return acc, txn
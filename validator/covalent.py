@@ -1,9 +1,25 @@
-import requests
+from support.http_client import async_session
+from support import payload_cache
 from icecream import ic
+import asyncio
+import aiohttp
+import json
+
+
+COVALENT_URL = 'https://api.covalenthq.com/v1'
+
+# seconds a raw Covalent response is cached (see PayloadCache)
+COVALENT_TTL = {
+    'balances_v2': 60,
+    'portfolio_v2': 300,
+    'transactions_v2': 120,  # first page: latest transactions
+    'transactions_v2_older': 3600,  # following pages: older transactions, cached per first page (see payload_version)
+}
+
 
 def format_err(e):
     '''
-    format the error output when fetching Covalent data. 
+    format the error output when fetching Covalent data.
     Covalent API returns JSON responses with the same shape for all endpoints
     '''
     error = {
@@ -15,71 +31,155 @@ def format_err(e):
     return error
 
 
-def covalent_get_balances_or_portfolio(chain_id, eth_address, endpoints, api_key):
+def format_unreachable(e):
+    '''format the error output when the Covalent API could not be reached or timed out'''
+    return format_err({
+        'error': True,
+        'error_message': f'Covalent API unreachable: {str(e) or type(e).__name__}',
+        'error_code': None
+    })
+
+
+async def covalent_get(endpoint):
+    '''send a GET request to the Covalent API and return its JSON payload'''
+    async with async_session().get(COVALENT_URL + endpoint) as r:
+        return await r.json(content_type=None)
+
+
+async def covalent_get_cached(eth_address, name, endpoint, version=None):
     '''
-    get historical portfolio value over time or token balances for an address. 
-    This function works for 2 endpoints: either 'balances_v2' or 'portfolio_v2' 
+    covalent_get() through the raw payload cache, with the ttl of the endpoint name.
+    Only successful responses are cached
+    '''
+    key = ('covalent', eth_address, name, {'endpoint': endpoint, 'version': version})
+    result = payload_cache.PAYLOAD_CACHE.get(key)
+    if result is None:
+        result = await covalent_get(endpoint)
+        if not result['error']:
+            payload_cache.PAYLOAD_CACHE.put(key, result, COVALENT_TTL[name])
+    return result
+
+
+async def covalent_get_balances_or_portfolio(chain_id, eth_address, endpoints, api_key):
+    '''
+    get historical portfolio value over time or token balances for an address.
+    This function works for 2 endpoints: either 'balances_v2' or 'portfolio_v2'
     '''
     try:
         endpoint = f'/{chain_id}/address/{eth_address}/{endpoints}/?key={api_key}'
-        url = 'https://api.covalenthq.com/v1' + endpoint
-        result = requests.get(url).json()
+        result = await covalent_get_cached(eth_address, endpoints, endpoint)
         if result['error']:
             r = format_err(result)
         else:
             r = result['data']
 
-    except requests.exceptions.JSONDecodeError:
+    except json.JSONDecodeError:
         r = 'JSONDecodeError: invalid Covalent API key'
 
-    finally:
-        return r
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        r = format_unreachable(e)
+
+    return r
+
 
+def transactions_endpoint(chain_id, eth_address, api_key, no_logs, pagesize, pagenumber):
+    return f'/{chain_id}/address/{eth_address}/transactions_v2/'\
+        f'?no-logs={no_logs}&page-size={pagesize}&page-number={pagenumber}&key={api_key}'
 
-def covalent_get_transactions(chain_id, eth_address, api_key, no_logs, pagesize, pagenumber):
+
+async def covalent_get_transactions(chain_id, eth_address, api_key, no_logs, pagesize, pagenumber, max_pages=3):
     '''
     Description:
-        get all transactions for a given address. This endpoint does a deep-crawl 
-        of the blockchain to retrieve all kinds of transactions/transfers that 
-        references the address including indexed topics within the event logs
+        get all transactions for a given address. This endpoint does a deep-crawl
+        of the blockchain to retrieve all kinds of transactions/transfers that
+        references the address including indexed topics within the event logs.
+        As soon as the first page reports more data, the following pages are all
+        requested at once; they are merged in page order and the pending requests
+        are cancelled as soon as a page reports there is no more data
 
     Parameters:
-        chain_id (int): blockchain id 
+        chain_id (int): blockchain id
         eth_address (str): wallet address to fetch txn data from
         api_key (str): Covalent api key to for the https request
         no_logs (bool): choose whether to include log events in the return object
         pagesize (int): number of results per page
         pagenumber (int): the specific page to be returned
+        max_pages (int): maximum number of pages to fetch, including the first one
 
-    Returns: 
+    Returns:
         r (dict): the txn history for a wallet address
     '''
+    pages = []
     try:
-        endpoint = f'/{chain_id}/address/{eth_address}/transactions_v2/'\
-                f'?no-logs={no_logs}&page-size={pagesize}&page-number={pagenumber}&key={api_key}'
-        url = 'https://api.covalenthq.com/v1' + endpoint
-        result = requests.get(url).json()
+        endpoint = transactions_endpoint(chain_id, eth_address, api_key, no_logs, pagesize, pagenumber)
+        result = await covalent_get_cached(eth_address, 'transactions_v2', endpoint)
 
         if result['error']:
             r = format_err(result)
 
         else:
             txn = result['data']
-            # fetched txn data from the first 3 pages making 3 distinct Covalent API calls
-            while pagenumber < 2:
-                pagenumber += 1
-                if txn['pagination']['has_more']:
-                    endpoint = f'/{chain_id}/address/{eth_address}/transactions_v2/'\
-                            f'?no-logs={no_logs}&page-size={pagesize}&page-number={pagenumber}&key={api_key}'
-                    url = 'https://api.covalenthq.com/v1' + endpoint
-                    result = requests.get(url).json()
-                    txn_next = result['data']
-                    txn['items'] = txn['items'] + txn_next['items']
-                    txn['pagination']['has_more'] = txn_next['pagination']['has_more']
+            if txn['pagination']['has_more']:
+                # new transactions shift the following pages, along with the first one
+                version = payload_cache.payload_version([t['tx_hash'] for t in txn['items']])
+                pages = [asyncio.ensure_future(covalent_get_cached(
+                    eth_address, 'transactions_v2_older',
+                    transactions_endpoint(chain_id, eth_address, api_key, no_logs, pagesize, n), version))
+                    for n in range(pagenumber + 1, pagenumber + max_pages)]
+
+            # merge the prefetched pages in order, up to the first page with no more data
+            for page in pages:
+                if not txn['pagination']['has_more']:
+                    break
+                result = await page
+                if result['error']:
+                    txn = format_err(result)
+                    break
+                txn_next = result['data']
+                # pages fetched while new transactions arrive may overlap
+                seen = set([t['tx_hash'] for t in txn['items']])
+                txn['items'] = txn['items'] + [t for t in txn_next['items'] if t['tx_hash'] not in seen]
+                txn['pagination']['has_more'] = txn_next['pagination']['has_more']
             r = txn
-    
-    except requests.exceptions.JSONDecodeError:
+
+    except json.JSONDecodeError:
         r = 'JSONDecodeError: invalid Covalent API key'
 
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        r = format_unreachable(e)
+
     finally:
-        return r
\ No newline at end of file
+        # drop the pages that are no longer needed
+        for page in pages:
+            page.cancel()
+        await asyncio.gather(*pages, return_exceptions=True)
+
+    return r
+
+
+async def covalent_get_all(chain_id, eth_address, api_key, no_logs, pagesize, pagenumber, max_pages=3):
+    '''
+    Description:
+        fetch transactions, balances, and portfolio of a wallet address concurrently,
+        so the overall latency is that of the slowest endpoint rather than their sum
+
+    Parameters:
+        chain_id (int): blockchain id
+        eth_address (str): wallet address to fetch data from
+        api_key (str): Covalent api key to for the https request
+        no_logs (bool): choose whether to include log events in the transactions
+        pagesize (int): number of transactions per page
+        pagenumber (int): the first page of transactions to be returned
+        max_pages (int): maximum number of transaction pages to fetch
+
+    Returns:
+        txn (dict): Covalent class A endpoint 'transactions_v2'
+        balances (dict): Covalent class A endpoint 'balances_v2'
+        portfolio (dict): Covalent class A endpoint 'portfolio_v2'
+    '''
+    txn, balances, portfolio = await asyncio.gather(
+        covalent_get_transactions(chain_id, eth_address, api_key, no_logs, pagesize, pagenumber, max_pages),
+        covalent_get_balances_or_portfolio(chain_id, eth_address, 'balances_v2', api_key),
+        covalent_get_balances_or_portfolio(chain_id, eth_address, 'portfolio_v2', api_key)
+    )
+    return txn, balances, portfolio
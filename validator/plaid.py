@@ -1,15 +1,36 @@
 from plaid.model.transactions_get_request_options import TransactionsGetRequestOptions
 from plaid.model.transactions_get_request import TransactionsGetRequest
+from plaid.model.transactions_sync_request import TransactionsSyncRequest
+from plaid.model.accounts_get_request import AccountsGetRequest
 from plaid.model.institutions_get_by_id_request import InstitutionsGetByIdRequest
 from plaid.model.country_code import CountryCode
 from plaid.api import plaid_api
+from concurrent.futures import ThreadPoolExecutor
 from helpers.helper import flatten_list
-from datetime import datetime, timedelta
+from support.client_registry import ClientRegistry, CLIENT_MAX_ENTRIES, CLIENT_IDLE_TTL
+from support import payload_cache
+from datetime import datetime, timedelta, timezone
 from icecream import ic
+from os import getenv
+from math import ceil
 import plaid
 import json
 
 
+PLAID_MAX_FETCH = 500  # https://plaid.com/docs/api/products/transactions/#transactionsget
+PLAID_MAX_WORKERS = 8  # page requests in flight at once, shared by all requests
+PLAID_POOL = ThreadPoolExecutor(max_workers=PLAID_MAX_WORKERS, thread_name_prefix='plaid')
+PLAID_INCREMENTAL = getenv('PLAID_INCREMENTAL', 'false').lower() in ['1', 'true', 'yes']
+PLAID_STORE_IDLE_DAYS = int(getenv('PLAID_STORE_IDLE_DAYS', 90))  # days the transactions of an unused item are stored
+PLAID_PURGE_INTERVAL = int(getenv('PLAID_PURGE_INTERVAL', 86400))  # seconds between two purges of the store
+
+# seconds a raw Plaid response is cached (see PayloadCache)
+PLAID_TTL = {
+    'transactions': 120,  # first page: accounts, balances, and latest transactions
+    'transactions_older': 3600,  # following pages: older transactions, cached per first page (see payload_version)
+}
+
+
 def plaid_environment(plaid_env):
     if plaid_env == 'sandbox':
         host = plaid.Environment.Sandbox
@@ -23,7 +44,7 @@ def plaid_environment(plaid_env):
     return host
 
 
-def plaid_client(plaid_env, client_id, secret):
+def build_plaid_client(plaid_env, client_id, secret):
     config = plaid.Configuration(
         host=plaid_environment(plaid_env),
         api_key={
@@ -34,6 +55,23 @@ def plaid_client(plaid_env, client_id, secret):
     return plaid_api.PlaidApi(plaid.ApiClient(config))
 
 
+def close_plaid_client(client):
+    client.api_client.close()
+    client.api_client.rest_client.pool_manager.clear()
+
+
+PLAID_CLIENTS = ClientRegistry(CLIENT_MAX_ENTRIES, CLIENT_IDLE_TTL, close_plaid_client)
+
+
+def plaid_client(plaid_env, client_id, secret):
+    '''
+    returns the Plaid client of an integrator, reused across requests (see ClientRegistry).
+    The secret is part of the key, so a client is never shared with a request holding a different secret
+    '''
+    return PLAID_CLIENTS.get(
+        (plaid_env, client_id, secret), lambda: build_plaid_client(plaid_env, client_id, secret))
+
+
 def format_error(e):
     r = json.loads(e.body)
     error = {
@@ -46,53 +84,75 @@ def format_error(e):
     return error
 
 
+def plaid_transactions_page(access_token, client, start_date, end_date, offset, version=None):
+    '''
+    fetch one page of up to PLAID_MAX_FETCH transactions, starting at the given offset.
+    Successful responses go through the raw payload cache, the following pages under the version of the first one
+    '''
+    name = 'transactions' if offset == 0 else 'transactions_older'
+    key = ('plaid', access_token, name, {
+        'start_date': start_date.date(), 'end_date': end_date.date(), 'offset': offset, 'version': version})
+    r = payload_cache.PAYLOAD_CACHE.get(key)
+    if r is not None:
+        return r
+
+    options = TransactionsGetRequestOptions()
+    options.offset = offset
+    options.count = PLAID_MAX_FETCH
+
+    request = TransactionsGetRequest(
+        access_token=access_token,
+        start_date=start_date.date(),
+        end_date=end_date.date(),
+        options=options
+    )
+
+    r = client.transactions_get(request).to_dict()
+    if 'error' in r:
+        raise Exception(r['error']['message'])
+
+    payload_cache.PAYLOAD_CACHE.put(key, r, PLAID_TTL[name])
+    return r
+
+
 def plaid_transactions(access_token, client, pagination_limit):
+    '''
+    Description:
+        fetch up to 5 years of transactions. The first page tells how many transactions exist,
+        so the offsets of all other pages are known up front: they are requested in parallel
+        on PLAID_POOL, up to pagination_limit extra pages, and merged back in offset order
 
+    Parameters:
+        access_token (str): Plaid access token of the user
+        client (plaid.api.plaid_api.PlaidApi): plaid client info (api key, secret key, palid environment)
+        pagination_limit (int): maximum number of pages to fetch after the first one
+
+    Returns:
+        data (dict): accounts, item, and posted transactions of the user
+    '''
     start_date = (datetime.now() - timedelta(days=1800))  # max of 5 years of data
     end_date = datetime.now()
     txn = list()
-    plaid_max_fetch = 500  # https://plaid.com/docs/api/products/transactions/#transactionsget
 
     try:
-        options = TransactionsGetRequestOptions()
-        options.count = plaid_max_fetch
-
-        request = TransactionsGetRequest(
-            access_token=access_token,
-            start_date=start_date.date(),
-            end_date=end_date.date(),
-            options=options
-        )
-
-        r = client.transactions_get(request).to_dict()
-        if 'error' in r:
-            raise Exception(r['error']['message'])
+        r = plaid_transactions_page(access_token, client, start_date, end_date, 0)
 
         txn_count = len(r['transactions'])
         txn_total_count = r['total_transactions']
 
         # calling other pages if exists
-        if txn_total_count != txn_count:
-            extra_pages = int(txn_total_count / txn_count)
+        if txn_total_count > txn_count:
+            extra_pages = ceil((txn_total_count - txn_count) / PLAID_MAX_FETCH)
             extra_pages = min(extra_pages, pagination_limit)
+            offsets = [txn_count + n * PLAID_MAX_FETCH for n in range(extra_pages)]
 
-            for n in range(extra_pages):
-                options = TransactionsGetRequestOptions()
-                options.offset = txn_count
-                options.count = plaid_max_fetch
-
-                request = TransactionsGetRequest(
-                    access_token=access_token,
-                    start_date=start_date.date(),
-                    end_date=end_date.date(),
-                    options=options
-                )
-                rn = client.transactions_get(request).to_dict()
-                if 'error' in rn:
-                    raise Exception(rn['error']['message'])
-
-                txn.append(rn['transactions'])
-                txn_count += len(rn['transactions'])
+            # new transactions shift the following pages, along with the first one
+            version = payload_cache.payload_version(txn_total_count, [t['transaction_id'] for t in r['transactions']])
+            pages = PLAID_POOL.map(
+                lambda offset: plaid_transactions_page(access_token, client, start_date, end_date, offset, version),
+                offsets
+            )
+            txn = [rn['transactions'] for rn in pages]
 
         # first page data only
         data = {k: v for k, v in r.items()
@@ -102,7 +162,9 @@ def plaid_transactions(access_token, client, pagination_limit):
         if txn:
             txn = flatten_list(txn)  # other pages
             lst = data['transactions']  # first page
-            lst.extend(txn)
+            # pages fetched while new transactions arrive may overlap
+            seen = set([t['transaction_id'] for t in lst])
+            lst.extend([t for t in txn if t['transaction_id'] not in seen])
             data['transactions'] = lst
 
         # remove pending transactions
@@ -115,6 +177,119 @@ def plaid_transactions(access_token, client, pagination_limit):
         return data
 
 
+def plaid_sync(access_token, client, cursor):
+    '''
+    Description:
+        fetch all transaction updates of a Plaid item since the given sync cursor.
+        If the data changes while paginating, the sync restarts from the given cursor
+
+    Parameters:
+        access_token (str): Plaid access token of the user
+        client (plaid.api.plaid_api.PlaidApi): plaid client info (api key, secret key, palid environment)
+        cursor (str): last sync cursor of the item (None to sync its whole history)
+
+    Returns:
+        transactions (list): added and modified transactions
+        removed (list): ids of the removed transactions
+        cursor (str): the new sync cursor
+    '''
+    while True:
+        updates, removed, next_cursor = {}, set(), cursor
+        try:
+            has_more = True
+            while has_more:
+                request = TransactionsSyncRequest(access_token=access_token, count=PLAID_MAX_FETCH)
+                if next_cursor:
+                    request.cursor = next_cursor
+
+                r = client.transactions_sync(request).to_dict()
+                for t in r['added'] + r['modified']:
+                    updates[t['transaction_id']] = t
+                for t in r['removed']:
+                    updates.pop(t['transaction_id'], None)
+                    removed.add(t['transaction_id'])
+
+                has_more = r['has_more']
+                next_cursor = r['next_cursor']
+
+            return list(updates.values()), list(removed), next_cursor
+
+        except plaid.ApiException as e:
+            if json.loads(e.body)['error_code'] != 'TRANSACTIONS_SYNC_MUTATION_DURING_PAGINATION':
+                raise
+
+
+def plaid_transactions_incremental(access_token, client, db, pagination_limit):
+    '''
+    Description:
+        incremental counterpart of plaid_transactions(): the transactions of every Plaid item are stored
+        locally along with a sync cursor, so each request only fetches the updates since the last one.
+        Accounts are always fetched live, to get up-to-date balances. Only the latest transactions
+        a full download would get are read back, so both score the same data (see plaid_purge_store).
+        If the local store can't be used, fall back to a full download
+
+    Parameters:
+        access_token (str): Plaid access token of the user
+        client (plaid.api.plaid_api.PlaidApi): plaid client info (api key, secret key, palid environment)
+        db (sqlalchemy.orm.Session): database session
+        pagination_limit (int): maximum number of pages of transactions after the first one
+
+    Returns:
+        data (dict): accounts, item, and posted transactions of the user
+    '''
+    start_date = (datetime.now() - timedelta(days=1800))  # max of 5 years of data
+
+    try:
+        r = client.accounts_get(AccountsGetRequest(access_token=access_token)).to_dict()
+        item_id = r['item']['item_id']
+
+        try:
+            # the local store needs a database: only import it when it is used
+            from support import crud
+
+            cursor = crud.get_plaid_cursor(db, item_id)
+            txn, removed, cursor = plaid_sync(access_token, client, cursor)
+            crud.sync_plaid_transactions(db, item_id, cursor, txn, removed)
+            txn = crud.get_plaid_transactions(
+                db, item_id, start_date.date(), (pagination_limit + 1) * PLAID_MAX_FETCH)
+
+            data = {
+                'accounts': r['accounts'],
+                'item': r['item'],
+                'transactions': [t for t in txn if not t['pending']]
+            }
+
+        except plaid.ApiException:
+            raise
+
+        except Exception as e:
+            print(f'\033[31m Unable to sync Plaid transactions, downloading them all: {e}\033[0m')
+            data = plaid_transactions(access_token, client, pagination_limit)
+
+    except plaid.ApiException as e:
+        data = format_error(e)
+
+    finally:
+        return data
+
+
+def plaid_purge_store():
+    '''
+    drop the stored transactions out of the 5 year scoring window, and the items unused for PLAID_STORE_IDLE_DAYS
+    along with their transactions. Run on a schedule, every PLAID_PURGE_INTERVAL seconds (see main.py)
+    '''
+    from support.database import SessionLocal
+    from support import crud
+
+    db = SessionLocal()
+    try:
+        now = datetime.now(timezone.utc)
+        crud.purge_plaid_transactions(
+            db, (now - timedelta(days=1800)).date(), now - timedelta(days=PLAID_STORE_IDLE_DAYS))
+    finally:
+        db.close()
+
+
 def plaid_bank_name(client, bank_id):
     '''
         Description: